@@ -0,0 +1,44 @@
+"""
+Settings for the benchmark commands (benchmark_endpoints...).
+
+    python manage.py benchmark_endpoints --settings=coredjango.benchmark_settings
+
+Same as settings.py but on SQLite (the benchmark seeds a throwaway test database, in memory unless
+BENCHMARK_DATABASE is set) and without the debug toolbar, so nothing extra is measured.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import MIDDLEWARE
+
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['testserver', 'localhost', '127.0.0.1']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'benchmark.sqlite3',
+        'TEST': {
+            'NAME': os.environ.get('BENCHMARK_DATABASE'),    #None means an in-memory database
+        },
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1_000_000,     #the local-memory default (300) evicts most of the prices and pages, a shared cache wouldn't
+        },
+    }
+}
+
+MIDDLEWARE = [middleware for middleware in MIDDLEWARE if not middleware.startswith('debug_toolbar')]
+
+STORE_OUTBOX_MODE = 'worker'      #no background threads while measuring
+
+SILENCED_SYSTEM_CHECKS = ['debug_toolbar.W001']     #the toolbar app stays installed for its urls, only its middleware is removed
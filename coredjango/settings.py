@@ -58,6 +58,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'store.profiling.ProfilingMiddleware',
 ]
 
 INTERNAL_IPS = [
@@ -101,6 +102,59 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# any backend works here (redis, memcached...), the local-memory one is just the default
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'coredjango',
+    }
+}
+
+STORE_RESPONSE_CACHE_ALIAS = 'default'
+STORE_RESPONSE_CACHE_TIMEOUT = 60 * 15     #in seconds... writes invalidate the cached responses right away through version counters
+
+STORE_OUTBOX_MODE = 'thread'      #'thread' delivers the outbox events on background threads of the web process, 'worker' leaves them to 'manage.py run_outbox_worker', 'sync' delivers them right after the commit
+STORE_OUTBOX_THREADS = 4
+STORE_OUTBOX_BATCH_SIZE = 100
+STORE_OUTBOX_MAX_ATTEMPTS = 5
+
+STORE_PROFILING_SAMPLE_RATE = 0.01     #fraction of the /store/ requests profiled by store.profiling.ProfilingMiddleware (see 'manage.py profiling_report')
+
+STORE_SEARCH_BACKEND = 'auto'     #'auto' uses the database's full text index (mysql, sqlite) and falls back to 'python'
+STORE_SEARCH_RANKED_RESULTS = 200      #matches of a ?search= ordered by relevance, the others (never dropped) follow them in id order
+
+STORE_CART_BACKEND = 'database'     #'cache' keeps the anonymous carts in STORE_CART_CACHE_ALIAS (it has to be shared by all the processes, e.g. redis) and writes them to the database only at checkout
+STORE_CART_CACHE_ALIAS = 'default'
+STORE_CART_TTL = 60 * 60 * 24 * 7      #in seconds since the last change of a cart kept in the cache
+STORE_CART_MAX_AGE_DAYS = 30      #database carts older than this are deleted by 'manage.py purge_abandoned_carts'
+
+STORE_EXPORT_CHUNK_SIZE = 2000      #rows read (and items prefetched) at a time by the products/export/ and orders/export/ endpoints
+
+STORE_IMPORT_BATCH_SIZE = 1000      #products validated and written per transaction by products/import/ and 'manage.py import_products'
+
+STORE_TAX_RATE = '0.30'      #added to the promotion price of the products (store/pricing.py), a string so it stays an exact decimal
+
+STORE_HISTORY_TOP_PRODUCTS = 5      #products listed by customers/<id>/history/
+STORE_HISTORY_CHUNK_SIZE = 500      #customers recomputed per transaction by 'manage.py rebuild_customer_history'
+
+STORE_REPORTS_MAX_DAYS = 366      #longest range of a reports/ request
+STORE_REPORTS_CHUNK_DAYS = 31      #days recomputed per transaction by 'manage.py rebuild_sales_rollups'
+
+STORE_ASYNC_VIEWS = False      #True serves the anonymous product/collection/review/cart reads from async views (store/async_views.py), only worth it under asgi
+
+STORE_PRODUCT_INCLUDES = {      #what '?include=' can add to the products of products/ (store_custom owns the tags and the likes, store doesn't import them)
+    'tags': 'store_custom.loaders.prefetch_tags',
+    'likes': 'store_custom.loaders.prefetch_likes',
+}
+
+LIKES_MODELS = ['store.product']     #what can be liked through the likes/ endpoints
+LIKES_COUNTER_SHARDS = 16      #counter rows per object (likes/counters.py)... more shards, less waiting on a popular object's row lock
+LIKES_COUNT_CACHE_TIMEOUT = 60
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -151,7 +205,7 @@ REST_FRAMEWORK = {
     #'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberValidation'    #to make page number validation global across all the viewsets
 
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'store_custom.authentication.CachedJWTAuthentication',     #JWTAuthentication without the user query on every request
     ),
 
     #'DEFAULT_PERMISSION_CLASSES': [
@@ -172,6 +226,13 @@ DJOSER = {
 }
 
 
+AUTHENTICATION_BACKENDS = ['store_custom.backends.CachedModelBackend']     #ModelBackend with the permission sets in the cache
+
+AUTH_USER_CACHE_ALIAS = 'default'       #shared by all the processes (e.g. redis) in production
+AUTH_USER_CACHE_TIMEOUT = 60 * 5        #in seconds, for the users and their permission sets... saving the user/customer or changing permissions drops the entry right away
+AUTH_USER_CACHE_LOCAL_TIMEOUT = 5       #in seconds, how long a process keeps a user without asking the shared cache (how stale another process can be)
+AUTH_USER_CACHE_SIZE = 10_000       #users kept by each process
+
 SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('JWT',),
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1)
@@ -0,0 +1,203 @@
+import random
+from collections import Counter
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from store.caches import now_and_on_commit
+from .models import LikeCounter, LikedItem
+
+
+#like counts without COUNT(*) over likes_likeditem and without one hot counter row per object
+#
+#a like writes its LikedItem row and adds 1 to one of LIKES_COUNTER_SHARDS counter rows of the object, picked at random,
+#so concurrent likes of the same product mostly update different rows instead of queueing for one row lock
+#reading sums the shards (one indexed query for a whole page of objects) and caches the sum until the next like/unlike of that object
+#'manage.py compact_like_counters' folds the shards back into one row from time to time
+
+
+def get_setting(name, default):
+    return getattr(settings, f'LIKES_{name}', default)
+
+
+def get_cache():
+    return caches[get_setting('CACHE_ALIAS', 'default')]
+
+
+def cache_key(content_type_id, object_id):
+    return f'likes:count:{content_type_id}:{object_id}'
+
+
+
+
+#one statement for all the objects of a like/unlike... each row goes to a random shard and is created the first time that shard is used
+UPSERT_SQL = {
+    'mysql': 'ON DUPLICATE KEY UPDATE count = count + VALUES(count)',
+    'sqlite': 'ON CONFLICT (content_type_id, object_id, shard) DO UPDATE SET count = {table}.count + excluded.count',
+    'postgresql': 'ON CONFLICT (content_type_id, object_id, shard) DO UPDATE SET count = {table}.count + excluded.count',
+}
+
+
+def add(content_type, deltas):
+    #{object_id: +n or -n}
+    deltas = {object_id: delta for object_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    shards = get_setting('COUNTER_SHARDS', 16)
+    rows = sorted((object_id, random.randrange(shards), delta) for object_id, delta in deltas.items())    #sorted so concurrent writers lock rows in the same order
+
+    if connection.vendor in UPSERT_SQL:
+        table = connection.ops.quote_name(LikeCounter._meta.db_table)
+        placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+        params = [value for object_id, shard, delta in rows for value in (content_type.id, object_id, shard, delta)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (content_type_id, object_id, shard, count) VALUES {placeholders} '
+                + UPSERT_SQL[connection.vendor].format(table=table),
+                params)
+    else:
+        with transaction.atomic():
+            for object_id, shard, delta in rows:
+                counter, _ = LikeCounter.objects.select_for_update().get_or_create(content_type=content_type, object_id=object_id, shard=shard)
+                counter.count += delta
+                counter.save(update_fields=['count'])
+
+    now_and_on_commit(forget, content_type.id, list(deltas))      #and again after the commit, a read in between may have cached the old sum
+
+
+def forget(content_type_id, object_ids):
+    get_cache().delete_many([cache_key(content_type_id, object_id) for object_id in object_ids])
+
+
+
+
+def get_counts(content_type, object_ids):
+    #{object_id: likes} for many objects of one content type... cached sums first, one query for the rest
+    cache = get_cache()
+    keys = {cache_key(content_type.id, object_id): object_id for object_id in object_ids}
+    counts = {keys[key]: count for key, count in cache.get_many(keys).items()}
+
+    missing = [object_id for object_id in keys.values() if object_id not in counts]
+    if missing:
+        rows = LikeCounter.objects \
+            .filter(content_type=content_type, object_id__in=missing) \
+            .values('object_id') \
+            .annotate(total=Sum('count')) \
+            .order_by()
+        summed = {row['object_id']: row['total'] for row in rows}
+        fresh = {object_id: summed.get(object_id, 0) for object_id in missing}
+        cache.set_many({cache_key(content_type.id, object_id): count for object_id, count in fresh.items()}, get_setting('COUNT_CACHE_TIMEOUT', 60))
+        counts.update(fresh)
+    return counts
+
+
+
+
+#the likes that already exist hit the unique constraint of LikedItem and are skipped, RETURNING tells which rows really went in...
+#bulk_create(ignore_conflicts=True) runs the same insert but can't say which rows it skipped
+INSERT_LIKES_SQL = {
+    'sqlite': 'ON CONFLICT (user_id, content_type_id, object_id) DO NOTHING RETURNING object_id',
+    'postgresql': 'ON CONFLICT (user_id, content_type_id, object_id) DO NOTHING RETURNING object_id',
+}
+
+
+def insert_likes(user_id, content_type, object_ids):
+    #returns the object ids whose like was inserted now, a concurrent like of the same object by the same user gets only one of them
+    object_ids = sorted(set(object_ids))       #sorted so concurrent writers lock the index entries in the same order
+    if connection.vendor in INSERT_LIKES_SQL and connection.features.can_return_rows_from_bulk_insert:
+        table = connection.ops.quote_name(LikedItem._meta.db_table)
+        placeholders = ', '.join(['(%s, %s, %s)'] * len(object_ids))
+        params = [value for object_id in object_ids for value in (user_id, content_type.id, object_id)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, content_type_id, object_id) VALUES {placeholders} '
+                + INSERT_LIKES_SQL[connection.vendor],
+                params)
+            return {row[0] for row in cursor.fetchall()}
+
+    inserted = set()        #mysql has no RETURNING... get_or_create reads the row again when a concurrent like wins the insert
+    for object_id in object_ids:
+        _, created = LikedItem.objects.get_or_create(user_id=user_id, content_type=content_type, object_id=object_id)
+        if created:
+            inserted.add(object_id)
+    return inserted
+
+
+def like(user_id, content_type, object_ids):
+    #likes every object the user hasn't liked yet, returns the ids that were liked now... only the inserted likes are counted
+    with transaction.atomic():
+        inserted = insert_likes(user_id, content_type, object_ids)
+        new = [object_id for object_id in dict.fromkeys(object_ids) if object_id in inserted]
+        add(content_type, {object_id: 1 for object_id in new})
+    return new
+
+
+def unlike(user_id, content_type, object_ids):
+    #returns the ids that were unliked
+    with transaction.atomic():
+        items = LikedItem.objects.filter(user_id=user_id, content_type=content_type, object_id__in=object_ids)
+        removed = Counter(items.values_list('object_id', flat=True))
+        items.delete()
+        add(content_type, {object_id: -count for object_id, count in removed.items()})
+    return sorted(removed)
+
+
+
+
+def compact(batch_size=500):
+    #folds the shards of every object into one row (the sum doesn't change)... a like that lands on a new shard meanwhile just starts a new row
+    #returns (objects compacted, rows deleted)
+    objects = rows_deleted = 0
+    while True:
+        batch = list(
+            LikeCounter.objects
+            .values('content_type_id', 'object_id')
+            .annotate(rows=Count('id'))
+            .filter(rows__gt=1)
+            .order_by()[:batch_size])
+        if not batch:
+            break
+        for group in batch:
+            with transaction.atomic():
+                counters = list(
+                    LikeCounter.objects
+                    .select_for_update()
+                    .filter(content_type_id=group['content_type_id'], object_id=group['object_id'])
+                    .order_by('shard'))
+                if len(counters) < 2:
+                    continue
+                first, others = counters[0], counters[1:]
+                first.count = sum(counter.count for counter in counters)
+                first.save(update_fields=['count'])
+                LikeCounter.objects.filter(id__in=[counter.id for counter in others]).delete()
+                objects += 1
+                rows_deleted += len(others)
+        if len(batch) < batch_size:
+            break
+    return objects, rows_deleted
+
+
+def reconcile():
+    #sets every counter back to the number of LikedItem rows (after a bulk import or a bug)... returns the number of objects fixed
+    likes = {
+        (row['content_type_id'], row['object_id']): row['count']
+        for row in LikedItem.objects.values('content_type_id', 'object_id').annotate(count=Count('id')).order_by()
+    }
+    sums = {
+        (row['content_type_id'], row['object_id']): row['total']
+        for row in LikeCounter.objects.values('content_type_id', 'object_id').annotate(total=Sum('count')).order_by()
+    }
+
+    fixed = 0
+    for content_type_id, object_id in set(likes) | set(sums):
+        if likes.get((content_type_id, object_id), 0) == sums.get((content_type_id, object_id), 0):
+            continue
+        with transaction.atomic():
+            counters = LikeCounter.objects.select_for_update().filter(content_type_id=content_type_id, object_id=object_id)
+            list(counters)      #lock the shards, then count again inside the transaction
+            count = LikedItem.objects.filter(content_type_id=content_type_id, object_id=object_id).count()
+            counters.delete()
+            LikeCounter.objects.create(content_type_id=content_type_id, object_id=object_id, shard=0, count=count)
+        forget(content_type_id, [object_id])
+        fixed += 1
+    return fixed
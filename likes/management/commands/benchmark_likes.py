@@ -0,0 +1,98 @@
+import statistics
+import threading
+import time
+from uuid import uuid4
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from django.test.utils import override_settings
+from likes.counters import get_counts, get_setting, like
+from likes.models import LikeCounter, LikedItem
+
+
+#N users liking the same object at the same time, first with one counter row (every like waits for the same row lock)
+#and then with LIKES_COUNTER_SHARDS rows... runs against the configured database (sqlite or mysql), creates its own users and deletes them when it is done
+#
+#    python manage.py benchmark_likes --likes 2000 --threads 16
+class Command(BaseCommand):
+    help = 'Measures like throughput with many threads liking the same object, with and without sharded counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--likes', type=int, default=1000)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--shards', type=int, action='append', help='shard counts to compare (default: 1 and LIKES_COUNTER_SHARDS)')
+
+    def handle(self, *args, **options):
+        app_label, model = get_setting('MODELS', ['store.product'])[0].lower().split('.')
+        content_type = ContentType.objects.get_by_natural_key(app_label, model)
+        shard_counts = options['shards'] or [1, get_setting('COUNTER_SHARDS', 16)]
+
+        users = self.seed(options['likes'])
+        try:
+            self.stdout.write(f'{connection.vendor}: {options["likes"]} likes of one {app_label}.{model}, {options["threads"]} threads')
+            for i, shards in enumerate(shard_counts):
+                object_id = 2_000_000_000 + i        #the counters don't need the object to exist
+                with override_settings(LIKES_COUNTER_SHARDS=shards):
+                    self.run(users, content_type, object_id, options['threads'], shards)
+        finally:
+            self.cleanup(users)
+
+    def run(self, users, content_type, object_id, threads, shards):
+        queue = list(users)
+        lock = threading.Lock()
+        results = {'likes': 0, 'errors': 0, 'retries': 0, 'latencies': []}
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        break
+                    user = queue.pop()
+                started = time.perf_counter()
+                outcome, retries = self.like(user.id, content_type, object_id)
+                elapsed = time.perf_counter() - started
+                with lock:
+                    results[outcome] += 1
+                    results['retries'] += retries
+                    results['latencies'].append(elapsed)
+            connections.close_all()
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(results['latencies'])
+        count = get_counts(content_type, [object_id])[object_id]
+        rows = LikeCounter.objects.filter(content_type=content_type, object_id=object_id).count()
+        self.stdout.write(f'  {shards:>3} shard(s): {results["likes"] / elapsed:8.1f} likes/s   '
+                          f'p50 {statistics.median(latencies) * 1000:7.1f} ms   p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.1f} ms   '
+                          f'{results["retries"]} retries, {results["errors"]} failed   count {count} in {rows} rows')
+        if count != results['likes']:
+            self.stderr.write(self.style.ERROR(f'  the counter says {count}, {results["likes"]} likes were made'))
+
+    def like(self, user_id, content_type, object_id):
+        for attempt in range(20):
+            try:
+                like(user_id, content_type, [object_id])
+                return 'likes', attempt
+            except OperationalError:       #sqlite answers 'database is locked' instead of waiting for the row lock
+                time.sleep(0.005 * (attempt + 1))
+        return 'errors', 20
+
+    def seed(self, count):
+        run = uuid4().hex[:8]
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'benchmark_{run}_{i}', email=f'benchmark_{run}_{i}@example.com') for i in range(count)], batch_size=1000)
+        return list(User.objects.filter(username__startswith=f'benchmark_{run}_'))
+
+    def cleanup(self, users):
+        user_ids = [user.id for user in users]
+        LikedItem.objects.filter(user_id__in=user_ids).delete()
+        LikeCounter.objects.filter(object_id__gte=2_000_000_000).delete()
+        for start in range(0, len(user_ids), 500):
+            get_user_model().objects.filter(id__in=user_ids[start:start + 500]).delete()
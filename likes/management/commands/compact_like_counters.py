@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from likes.counters import compact, reconcile
+
+
+#the sharded like counters (likes/counters.py) grow up to LIKES_COUNTER_SHARDS rows per object... this folds them back into one row
+#run it from cron, e.g. every hour:
+#
+#    0 * * * *  python manage.py compact_like_counters
+class Command(BaseCommand):
+    help = 'Folds the shards of the like counters into one row per object'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--reconcile', action='store_true', help='also recount the likes of every object whose counter is off')
+
+    def handle(self, *args, **options):
+        objects, rows = compact(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Compacted the counters of {objects} objects ({rows} rows deleted)'))
+        if options['reconcile']:
+            fixed = reconcile()
+            self.stdout.write(self.style.SUCCESS(f'Recounted {fixed} objects'))
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def remove_duplicates(apps, schema_editor):
+    #concurrent likes could insert the same like twice before the constraint... keeps the first one and recounts those objects
+    LikedItem = apps.get_model('likes', 'LikedItem')
+    LikeCounter = apps.get_model('likes', 'LikeCounter')
+    duplicates = LikedItem.objects \
+        .values('user_id', 'content_type_id', 'object_id') \
+        .annotate(first=models.Min('id'), count=models.Count('id')) \
+        .filter(count__gt=1) \
+        .order_by()
+    objects = set()
+    for row in duplicates:
+        LikedItem.objects \
+            .filter(user_id=row['user_id'], content_type_id=row['content_type_id'], object_id=row['object_id']) \
+            .exclude(id=row['first']) \
+            .delete()
+        objects.add((row['content_type_id'], row['object_id']))
+
+    for content_type_id, object_id in objects:
+        LikeCounter.objects.filter(content_type_id=content_type_id, object_id=object_id).delete()
+        count = LikedItem.objects.filter(content_type_id=content_type_id, object_id=object_id).count()
+        LikeCounter.objects.create(content_type_id=content_type_id, object_id=object_id, shard=0, count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('likes', '0003_likecounter'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='likeditem',
+            constraint=models.UniqueConstraint(fields=('user', 'content_type', 'object_id'), name='likes_likeditem_user_object_unique'),
+        ),
+    ]
@@ -9,3 +9,25 @@ class LikedItem(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_type', 'object_id'], name='likes_likeditem_object_idx')     #the likes of an object
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'content_type', 'object_id'], name='likes_likeditem_user_object_unique')    #a user likes an object once, even with two concurrent requests
+        ]
+
+
+#the like count of an object is spread over up to LIKES_COUNTER_SHARDS rows (likes/counters.py)... every like adds 1 to a random shard,
+#so concurrent likes of a popular product don't all wait for the lock of one row... the count is the sum of the shards
+class LikeCounter(models.Model):
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    shard = models.PositiveSmallIntegerField(default=0)
+    count = models.IntegerField(default=0)      #a shard can go below 0 (an unlike picks a random shard too), the sum can't
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id', 'shard'], name='likes_likecounter_shard_unique')
+        ]
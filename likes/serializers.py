@@ -0,0 +1,30 @@
+from django.contrib.contenttypes.models import ContentType
+from rest_framework import serializers
+from .counters import get_setting
+
+
+class LikeTargetSerializer(serializers.Serializer):     #{"object_type": "store.product", "object_ids": [1, 2, 3]}
+    object_type = serializers.CharField()
+    object_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=1000)
+
+    def validate_object_type(self, value):      #returns the content type
+        allowed = [name.lower() for name in get_setting('MODELS', ['store.product'])]     #only these models can be liked
+        if value.lower() not in allowed:
+            raise serializers.ValidationError(f'{value} can not be liked')
+        app_label, model = value.lower().split('.')
+        try:
+            return ContentType.objects.get_by_natural_key(app_label, model)
+        except ContentType.DoesNotExist:
+            raise serializers.ValidationError(f'{value} can not be liked')
+
+
+class BulkLikeSerializer(LikeTargetSerializer):
+    def validate(self, data):
+        #all the objects are checked with one query
+        object_ids = set(data['object_ids'])
+        model = data['object_type'].model_class()
+        existing = set(model._default_manager.filter(pk__in=object_ids).values_list('pk', flat=True))
+        missing = sorted(object_ids - existing)
+        if missing:
+            raise serializers.ValidationError({'object_ids': f'No objects with the ids {missing} in the db'})
+        return data
@@ -1,3 +1,170 @@
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+from store.models import Collection, Product
+from . import counters
+from .counters import add, compact, get_counts, like, reconcile, unlike
+from .models import LikeCounter, LikedItem
 
 # Create your tests here.
+
+
+class LikesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()       #the sums are cached
+        collection = Collection.objects.create(title='collection')
+        self.products = [
+            Product.objects.create(title=f'product {i}', slug='product', unit_price=10, inventory=10, collection=collection)
+            for i in range(3)
+        ]
+        self.ids = [product.id for product in self.products]
+        self.content_type = ContentType.objects.get_for_model(Product)
+        self.users = [self.create_user(f'user{i}') for i in range(3)]
+
+    def create_user(self, username):
+        return get_user_model().objects.create(username=username, email=f'{username}@example.com')
+
+    def rows(self, object_id):
+        return LikeCounter.objects.filter(content_type=self.content_type, object_id=object_id).count()
+
+
+
+
+class CounterTests(LikesTestCase):
+    @override_settings(LIKES_COUNTER_SHARDS=4)
+    def test_add_spreads_over_the_shards_and_get_counts_sums_them(self):
+        for _ in range(20):
+            add(self.content_type, {self.ids[0]: 1, self.ids[1]: 2})
+        add(self.content_type, {self.ids[0]: -5, self.ids[2]: 0})
+        self.assertLessEqual(self.rows(self.ids[0]), 4)
+        self.assertGreater(self.rows(self.ids[0]), 1)
+        self.assertEqual(self.rows(self.ids[2]), 0)     #a delta of 0 writes nothing
+        self.assertEqual(get_counts(self.content_type, self.ids), {self.ids[0]: 15, self.ids[1]: 40, self.ids[2]: 0})
+
+    def test_get_counts_is_one_query_then_cached(self):
+        LikeCounter.objects.bulk_create([
+            LikeCounter(content_type=self.content_type, object_id=self.ids[0], shard=shard, count=count)
+            for shard, count in enumerate([3, -1, 2])
+        ])
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(get_counts(self.content_type, self.ids), {self.ids[0]: 4, self.ids[1]: 0, self.ids[2]: 0})
+        self.assertEqual(len(context.captured_queries), 1)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(get_counts(self.content_type, self.ids[:2]), {self.ids[0]: 4, self.ids[1]: 0})
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_the_cached_sums_are_dropped_right_away_and_after_the_commit(self):
+        self.assertEqual(get_counts(self.content_type, self.ids[:1]), {self.ids[0]: 0})
+        with self.captureOnCommitCallbacks() as callbacks:
+            add(self.content_type, {self.ids[0]: 2})
+        self.assertEqual(get_counts(self.content_type, self.ids[:1]), {self.ids[0]: 2})
+        cache.set(counters.cache_key(self.content_type.id, self.ids[0]), 0)        #a concurrent request read the sum of before the commit
+        for callback in callbacks:
+            callback()
+        self.assertEqual(get_counts(self.content_type, self.ids[:1]), {self.ids[0]: 2})
+
+    def test_compact_keeps_the_totals(self):
+        with override_settings(LIKES_COUNTER_SHARDS=8):
+            for _ in range(30):
+                add(self.content_type, {self.ids[0]: 1, self.ids[1]: -1 if _ % 3 == 0 else 1})
+        add(self.content_type, {self.ids[2]: 1})
+        before = get_counts(self.content_type, self.ids)
+        rows = LikeCounter.objects.count()
+        objects, deleted = compact(batch_size=1)
+        self.assertEqual(objects, 2)        #the third object had one row already
+        self.assertEqual(deleted, rows - 3)
+        self.assertEqual([self.rows(object_id) for object_id in self.ids], [1, 1, 1])
+        cache.clear()
+        self.assertEqual(get_counts(self.content_type, self.ids), before)
+        self.assertEqual(before, {self.ids[0]: 30, self.ids[1]: 10, self.ids[2]: 1})
+        self.assertEqual(compact(), (0, 0))
+
+
+
+
+class LikeTests(LikesTestCase):
+    def test_like_counts_only_the_new_likes(self):
+        self.assertEqual(like(self.users[0].id, self.content_type, [self.ids[1], self.ids[0], self.ids[1]]), [self.ids[1], self.ids[0]])
+        self.assertEqual(like(self.users[0].id, self.content_type, [self.ids[0], self.ids[2]]), [self.ids[2]])
+        like(self.users[1].id, self.content_type, [self.ids[0]])
+        self.assertEqual(LikedItem.objects.count(), 4)
+        cache.clear()
+        self.assertEqual(get_counts(self.content_type, self.ids), {self.ids[0]: 2, self.ids[1]: 1, self.ids[2]: 1})
+
+    def test_a_like_inserted_meanwhile_is_not_counted_twice(self):
+        #what a concurrent request sees: the row went in after the checks of this one
+        LikedItem.objects.create(user=self.users[0], content_type=self.content_type, object_id=self.ids[0])
+        self.assertEqual(like(self.users[0].id, self.content_type, self.ids[:2]), [self.ids[1]])
+        self.assertEqual(get_counts(self.content_type, self.ids[:2]), {self.ids[0]: 0, self.ids[1]: 1})
+
+    def test_the_same_like_can_not_be_stored_twice(self):
+        LikedItem.objects.create(user=self.users[0], content_type=self.content_type, object_id=self.ids[0])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LikedItem.objects.create(user=self.users[0], content_type=self.content_type, object_id=self.ids[0])
+
+    def test_without_returning(self):
+        #mysql: one get_or_create per object
+        with mock.patch.dict(counters.INSERT_LIKES_SQL, clear=True):
+            self.assertEqual(like(self.users[0].id, self.content_type, self.ids[:2]), self.ids[:2])
+            self.assertEqual(like(self.users[0].id, self.content_type, self.ids), [self.ids[2]])
+        self.assertEqual(get_counts(self.content_type, self.ids), {object_id: 1 for object_id in self.ids})
+
+    def test_unlike_and_reconcile(self):
+        like(self.users[0].id, self.content_type, self.ids)
+        like(self.users[1].id, self.content_type, self.ids[:1])
+        self.assertEqual(unlike(self.users[0].id, self.content_type, [self.ids[2], self.ids[0], self.ids[2]]), [self.ids[0], self.ids[2]])
+        self.assertEqual(unlike(self.users[0].id, self.content_type, [self.ids[2]]), [])
+        cache.clear()
+        self.assertEqual(get_counts(self.content_type, self.ids), {self.ids[0]: 1, self.ids[1]: 1, self.ids[2]: 0})
+
+        LikeCounter.objects.filter(object_id=self.ids[1]).update(count=7)       #off, e.g. after a bulk import
+        self.assertEqual(reconcile(), 1)
+        self.assertEqual(get_counts(self.content_type, self.ids[1:2]), {self.ids[1]: 1})
+
+
+
+
+class LikeApiTests(LikesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def test_like_and_unlike(self):
+        self.assertEqual(self.client.post('/likes/', {'object_type': 'store.product', 'object_ids': self.ids[:1]}, format='json').status_code, 401)
+
+        self.client.force_authenticate(self.users[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/likes/', {'object_type': 'store.product', 'object_ids': self.ids[:2]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'liked': self.ids[:2], 'counts': {self.ids[0]: 1, self.ids[1]: 1}})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/likes/', {'object_type': 'store.product', 'object_ids': self.ids[:1]}, format='json')
+        self.assertEqual(response.data, {'liked': [], 'counts': {self.ids[0]: 1}})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/likes/unlike/', {'object_type': 'store.product', 'object_ids': self.ids[:1]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'unliked': self.ids[:1], 'counts': {self.ids[0]: 0}})
+
+    def test_invalid_targets(self):
+        self.client.force_authenticate(self.users[0])
+        response = self.client.post('/likes/', {'object_type': 'store.collection', 'object_ids': [1]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('object_type', response.data)
+        response = self.client.post('/likes/', {'object_type': 'store.product', 'object_ids': [self.ids[0], self.ids[-1] + 100]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(LikedItem.objects.exists())
+
+    def test_counts(self):
+        like(self.users[0].id, self.content_type, self.ids[:2])
+        like(self.users[1].id, self.content_type, self.ids[:1])
+        response = self.client.get(f'/likes/counts/?object_type=store.product&object_ids={self.ids[0]},{self.ids[2]}')     #anyone
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {self.ids[0]: 2, self.ids[2]: 0})
+        self.assertEqual(self.client.get('/likes/counts/?object_type=store.product').status_code, 400)
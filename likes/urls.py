@@ -0,0 +1,8 @@
+from rest_framework.routers import SimpleRouter
+from . import views
+
+
+router = SimpleRouter()
+router.register('', views.LikeViewSet, basename='likes')      #likes/, likes/unlike/, likes/counts/
+
+urlpatterns = router.urls
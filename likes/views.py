@@ -1,3 +1,38 @@
-from django.shortcuts import render
+from rest_framework.decorators import action
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.viewsets import ViewSet
+from .counters import get_counts, like, unlike
+from .serializers import BulkLikeSerializer, LikeTargetSerializer
 
-# Create your views here.
+
+#likes/           POST {"object_type": "store.product", "object_ids": [1, 2]}    likes them (the ones already liked are skipped)
+#likes/unlike/    POST {"object_type": "store.product", "object_ids": [1, 2]}    unlikes them
+#likes/counts/    GET ?object_type=store.product&object_ids=1,2                   like counts (anyone)
+#every response has the current counts of the objects
+class LikeViewSet(ViewSet):
+    permission_classes = [IsAuthenticated]
+
+    def create(self, request):
+        serializer = BulkLikeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        content_type, object_ids = serializer.validated_data['object_type'], serializer.validated_data['object_ids']
+        liked = like(request.user.id, content_type, object_ids)
+        return Response({'liked': liked, 'counts': get_counts(content_type, object_ids)})
+
+    @action(detail=False, methods=['POST'])
+    def unlike(self, request):
+        serializer = LikeTargetSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        content_type, object_ids = serializer.validated_data['object_type'], serializer.validated_data['object_ids']
+        unliked = unlike(request.user.id, content_type, object_ids)
+        return Response({'unliked': unliked, 'counts': get_counts(content_type, object_ids)})
+
+    @action(detail=False, methods=['GET'], permission_classes=[AllowAny])
+    def counts(self, request):
+        serializer = LikeTargetSerializer(data={
+            'object_type': request.query_params.get('object_type', ''),
+            'object_ids': [value for value in request.query_params.get('object_ids', '').split(',') if value]
+        })
+        serializer.is_valid(raise_exception=True)
+        return Response(get_counts(serializer.validated_data['object_type'], serializer.validated_data['object_ids']))
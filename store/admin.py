@@ -1,9 +1,12 @@
 from django.contrib import admin, messages
-from django.db.models.aggregates import Count
+from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 from django.utils.html import format_html, urlencode
 from django.urls import reverse
+from django.utils import timezone
 from . import models
+from .history import rebuild_history
+from .reports import rebuild_rollups
 
 
 class InventoryFilter(admin.SimpleListFilter):
@@ -70,12 +73,7 @@ class CollectionAdmin(admin.ModelAdmin):
             + urlencode({
                 'collection__id': str(collection.id)
             }))
-        return format_html('<a href="{}">{} Products</a>', url, collection.products_count)
-
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            products_count=Count('product')    # product is instead of 'product_set'
-        )
+        return format_html('<a href="{}">{} Products</a>', url, collection.products_count)    #products_count is a column kept up to date by the product signals
 
 
 
@@ -101,7 +99,7 @@ class CustomerAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         return super().get_queryset(request).annotate(
-            orders_count=Count('order')
+            orders_count=Coalesce('history__orders_count', 0)      #from the history table (store/history.py), no GROUP BY over the orders
         )
 
 
@@ -118,3 +116,19 @@ class OrderAdmin(admin.ModelAdmin):
     autocomplete_fields = ['customer']
     inlines = [OrderItemInline]
     list_display = ['id', 'placed_at', 'customer']
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        rebuild_history([form.instance.customer_id])        #the items are saved after the order, the order handlers can't count them
+        if form.instance.payment_status == models.Order.PAYMENT_STATUS_COMPLETE:
+            day = timezone.localdate(form.instance.placed_at)
+            rebuild_rollups(day, day)
+
+
+
+@admin.register(models.OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'signal', 'created_at', 'attempts', 'delivered_at']
+    list_filter = ['signal', ('delivered_at', admin.EmptyFieldListFilter)]
+    list_per_page = 50
+    readonly_fields = ['signal', 'sender', 'payload', 'created_at', 'attempts', 'delivered_at', 'last_error']
@@ -0,0 +1,201 @@
+import math
+import re
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.urls import re_path
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from .caches import (
+    VERSION_COLLECTIONS, VERSION_PRODUCTS, VERSION_PROMOTIONS, aget_validators, collection_version, conditional_response, count_request, get_cache, get_timeout,
+    response_cache_key, response_etag, review_version, set_validators)
+from .carts import get_cart_store
+from .fast_serializers import FastCartSerializer, FastCollectionSerializer, FastProductSerializer, FastReviewSerializer
+from .models import Collection, Product, Review
+from .paginations import DefaultPagination
+from .pricing import aget_prices
+
+
+#async versions of the hot read endpoints for asgi deployments... with STORE_ASYNC_VIEWS = True store/urls.py puts them in front of the viewsets
+#they read through the async orm (aiterator, aget, acount) and the async cache api, so an anonymous GET never leaves the event loop for a thread
+#
+#they only answer what they can answer exactly like the viewset (same json, same status, same cached responses):
+#anonymous json GETs with the query params they know... everything else (writes, a token, ?search=, ?ordering=, cursor pagination,
+#the browsable api) is handed to the viewset, which runs on a thread like any sync view under asgi
+
+
+PRICE_RE = re.compile(r'^\d{1,4}(\.\d{1,2})?$')     #what the unit_price filters accept (max_digits=6, decimal_places=2), anything else goes to the viewset and its error message
+
+
+class AsyncReadView(View):
+    sync_view = None        #the viewset view (from the router) that gets every request this view doesn't handle
+    query_params = []       #the query params this view understands
+    renderer = JSONRenderer()
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or not self.can_handle(request, kwargs):
+            return await sync_to_async(self.sync_view)(request, *args, **kwargs)
+        try:
+            return await self.get(request, *args, **kwargs)
+        except APIException as error:
+            return self.render({'detail': error.detail}, error.status_code)
+
+    def can_handle(self, request, kwargs):
+        if 'HTTP_AUTHORIZATION' in request.META:        #the viewset authenticates the token (and refuses a bad one with a 401)
+            return False
+        accept = request.headers.get('Accept', '*/*')
+        if 'text/html' in accept or not ('application/json' in accept or '*/*' in accept):      #the browsable api and the 406s are the viewset's
+            return False
+        if any(name not in self.query_params or not request.GET[name] for name in request.GET):     #django-filter ignores empty params, the viewset sorts that out
+            return False
+        return self.valid(request.GET, kwargs)
+
+    def valid(self, params, kwargs):
+        return True
+
+    def render(self, data, status=200):
+        response = HttpResponse(self.renderer.render(data), content_type='application/json', status=status)
+        response['Vary'] = 'Accept'
+        response['Allow'] = ', '.join(method.upper() for method in self.sync_view.cls.http_method_names if method in self.sync_view.actions or method in ['head', 'options'])    #head comes with get
+        return response
+
+    async def respond(self, request, action, lookup, names, handler, *args, cache=False):
+        #the ETag/Last-Modified (and the 304) of ConditionalResponseMixin, and with cache=True the response cache of CachedResponseMixin (store/caches.py)...
+        #the same counters and keys, so the viewset and the async view answer each other's ETags and serve each other's cached responses
+        versions, last_modified = await aget_validators(*names)
+        basename = self.sync_view.initkwargs['basename']
+        etag = response_etag(basename, action, lookup, request.GET, versions)
+        response = conditional_response(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        if cache:
+            data = await self.cached(response_cache_key(basename, action, lookup, request.GET, versions), handler, request, *args)
+        else:
+            data = await handler(request, *args)
+        return set_validators(self.render(data), etag, last_modified)
+
+    async def cached(self, key, handler, *args):
+        cache = get_cache()
+        data = await cache.aget(key)
+        if data is not None:
+            count_request('hits')
+            return data
+
+        count_request('misses')
+        data = await handler(*args)
+        await cache.aset(key, data, get_timeout())
+        return data
+
+    async def paginate(self, request, queryset, serializer_class):
+        #the page, the links and the 404 of DefaultPagination (PageNumberPagination) with acount() and aiterator()
+        page_size = DefaultPagination.page_size
+        count = await queryset.acount()
+        pages = max(1, math.ceil(count / page_size))
+        number = int(request.GET.get(DefaultPagination.page_query_param, 1))
+        if number < 1 or number > pages:
+            message = 'That page number is less than 1' if number < 1 else 'That page contains no results'
+            raise NotFound(DefaultPagination.invalid_page_message.format(page_number=number, message=message))
+
+        offset = (number - 1) * page_size
+        rows = [row async for row in queryset[offset:offset + page_size].aiterator()]
+        context = {'prices': await aget_prices([(row['id'], row['unit_price']) for row in rows])}      #priced here, the serializer would price them with sync queries
+        url = request.build_absolute_uri()
+        if number == 1:
+            previous = None
+        elif number == 2:
+            previous = remove_query_param(url, DefaultPagination.page_query_param)
+        else:
+            previous = replace_query_param(url, DefaultPagination.page_query_param, number - 1)
+        return {
+            'count': count,
+            'next': replace_query_param(url, DefaultPagination.page_query_param, number + 1) if number < pages else None,
+            'previous': previous,
+            'results': serializer_class(rows, many=True, context=context).data
+        }
+
+
+
+
+class ProductListView(AsyncReadView):        #ProductViewSet.list without search, ordering and cursor pagination
+    query_params = ['page', 'collection_id', 'unit_price__gt', 'unit_price__lt']
+
+    def valid(self, params, kwargs):
+        return params.get('page', '1').isdigit() and params.get('collection_id', '0').isdigit() \
+            and all(PRICE_RE.match(params[name]) for name in ['unit_price__gt', 'unit_price__lt'] if name in params)
+
+    async def get(self, request):
+        collection_id = request.GET.get('collection_id')
+        versions = [collection_version(int(collection_id)), VERSION_PROMOTIONS] if collection_id else [VERSION_PRODUCTS, VERSION_PROMOTIONS]
+        return await self.respond(request, 'list', '', versions, self.list, cache=True)
+
+    async def list(self, request):
+        queryset = Product.objects.values(*FastProductSerializer.values_fields())
+        filters = {name: request.GET[name] for name in self.query_params[1:] if name in request.GET}
+        return await self.paginate(request, queryset.filter(**filters), FastProductSerializer)
+
+
+class ProductDetailView(AsyncReadView):      #ProductViewSet.retrieve
+    def valid(self, params, kwargs):
+        return kwargs['pk'].isdigit()
+
+    async def get(self, request, pk):
+        return await self.respond(request, 'retrieve', pk, [VERSION_PRODUCTS, VERSION_PROMOTIONS], self.retrieve, pk, cache=True)
+
+    async def retrieve(self, request, pk):
+        try:
+            row = await Product.objects.values(*FastProductSerializer.values_fields()).aget(pk=pk)
+        except Product.DoesNotExist:
+            raise NotFound('No Product matches the given query.')
+        return FastProductSerializer(row, context={'prices': await aget_prices([(row['id'], row['unit_price'])])}).data
+
+
+class CollectionListView(AsyncReadView):     #CollectionViewSet.list
+    async def get(self, request):
+        return await self.respond(request, 'list', '', [VERSION_COLLECTIONS], self.list)
+
+    async def list(self, request):
+        rows = [row async for row in Collection.objects.values(*FastCollectionSerializer.values_fields()).aiterator()]
+        return FastCollectionSerializer(rows, many=True).data
+
+
+class ReviewListView(AsyncReadView):     #ReviewViewSet.list without ordering and cursor pagination
+    def valid(self, params, kwargs):
+        return kwargs['product_pk'].isdigit()
+
+    async def get(self, request, product_pk):
+        return await self.respond(request, 'list', '', [review_version(product_pk)], self.list, product_pk)
+
+    async def list(self, request, product_pk):
+        rows = [row async for row in Review.objects.filter(product_id=product_pk).values(*FastReviewSerializer.values_fields()).aiterator()]
+        return FastReviewSerializer(rows, many=True).data
+
+
+class CartDetailView(AsyncReadView):     #CartViewSet.retrieve
+    async def get(self, request, pk):
+        cart = await get_cart_store().aget_cart(pk)
+        if cart is None:
+            raise NotFound()
+        prices = await aget_prices([(item['product__id'], item['product__unit_price']) for item in cart['items']])
+        return self.render(FastCartSerializer(cart, context={'prices': prices}).data)
+
+
+
+
+ASYNC_VIEWS = {     #url name of the viewset route -> the async view in front of it
+    'products-list': ProductListView,
+    'products-detail': ProductDetailView,
+    'collection-list': CollectionListView,
+    'product-reviews-list': ReviewListView,
+    'cart-detail': CartDetailView,
+}
+
+
+def get_urlpatterns(sync_urlpatterns):
+    #the same regex as the router's route, with its view as the fallback... csrf_exempt b/c the viewsets are (DRF checks csrf itself for session auth)
+    return [
+        re_path(pattern.pattern.regex.pattern, csrf_exempt(ASYNC_VIEWS[pattern.name].as_view(sync_view=pattern.callback)))
+        for pattern in sync_urlpatterns if pattern.name in ASYNC_VIEWS
+    ]
@@ -0,0 +1,250 @@
+import hashlib
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.response import Response
+
+
+#read-through response cache for the catalog endpoints
+#every cached response is keyed by the version counters it depends on, so a write never has to find and delete cached pages... it just bumps a counter and the old keys are never read again (they expire on their own)
+
+
+VERSION_PRODUCTS = 'products'        #bumped on any product write (unfiltered lists and detail views depend on it)
+VERSION_PROMOTIONS = 'promotions'    #bumped on any promotion write
+VERSION_COLLECTIONS = 'collections'      #bumped on any collection write and when a product is added, moved or deleted (products_count)
+
+
+def get_cache():
+    return caches[getattr(settings, 'STORE_RESPONSE_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'STORE_RESPONSE_CACHE_TIMEOUT', 60 * 15)
+
+
+def collection_version(collection_id):
+    return f'collection:{collection_id}'
+
+
+def review_version(product_id):
+    return f'reviews:{product_id}'
+
+
+def _version_key(name):
+    return f'store:version:{name}'
+
+
+def _modified_key(name):       #when the counter was bumped last (ms), for Last-Modified
+    return f'store:modified:{name}'
+
+
+def get_versions(*names):
+    cache = get_cache()
+    keys = {_version_key(name): name for name in names}
+    found = cache.get_many(keys.keys())     #one round trip for all the counters a response depends on
+
+    versions = {}
+    for key, name in keys.items():
+        if key not in found:
+            #a missing counter (never set or evicted) starts from the clock so it can never repeat a value an old cached response was stored under
+            cache.add(key, int(time.time() * 1000), None)
+            found[key] = cache.get(key)
+        versions[name] = found[key]
+    return versions
+
+
+def get_validators(*names):
+    #the versions of get_versions and the last time any of them was bumped (in seconds), in one round trip... a missing time counts as now
+    cache = get_cache()
+    version_keys = {_version_key(name): name for name in names}
+    modified_keys = [_modified_key(name) for name in names]
+    found = cache.get_many([*version_keys, *modified_keys])
+
+    for key in [*version_keys, *modified_keys]:
+        if key not in found:
+            cache.add(key, int(time.time() * 1000), None)
+            found[key] = cache.get(key)
+    return {name: found[key] for key, name in version_keys.items()}, max(found[key] for key in modified_keys) // 1000
+
+
+async def aget_validators(*names):       #get_validators for the async views
+    cache = get_cache()
+    version_keys = {_version_key(name): name for name in names}
+    modified_keys = [_modified_key(name) for name in names]
+    found = await cache.aget_many([*version_keys, *modified_keys])
+
+    for key in [*version_keys, *modified_keys]:
+        if key not in found:
+            await cache.aadd(key, int(time.time() * 1000), None)
+            found[key] = await cache.aget(key)
+    return {name: found[key] for key, name in version_keys.items()}, max(found[key] for key in modified_keys) // 1000
+
+
+def bump_version(*names):
+    cache = get_cache()
+    for name in names:
+        key = _version_key(name)
+        try:
+            cache.incr(key)
+        except ValueError:      #the counter is not in the cache yet
+            cache.add(key, int(time.time() * 1000), None)
+    cache.set_many({_modified_key(name): int(time.time() * 1000) for name in names}, None)
+
+
+def now_and_on_commit(invalidate, *args):
+    #for the writes of a transaction: invalidates right away and again after the commit, so a request that read the old rows
+    #between the two (before the commit) can't leave them in the cache under the new version
+    invalidate(*args)
+    transaction.on_commit(lambda: invalidate(*args))
+
+
+
+
+#hit/miss counters are kept per process so reading them never touches the cache backend
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def count_request(name):      #'hits' or 'misses'
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / total if total else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats['hits'] = 0
+        _stats['misses'] = 0
+
+
+
+
+def normalize_query_string(query_params):
+    #?page=2&search=x and ?search=x&page=2 are the same request... empty values are dropped b/c the filters ignore them too
+    items = []
+    for key in sorted(query_params.keys()):
+        for value in sorted(query_params.getlist(key)):
+            if value != '':
+                items.append(f'{key}={value}')
+    return '&'.join(items)
+
+
+
+
+def response_cache_key(basename, action, lookup, query_params, versions):
+    #shared by CachedResponseMixin and the async views, so both serve each other's cached responses
+    versions = ':'.join(f'{name}={value}' for name, value in sorted(versions.items()))
+    query = hashlib.md5(normalize_query_string(query_params).encode()).hexdigest()
+    return f'store:response:{basename}:{action}:{lookup}:{query}:{versions}'
+
+
+
+
+def response_etag(basename, action, lookup, query_params, versions):      #a new etag whenever the cache key of the response changes
+    return quote_etag(hashlib.md5(response_cache_key(basename, action, lookup, query_params, versions).encode()).hexdigest())
+
+
+def conditional_response(request, etag, last_modified):
+    #a 304 when the client's If-None-Match or If-Modified-Since still matches (django's rules, If-None-Match wins), None otherwise
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+
+
+class VersionedResponseMixin:
+    #the version counters a 'list'/'retrieve' response depends on... read once per request and shared by the two mixins below
+    def get_cache_versions(self):        #override this to narrow down what a response depends on
+        return [VERSION_PRODUCTS, VERSION_PROMOTIONS]
+
+    def get_response_versions(self):
+        if getattr(self, 'response_versions', None) is None:
+            self.response_versions = get_versions(*self.get_cache_versions())
+        return self.response_versions
+
+    def get_response_lookup(self):
+        return self.kwargs.get(self.lookup_field, '')
+
+
+class CachedResponseMixin(VersionedResponseMixin):
+    #caches the serialized data of 'list' and 'retrieve' for viewsets whose output doesn't depend on the user
+    cache_actions = ['list', 'retrieve']
+
+    def get_cache_key(self, request):
+        return response_cache_key(self.basename, self.action, self.get_response_lookup(), request.query_params, self.get_response_versions())
+
+    def list(self, request, *args, **kwargs):
+        return self._cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached(super().retrieve, request, *args, **kwargs)
+
+    def _cached(self, handler, request, *args, **kwargs):
+        if self.action not in self.cache_actions or request.method != 'GET':
+            return handler(request, *args, **kwargs)
+
+        cache = get_cache()
+        key = self.get_cache_key(request)
+        data = cache.get(key)
+        if data is not None:
+            count_request('hits')
+            return Response(data)
+
+        count_request('misses')
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(key, response.data, get_timeout())
+        return response
+
+
+
+
+class ConditionalResponseMixin(VersionedResponseMixin):
+    #ETag and Last-Modified on the json 'list' and 'retrieve' responses, made from the same version counters as the response cache:
+    #a client that sends them back (If-None-Match / If-Modified-Since) gets a 304 before any query runs or anything is serialized
+    #goes before CachedResponseMixin in the bases, so a 304 doesn't even read the cached response
+    conditional_actions = ['list', 'retrieve']
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(super().retrieve, request, *args, **kwargs)
+
+    def is_conditional(self, request):      #override this for the requests whose response isn't covered by the version counters
+        return self.action in self.conditional_actions and request.accepted_renderer.format == 'json'     #the browsable api page shows the user, it is never 304'd
+
+    def _conditional(self, handler, request, *args, **kwargs):
+        if not self.is_conditional(request):
+            return handler(request, *args, **kwargs)
+
+        self.response_versions, last_modified = get_validators(*self.get_cache_versions())
+        etag = response_etag(self.basename, self.action, self.get_response_lookup(), request.query_params, self.response_versions)
+        response = conditional_response(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            set_validators(response, etag, last_modified)
+        return response
@@ -0,0 +1,512 @@
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import Cart, CartItem, Product
+
+
+#where the anonymous carts live... CartViewSet, CartItemViewSet and the checkout only talk to get_cart_store()
+#STORE_CART_BACKEND = 'database' keeps them in the Cart/CartItem tables
+#STORE_CART_BACKEND = 'cache' keeps them in a cache (redis in production, STORE_CART_CACHE_ALIAS) with a TTL, and writes them to the tables only when they are checked out
+#
+#both stores return plain dicts that the fast serializers take as rows:
+#    cart: {'id': uuid, 'items': [item, ...]}
+#    item: {'id': 1, 'product_id': 1, 'quantity': 2, 'product__id': 1, 'product__title': '...', 'product__unit_price': Decimal(...)}
+
+
+class CartNotFound(Exception):
+    pass
+
+
+class QuantityTooLarge(Exception):
+    def __init__(self, product_ids):
+        super().__init__(f'The quantity of a cart item can not be more than {MAX_QUANTITY}')
+        self.product_ids = product_ids
+
+
+PRODUCT_FIELDS = ['id', 'title', 'unit_price']      #what FastSimpleProductSerializer shows of the product of an item
+MAX_QUANTITY = 32767        #CartItem.quantity is a PositiveSmallIntegerField
+
+
+def parse_cart_id(value):
+    #cart ids come from the url... anything that isn't a uuid is just a cart that doesn't exist
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def parse_item_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_items(items):
+    #[(product_id, quantity), ...] with every product once... postgres refuses to update the same row twice in one statement
+    quantities = defaultdict(int)
+    for product_id, quantity in items:
+        quantities[product_id] += quantity
+    return sorted(quantities.items())      #the same order every time, so concurrent upserts lock the rows in the same order
+
+
+def check_quantities(items, current):
+    #items are added to the current quantities ({product_id: quantity})... the sums have to fit in CartItem.quantity
+    too_large = [product_id for product_id, quantity in items if current.get(product_id, 0) + quantity > MAX_QUANTITY]
+    if too_large:
+        raise QuantityTooLarge(too_large)
+
+
+
+
+class BaseCartStore:
+    def create_cart(self):
+        raise NotImplementedError
+
+    def get_cart(self, cart_id):        #None when there is no such cart
+        raise NotImplementedError
+
+    async def aget_cart(self, cart_id):     #get_cart for the async views (store/async_views.py)
+        return await sync_to_async(self.get_cart)(cart_id)
+
+    def exists(self, cart_id):
+        raise NotImplementedError
+
+    def delete_cart(self, cart_id):     #False when there was no such cart
+        raise NotImplementedError
+
+    def get_items(self, cart_id):
+        raise NotImplementedError
+
+    def get_item(self, cart_id, item_id):
+        raise NotImplementedError
+
+    def add_items(self, cart_id, items):    #[(product_id, quantity), ...] added to what is already in the cart... raises CartNotFound or QuantityTooLarge (nothing is added)
+        raise NotImplementedError
+
+    def add_item(self, cart_id, product_id, quantity):
+        self.add_items(cart_id, [(product_id, quantity)])
+        return next((item for item in self.get_items(cart_id) if item['product_id'] == product_id), None)
+
+    def update_item(self, cart_id, item_id, quantity):     #None when there is no such item
+        raise NotImplementedError
+
+    def remove_item(self, cart_id, item_id):
+        raise NotImplementedError
+
+    def persist(self, cart_id):
+        #called by the checkout inside its transaction, the cart has to be in the Cart/CartItem tables when it returns... raises CartNotFound
+        #when the cart is gone or another checkout of it is running
+        pass
+
+    def forget(self, cart_id):
+        #called after the checkout committed (the checkout already deleted the Cart row)
+        pass
+
+    def release(self, cart_id):
+        #called when the checkout failed (rolled back), the cart can be checked out again
+        pass
+
+
+
+
+#adding products to a cart with one 'INSERT ... ON CONFLICT/ON DUPLICATE KEY UPDATE' statement (whatever the number of items)
+#an item that is already in the cart gets its quantity increased by the database itself, so two concurrent adds of the same product
+#can't both try to insert the row (unique_together on cart/product) or overwrite each other's quantity
+UPSERT_SQL = {
+    'mysql': 'ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity)',
+    'sqlite': 'ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {table}.quantity + excluded.quantity',
+    'postgresql': 'ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {table}.quantity + excluded.quantity',
+}
+
+
+def upsert(cart_id, items):
+    table = connection.ops.quote_name(CartItem._meta.db_table)
+    cart_id = CartItem._meta.get_field('cart').get_db_prep_value(cart_id, connection)   #the uuid in the format this database stores it
+    placeholders = ', '.join(['(%s, %s, %s)'] * len(items))
+    params = [value for product_id, quantity in items for value in (cart_id, product_id, quantity)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (cart_id, product_id, quantity) VALUES {placeholders} '
+            + UPSERT_SQL[connection.vendor].format(table=table),
+            params)
+
+
+def add_items_one_by_one(cart_id, items):
+    #other databases... lock the existing rows, update them and create the missing ones
+    with transaction.atomic():
+        existing = {
+            item.product_id: item
+            for item in CartItem.objects.select_for_update().filter(cart_id=cart_id, product_id__in=[product_id for product_id, _ in items])
+        }
+        for product_id, quantity in items:
+            if product_id in existing:
+                existing[product_id].quantity += quantity
+                existing[product_id].save(update_fields=['quantity'])
+            else:
+                CartItem.objects.create(cart_id=cart_id, product_id=product_id, quantity=quantity)
+
+
+
+
+class DatabaseCartStore(BaseCartStore):
+    item_fields = ['id', 'product_id', 'quantity'] + [f'product__{field}' for field in PRODUCT_FIELDS]
+
+    def item_rows(self, cart_id):
+        return CartItem.objects.filter(cart_id=cart_id).order_by('id').values(*self.item_fields)
+
+    def create_cart(self):
+        return {'id': Cart.objects.create().id, 'items': []}
+
+    def get_cart(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None or not self.exists(cart_id):
+            return None
+        return {'id': cart_id, 'items': list(self.item_rows(cart_id))}
+
+    async def aget_cart(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None or not await Cart.objects.filter(id=cart_id).aexists():
+            return None
+        return {'id': cart_id, 'items': [row async for row in self.item_rows(cart_id)]}
+
+    def exists(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        return cart_id is not None and Cart.objects.filter(id=cart_id).exists()
+
+    def delete_cart(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        return cart_id is not None and Cart.objects.filter(id=cart_id).delete()[0] > 0
+
+    def get_items(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        return [] if cart_id is None else list(self.item_rows(cart_id))
+
+    def get_item(self, cart_id, item_id):
+        cart_id, item_id = parse_cart_id(cart_id), parse_item_id(item_id)
+        if cart_id is None or item_id is None:
+            return None
+        return self.item_rows(cart_id).filter(id=item_id).first()
+
+    def add_items(self, cart_id, items):
+        cart_id = parse_cart_id(cart_id)
+        items = merge_items(items)
+        if cart_id is None:
+            raise CartNotFound()
+        if not items:
+            return
+        with transaction.atomic():
+            #the cart row is locked (a concurrent delete waits)... the foreign key alone isn't enough, sqlite and postgres only check it at the commit
+            if not Cart.objects.select_for_update().filter(id=cart_id).exists():
+                raise CartNotFound()
+            #the adds to this cart wait for the lock, so the quantities can't change between this check and the upsert
+            check_quantities(items, dict(CartItem.objects.filter(cart_id=cart_id, product_id__in=[product_id for product_id, _ in items]).values_list('product_id', 'quantity')))
+            if connection.vendor in UPSERT_SQL:
+                upsert(cart_id, items)
+            else:
+                add_items_one_by_one(cart_id, items)
+
+    def add_item(self, cart_id, product_id, quantity):
+        self.add_items(cart_id, [(product_id, quantity)])
+        return self.item_rows(cart_id).get(product_id=product_id)
+
+    def update_item(self, cart_id, item_id, quantity):
+        cart_id, item_id = parse_cart_id(cart_id), parse_item_id(item_id)
+        if cart_id is None or item_id is None:
+            return None
+        if not CartItem.objects.filter(cart_id=cart_id, id=item_id).update(quantity=quantity):
+            return None
+        return self.get_item(cart_id, item_id)
+
+    def remove_item(self, cart_id, item_id):
+        cart_id, item_id = parse_cart_id(cart_id), parse_item_id(item_id)
+        if cart_id is None or item_id is None:
+            return False
+        return CartItem.objects.filter(cart_id=cart_id, id=item_id).delete()[0] > 0
+
+    def persist(self, cart_id):
+        #the cart row stays locked until the checkout commits, a second checkout of the same cart waits and then finds it deleted
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None or not Cart.objects.select_for_update().filter(id=cart_id).exists():
+            raise CartNotFound()
+
+
+
+
+#the cart is one cache entry: {'next_id': 3, 'items': [[item_id, product_id, quantity], ...]}
+#the entry expires STORE_CART_TTL seconds after the last change, so abandoned carts clean themselves up
+#changes take a short per cart lock (cache.add is atomic on every backend, SET NX on redis) so two requests can't overwrite each other's items
+#the product title/price are read from the database when the cart is shown, so they are never stale
+#
+#a cart that isn't in the cache is looked up in the tables (DatabaseCartStore): the carts created before switching to this store
+#keep working until they are checked out or purged (purge_abandoned_carts)
+class CacheCartStore(BaseCartStore):
+    lock_timeout = 5        #seconds... a lock left behind by a crashed process expires on its own
+    lock_wait = 0.005
+    checkout_timeout = 60       #seconds, same for the mark of a checkout that crashed
+
+    def __init__(self, alias=None, ttl=None):
+        self.cache = caches[alias or getattr(settings, 'STORE_CART_CACHE_ALIAS', 'default')]
+        self.ttl = ttl or getattr(settings, 'STORE_CART_TTL', 60 * 60 * 24 * 7)
+        self.database = DatabaseCartStore()
+
+    def key(self, cart_id):
+        return f'store:cart:{cart_id}'
+
+    def load(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        return None if cart_id is None else self.cache.get(self.key(cart_id))
+
+    def save(self, cart_id, data):
+        self.cache.set(self.key(cart_id), data, self.ttl)
+
+    def locked(self, cart_id):
+        return CartLock(self.cache, f'{self.key(cart_id)}:lock', self.lock_timeout, self.lock_wait)
+
+    def change(self, cart_id, function):
+        #runs function(data) under the cart lock and saves the data when it returns something true
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            return None
+        with self.locked(cart_id):
+            data = self.cache.get(self.key(cart_id))
+            if data is None:
+                return None
+            result = function(data)
+            if result:
+                self.save(cart_id, data)
+            return result
+
+    def products(self, items):
+        return Product.objects.filter(id__in=[product_id for _, product_id, _ in items]).values(*PRODUCT_FIELDS)
+
+    def rows(self, items, products=None):
+        #one query for the products of all the items... items whose product was deleted are dropped (the database cascades them too)
+        products = {product['id']: product for product in (self.products(items) if products is None else products)}
+        return [
+            {
+                'id': item_id,
+                'product_id': product_id,
+                'quantity': quantity,
+                **{f'product__{field}': products[product_id][field] for field in PRODUCT_FIELDS}
+            }
+            for item_id, product_id, quantity in sorted(items) if product_id in products
+        ]
+
+    def create_cart(self):
+        cart_id = uuid.uuid4()
+        self.save(cart_id, {'next_id': 1, 'items': []})
+        return {'id': cart_id, 'items': []}
+
+    def get_cart(self, cart_id):
+        data = self.load(cart_id)
+        if data is None:
+            return self.database.get_cart(cart_id)
+        return {'id': parse_cart_id(cart_id), 'items': self.rows(data['items'])}
+
+    async def aget_cart(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        data = None if cart_id is None else await self.cache.aget(self.key(cart_id))
+        if data is None:
+            return await self.database.aget_cart(cart_id)
+        products = [product async for product in self.products(data['items'])]
+        return {'id': cart_id, 'items': self.rows(data['items'], products)}
+
+    def exists(self, cart_id):
+        return self.load(cart_id) is not None or self.database.exists(cart_id)
+
+    def delete_cart(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        return cart_id is not None and (self.cache.delete(self.key(cart_id)) or self.database.delete_cart(cart_id))
+
+    def get_items(self, cart_id):
+        data = self.load(cart_id)
+        return self.rows(data['items']) if data else self.database.get_items(cart_id)
+
+    def get_item(self, cart_id, item_id):
+        item_id = parse_item_id(item_id)
+        data = self.load(cart_id)
+        if data is None:
+            return self.database.get_item(cart_id, item_id)
+        if item_id is None:
+            return None
+        return next(iter(self.rows([item for item in data['items'] if item[0] == item_id])), None)
+
+    def add_items(self, cart_id, items):
+        items = merge_items(items)
+
+        def add(data):
+            current = {item[1]: item for item in data['items']}
+            check_quantities(items, {product_id: item[2] for product_id, item in current.items()})
+            for product_id, quantity in items:
+                if product_id in current:
+                    current[product_id][2] += quantity
+                else:
+                    data['items'].append([data['next_id'], product_id, quantity])
+                    data['next_id'] += 1
+            return True
+
+        if self.change(cart_id, add) is None:
+            self.database.add_items(cart_id, items)     #raises CartNotFound when it isn't there either
+
+    def update_item(self, cart_id, item_id, quantity):
+        item_id = parse_item_id(item_id)
+
+        def update(data):
+            for item in data['items']:
+                if item[0] == item_id:
+                    item[2] = quantity
+                    return True
+            return False
+
+        updated = self.change(cart_id, update)
+        if updated is None:
+            return self.database.update_item(cart_id, item_id, quantity)
+        return self.get_item(cart_id, item_id) if updated else None
+
+    def remove_item(self, cart_id, item_id):
+        item_id = parse_item_id(item_id)
+
+        def remove(data):
+            remaining = [item for item in data['items'] if item[0] != item_id]
+            removed = len(remaining) < len(data['items'])
+            data['items'] = remaining
+            return removed
+
+        removed = self.change(cart_id, remove)
+        if removed is None:
+            return self.database.remove_item(cart_id, item_id)
+        return bool(removed)
+
+    def persist(self, cart_id):
+        #write-behind... the cart only reaches the database when it becomes an order
+        #the cart is marked under its lock, so a second checkout of it (a double click) fails here instead of on the Cart primary key
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is None:
+            raise CartNotFound()
+
+        with self.locked(cart_id):
+            data = self.cache.get(self.key(cart_id))
+            if data is None:
+                return self.database.persist(cart_id)       #a cart of the tables, nothing to write
+            if time.time() - data.get('checkout', 0) < self.checkout_timeout:
+                raise CartNotFound('The cart is already being checked out')
+            data['checkout'] = time.time()
+            self.save(cart_id, data)
+
+        Cart.objects.create(id=cart_id)
+        product_ids = set(Product.objects.filter(id__in=[product_id for _, product_id, _ in data['items']]).values_list('id', flat=True))
+        CartItem.objects.bulk_create([
+            CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+            for _, product_id, quantity in sorted(data['items']) if product_id in product_ids
+        ])
+
+    def forget(self, cart_id):
+        cart_id = parse_cart_id(cart_id)
+        if cart_id is not None:
+            self.cache.delete(self.key(cart_id))
+
+    def release(self, cart_id):
+        def unclaim(data):
+            return data.pop('checkout', None)
+        self.change(cart_id, unclaim)
+
+
+
+
+class CartLock:
+    def __init__(self, cache, key, timeout, wait):
+        self.cache = cache
+        self.key = key
+        self.timeout = timeout
+        self.wait = wait
+        self.token = uuid.uuid4().hex
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while not self.cache.add(self.key, self.token, self.timeout):
+            if time.monotonic() > deadline:     #the holder is gone (its lock is about to expire anyway)
+                self.cache.set(self.key, self.token, self.timeout)
+                break
+            time.sleep(self.wait)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.cache.get(self.key) == self.token:      #don't release a lock that expired and was taken by someone else
+            self.cache.delete(self.key)
+
+
+
+
+#carts that were never checked out stay in the tables forever... this deletes the ones created more than STORE_CART_MAX_AGE_DAYS ago
+#in small batches ('DELETE ... WHERE id IN (...)', each batch in its own short transaction) with a pause in between,
+#so the row locks are held briefly and the replicas keep up
+#nothing is remembered between runs: every committed batch is gone for good, so an interrupted purge just starts again from the oldest cart left
+#(carts kept in the cache store expire with their TTL and never get here)
+#
+#called by 'manage.py purge_abandoned_carts' (cron) and can be called from any other scheduler the same way
+def purge_abandoned_carts(days=None, batch_size=1000, pause=0.1, max_batches=None, progress=None):
+    days = days if days is not None else getattr(settings, 'STORE_CART_MAX_AGE_DAYS', 30)
+    cutoff = timezone.now() - timedelta(days=days)
+    stats = {'batches': 0, 'carts': 0, 'items': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+    since = None        #created_at of the last batch... the next one starts there instead of rescanning the deleted range
+
+    while max_batches is None or stats['batches'] < max_batches:
+        carts = Cart.objects.filter(created_at__lt=cutoff)
+        if since is not None:
+            carts = carts.filter(created_at__gte=since)
+        rows = list(carts.order_by('created_at').values_list('id', 'created_at')[:batch_size])
+        if not rows:
+            break
+
+        with transaction.atomic():
+            _, deleted = Cart.objects.filter(id__in=[cart_id for cart_id, _ in rows]).delete()    #the items go in the same transaction (on_delete=CASCADE)
+        since = rows[-1][1]
+        stats['batches'] += 1
+        stats['carts'] += deleted.get(Cart._meta.label, 0)
+        stats['items'] += deleted.get(CartItem._meta.label, 0)
+        stats['seconds'] = time.perf_counter() - started
+        if progress is not None:
+            progress(stats)
+
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+
+
+CART_STORES = {
+    'database': DatabaseCartStore,
+    'cache': CacheCartStore
+}
+
+_cart_store = None
+_cart_store_lock = threading.Lock()
+
+
+def get_cart_store():
+    global _cart_store
+    with _cart_store_lock:
+        if _cart_store is None:
+            _cart_store = CART_STORES[getattr(settings, 'STORE_CART_BACKEND', 'database')]()
+        return _cart_store
+
+
+def reset_cart_store():
+    global _cart_store
+    with _cart_store_lock:
+        _cart_store = None
@@ -0,0 +1,89 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, When
+from .caches import VERSION_PRODUCTS, bump_version, collection_version
+from .carts import CartNotFound, get_cart_store
+from .models import Cart, CartItem, Customer, Order, OrderItem, Product
+from .outbox import enqueue
+from .pricing import get_prices
+
+
+#turns a cart into an order in one transaction with a fixed number of queries (whatever the number of items):
+#lock the products, check the inventory, decrement it with one UPDATE, price them, create the order and its items, delete the cart
+
+
+class InsufficientInventory(Exception):
+    def __init__(self, shortages):
+        super().__init__('Not enough inventory for one or more products')
+        self.shortages = shortages     #[{'product_id': 1, 'requested': 5, 'available': 2}, ...]
+
+
+def place_order(cart_id, user_id, sender=None, customer_id=None):      #customer_id when the caller knows it already (request.user of CachedJWTAuthentication)
+    cart_store = get_cart_store()
+    try:
+        return checkout(cart_store, cart_id, user_id, sender, customer_id)
+    except CartNotFound:        #the cart is gone or another checkout has it, nothing to release
+        raise
+    except Exception:
+        cart_store.release(cart_id)     #rolled back, the cart can be checked out again
+        raise
+
+
+def checkout(cart_store, cart_id, user_id, sender, customer_id):
+    with transaction.atomic():
+        cart_store.persist(cart_id)     #a cart kept in the cache is written to the Cart/CartItem tables now, in the same transaction (store/carts.py)
+        if customer_id is None:
+            customer_id = Customer.objects.values_list('id', flat=True).get(user_id=user_id)
+        items = list(CartItem.objects.filter(cart_id=cart_id).values_list('product_id', 'quantity'))
+        products = lock_products([product_id for product_id, _ in items])
+
+        reserve_inventory(items, products)
+        prices = get_prices([(product_id, product['unit_price']) for product_id, product in products.items()])      #with the promotions, like the cart showed them (store/pricing.py)
+
+        order = Order.objects.create(customer_id=customer_id)
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product_id=product_id,
+                quantity=quantity,
+                unit_price=prices[product_id].price
+            ) for product_id, quantity in items
+        ])
+        Cart.objects.filter(id=cart_id).delete()
+        transaction.on_commit(lambda: cart_store.forget(cart_id))
+
+        #the inventory was changed with queryset.update (no product signals) so the cached catalog pages are invalidated here
+        collection_ids = {product['collection_id'] for product in products.values()}
+        transaction.on_commit(lambda: bump_version(VERSION_PRODUCTS, *[collection_version(collection_id) for collection_id in collection_ids]))
+
+        enqueue('store.signals.order_created', sender, order=order)     #the receivers run after the commit on the outbox dispatcher (store/outbox.py), not on the request thread
+        return order
+
+
+def lock_products(product_ids):
+    #one 'SELECT ... FOR UPDATE' ordered by id... every checkout takes the row locks in the same order, so two checkouts can't deadlock on each other
+    rows = Product.objects \
+        .select_for_update() \
+        .filter(id__in=product_ids) \
+        .order_by('id') \
+        .values('id', 'unit_price', 'inventory', 'collection_id')
+    return {row['id']: row for row in rows}
+
+
+def reserve_inventory(items, products):
+    shortages = [
+        {
+            'product_id': product_id,
+            'requested': quantity,
+            'available': products[product_id]['inventory'] if product_id in products else 0
+        }
+        for product_id, quantity in items
+        if product_id not in products or products[product_id]['inventory'] < quantity
+    ]
+    if shortages:
+        raise InsufficientInventory(shortages)
+
+    if items:       #UPDATE store_product SET inventory = CASE WHEN id = 1 THEN inventory - 2 WHEN ... END WHERE id IN (...)
+        Product.objects.filter(id__in=[product_id for product_id, _ in items]).update(inventory=Case(
+            *[When(id=product_id, then=F('inventory') - quantity) for product_id, quantity in items],
+            output_field=IntegerField()
+        ))
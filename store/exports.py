@@ -0,0 +1,129 @@
+import csv
+from decimal import Decimal
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import BasePermission
+from rest_framework.utils.encoders import JSONEncoder
+
+
+#streaming exports for the list endpoints:  GET /store/products/export/?output=csv  or  /store/orders/export/?output=ndjson
+#the same filters, search and ordering as the list apply, but there are no pages... the rows are read with .iterator(chunk_size)
+#so only one chunk is in memory at a time (a server side cursor on postgres, chunked fetches elsewhere) and prefetch_related runs once per chunk
+#the response is written out while it is being read, so memory stays the same for 100 rows or 10 million
+
+
+OUTPUTS = {
+    'ndjson': 'application/x-ndjson',       #one json object per line, the same object the list endpoint returns
+    'csv': 'text/csv',
+}
+
+
+def get_chunk_size():
+    return getattr(settings, 'STORE_EXPORT_CHUNK_SIZE', 2000)
+
+
+class ExportPermission(BasePermission):      #staff, or reporting users that were given the 'view' permission of the model
+    def has_permission(self, request, view):
+        user = request.user
+        if not (user and user.is_authenticated):
+            return False
+        opts = view.get_queryset().model._meta
+        return user.is_staff or user.has_perm(f'{opts.app_label}.view_{opts.model_name}')
+
+
+
+
+def prepared(objects, serializer, size):
+    #the objects of the iterator, handed to serializer.prepare a chunk at a time (the prices of a chunk of products in one go)
+    context = serializer.context
+    chunk = []
+    for obj in objects:
+        chunk.append(obj)
+        if len(chunk) == size:
+            yield from prepared_chunk(chunk, serializer, context)
+            chunk = []
+    yield from prepared_chunk(chunk, serializer, context)
+
+
+def prepared_chunk(chunk, serializer, context):
+    #a fresh copy of the context for every chunk... what prepare() keeps there (the prices) goes away with its chunk instead of piling up for the whole export
+    serializer.context, serializer.nested = dict(context), {}
+    serializer.prepare(chunk)
+    yield from chunk
+
+
+
+
+class Echo:     #csv.writer writes into this and gets the line back instead of writing it anywhere
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(objects, serializer):
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))       #like JSONRenderer (decimals, dates, uuids)
+    for obj in objects:
+        yield encoder.encode(serializer.to_representation(obj)) + '\n'
+
+
+def csv_value(value):      #the number the json shows, not the full precision of a computed decimal (price_with_tax)
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def csv_lines(objects, serializer, header, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for obj in objects:
+        for row in rows(serializer.to_representation(obj)):
+            yield writer.writerow([csv_value(value) for value in row])
+
+
+def buffered(lines, size=64 * 1024):
+    #a few big chunks instead of one tiny write per row
+    buffer = []
+    length = 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+
+
+class ExportMixin:
+    #adds the 'export' action to a viewset... the viewset sets export_serializer_class (a fast serializer, store/fast_serializers.py)
+    #and can override get_export_header/get_export_rows when one object is more than one csv row
+    export_serializer_class = None
+    export_name = None      #file name without the extension, the basename by default
+
+    @action(detail=False, methods=['GET'], permission_classes=[ExportPermission], pagination_class=None)
+    def export(self, request):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in OUTPUTS:
+            raise ValidationError({'output': f'Pick one of {", ".join(OUTPUTS)}'})
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if not queryset.ordered:
+            queryset = queryset.order_by('pk')      #the same order on every export
+        serializer = self.export_serializer_class(context={'request': request})
+        objects = prepared(queryset.iterator(chunk_size=get_chunk_size()), serializer, get_chunk_size())
+        if output == 'csv':
+            lines = csv_lines(objects, serializer, self.get_export_header(), self.get_export_rows)
+        else:
+            lines = ndjson_lines(objects, serializer)
+
+        response = StreamingHttpResponse(buffered(lines), content_type=OUTPUTS[output])
+        response['Content-Disposition'] = f'attachment; filename="{self.export_name or self.basename}.{output}"'
+        return response
+
+    def get_export_header(self):
+        return [name for name, _, _ in self.export_serializer_class.fields]
+
+    def get_export_rows(self, data):        #csv rows of one serialized object
+        return [list(data.values())]
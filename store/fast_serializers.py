@@ -0,0 +1,251 @@
+import decimal
+from operator import attrgetter, itemgetter
+from rest_framework.fields import DateTimeField
+from rest_framework.settings import api_settings
+from rest_framework.utils.serializer_helpers import ReturnDict, ReturnList
+from .pricing import price_products
+
+
+#read-only serializers for the hot GET endpoints... they give exactly the same json as ProductSerializer, CartSerializer...
+#but the fields are compiled into plain getter/converter pairs once per class instead of going through the DRF field machinery for every object
+#they take model instances or '.values()' rows (nested objects as 'product__title' keys)
+
+
+def to_int(value):
+    return int(value)
+
+
+def to_str(value):
+    return str(value)
+
+
+def to_nullable_str(value):
+    return None if value is None else str(value)
+
+
+def to_iso(value):      #dates, like DateField with the default iso-8601 format
+    return None if value is None else value.isoformat()
+
+
+DATETIME_FIELD = DateTimeField()
+
+
+def to_datetime(value):     #like DateTimeField: in the current time zone, iso-8601 with 'Z' for utc
+    return None if value is None else DATETIME_FIELD.to_representation(value)
+
+
+def to_decimal(max_digits, decimal_places):
+    #same as rest_framework.fields.DecimalField.to_representation
+    exponent = decimal.Decimal('.1') ** decimal_places
+    context = decimal.getcontext().copy()
+    context.prec = max_digits
+    coerce_to_string = api_settings.COERCE_DECIMAL_TO_STRING
+
+    def convert(value):
+        if value is None:
+            return '' if coerce_to_string else None
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        quantized = value.quantize(exponent, context=context)
+        return f'{quantized:f}' if coerce_to_string else quantized
+    return convert
+
+
+class Nested:
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+
+
+class Method:       #like SerializerMethodField... the method gets the fields declared before it (already converted)
+    def __init__(self, method_name):
+        self.method_name = method_name
+
+
+
+
+class FastSerializer:
+    fields = []     #(name, source, converter) in output order... converter is a function, Nested(...) or Method(...)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile()
+
+    @classmethod
+    def compile(cls):
+        cls._instance_fields = []
+        cls._row_fields = []
+        for name, source, converter in cls.fields:
+            if isinstance(converter, Method):
+                cls._instance_fields.append((name, None, ('method', converter.method_name)))
+                cls._row_fields.append((name, None, ('method', converter.method_name)))
+            elif isinstance(converter, Nested):
+                nested = converter.serializer_class
+                prefix = f'{source}__'
+                keys = [(f'{prefix}{nested_source}', nested_source) for nested_source in nested.values_fields()]
+                cls._instance_fields.append((name, attrgetter(source), ('nested', nested)))
+                cls._row_fields.append((name, lambda row, keys=keys: {nested_key: row[key] for key, nested_key in keys}, ('nested', nested)))
+            else:
+                cls._instance_fields.append((name, attrgetter(source), converter))
+                cls._row_fields.append((name, itemgetter(source), converter))
+
+    @classmethod
+    def values_fields(cls):
+        #what to pass to queryset.values() to serialize from rows
+        names = []
+        for _, source, converter in cls.fields:
+            if isinstance(converter, Nested):
+                names += [f'{source}__{nested_source}' for nested_source in converter.serializer_class.values_fields()]
+            elif source is not None:
+                names.append(source)
+        return names
+
+    def __init__(self, instance=None, many=False, context=None, **kwargs):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+        self.nested = {}
+
+    def prepare(self, objects):
+        #called with all the objects (or a chunk of them) before they are serialized, for what is fetched in bulk (the prices)
+        pass
+
+    def get_nested(self, serializer_class):     #one nested serializer per parent, not one per object
+        if serializer_class not in self.nested:
+            self.nested[serializer_class] = serializer_class(context=self.context)
+        return self.nested[serializer_class]
+
+    def to_representation(self, obj):
+        compiled = self._row_fields if isinstance(obj, dict) else self._instance_fields
+        data = {}
+        for name, getter, converter in compiled:
+            if isinstance(converter, tuple):
+                kind, target = converter
+                if kind == 'method':
+                    data[name] = getattr(self, target)(data)
+                else:
+                    value = getter(obj)
+                    data[name] = None if value is None else self.get_nested(target).to_representation(value)
+            else:
+                data[name] = converter(getter(obj))
+        return data
+
+    @property
+    def data(self):
+        if self.many:
+            objects = list(self.instance)
+            self.prepare(objects)
+            return ReturnList([self.to_representation(obj) for obj in objects], serializer=self)
+        self.prepare([self.instance])
+        return ReturnDict(self.to_representation(self.instance), serializer=self)
+
+
+
+
+class FastProductSerializer(FastSerializer):    #ProductSerializer
+    fields = [
+        ('id', 'id', to_int),
+        ('title', 'title', to_str),
+        ('slug', 'slug', to_str),
+        ('description', 'description', to_nullable_str),
+        ('inventory', 'inventory', to_int),
+        ('unit_price', 'unit_price', to_decimal(6, 2)),
+        ('price', None, Method('get_price')),
+        ('price_with_tax', None, Method('calculate_tax')),
+        ('collection', 'collection_id', to_int),
+    ]
+
+    def prepare(self, products):        #the whole page priced at once (store/pricing.py)
+        price_products(self.context, [(product['id'], product['unit_price']) if isinstance(product, dict) else (product.id, product.unit_price) for product in products])
+
+    def get_price(self, data):
+        return price_products(self.context, [(data['id'], decimal.Decimal(str(data['unit_price'])))])[data['id']].price
+
+    def calculate_tax(self, data):
+        return self.context['prices'][data['id']].price_with_tax
+
+
+class FastCollectionSerializer(FastSerializer):     #CollectionSerializer
+    fields = [
+        ('id', 'id', to_int),
+        ('title', 'title', to_str),
+        ('products_count', 'products_count', to_int),
+    ]
+
+
+class FastReviewSerializer(FastSerializer):     #ReviewSerializer
+    fields = [
+        ('id', 'id', to_int),
+        ('name', 'name', to_str),
+        ('description', 'description', to_str),
+        ('date', 'date', to_iso),
+    ]
+
+
+class FastSimpleProductSerializer(FastSerializer):    #SimpleProductSerializer
+    fields = [
+        ('id', 'id', to_int),
+        ('title', 'title', to_str),
+        ('unit_price', 'unit_price', to_decimal(6, 2)),
+    ]
+
+
+class FastCartItemSerializer(FastSerializer):     #CartItemSerializer
+    fields = [
+        ('id', 'id', to_int),
+        ('product', 'product', Nested(FastSimpleProductSerializer)),
+        ('quantity', 'quantity', to_int),
+        ('price', None, Method('get_price')),
+        ('total_price', None, Method('get_total_price')),
+    ]
+
+    def prepare(self, items):       #the products of all the items priced at once (store/pricing.py)
+        price_products(self.context, [
+            (item['product__id'], item['product__unit_price']) if isinstance(item, dict) else (item.product.id, item.product.unit_price)
+            for item in items
+        ])
+
+    def get_price(self, data):
+        product = data['product']
+        return price_products(self.context, [(product['id'], decimal.Decimal(str(product['unit_price'])))])[product['id']].price
+
+    def get_total_price(self, data):
+        return data['quantity'] * data['price']
+
+
+class FastCartSerializer(FastSerializer):     #CartSerializer... the items are serialized once and the cart total is summed in the same pass
+    fields = [
+        ('id', 'id', to_str),
+    ]
+
+    def to_representation(self, cart):
+        items = cart['items'] if isinstance(cart, dict) else list(cart.items.all())
+        item_serializer = self.get_nested(FastCartItemSerializer)
+        item_serializer.prepare(items)
+        items = [item_serializer.to_representation(item) for item in items]
+        data = super().to_representation(cart)
+        data['items'] = items
+        data['total_price'] = sum([item['total_price'] for item in items])
+        return data
+
+
+class FastOrderItemSerializer(FastSerializer):     #OrderItemSerializer
+    fields = [
+        ('id', 'id', to_int),
+        ('product', 'product', Nested(FastSimpleProductSerializer)),
+        ('quantity', 'quantity', to_int),
+        ('unit_price', 'unit_price', to_decimal(6, 2)),
+    ]
+
+
+class FastOrderSerializer(FastSerializer):      #OrderSerializer... takes orders with their items prefetched (instances only)
+    fields = [
+        ('id', 'id', to_int),
+        ('customer', 'customer_id', to_int),
+        ('placed_at', 'placed_at', to_datetime),
+        ('payment_status', 'payment_status', to_str),
+    ]
+
+    def to_representation(self, order):
+        data = super().to_representation(order)
+        data['items'] = [self.get_nested(FastOrderItemSerializer).to_representation(item) for item in order.items.all()]
+        return data
@@ -0,0 +1,115 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, Max, Q, Sum, Value, When
+from .models import Customer, CustomerHistory, CustomerProductHistory, Order, OrderItem
+
+
+#the customers' order history (CustomerHistory, CustomerProductHistory) is updated by a few queries when something happens to an order,
+#never recomputed from all of a customer's orders... the order handlers (store/signals/handlers.py) call these in the transaction of the save:
+#
+#    an order is placed                                    record_order        orders_count, last_order_at
+#    its payment becomes complete                          record_payment      paid_orders_count, lifetime_spend, the products bought
+#    a complete order stops being one, deleted or moved    rebuild_history     the customers are recomputed from their orders (rare)
+#
+#the updates are relative (orders_count + 1), so concurrent orders of the same customer can't overwrite each other
+#changes that skip Order.save (queryset.update, bulk_create, raw sql) aren't seen, 'manage.py rebuild_customer_history' recomputes everything
+
+
+def get_top_products_count():
+    return getattr(settings, 'STORE_HISTORY_TOP_PRODUCTS', 5)
+
+
+def get_chunk_size():
+    return getattr(settings, 'STORE_HISTORY_CHUNK_SIZE', 500)
+
+
+def update_history(customer_id, **values):
+    #an UPDATE of the customer's row, the row is inserted first the first time (ignore_conflicts: a concurrent order may insert it too)
+    if not CustomerHistory.objects.filter(customer_id=customer_id).update(**values):
+        CustomerHistory.objects.bulk_create([CustomerHistory(customer_id=customer_id)], ignore_conflicts=True)
+        CustomerHistory.objects.filter(customer_id=customer_id).update(**values)
+
+
+def record_order(customer_id, placed_at):
+    update_history(
+        customer_id,
+        orders_count=F('orders_count') + 1,
+        last_order_at=Case(When(last_order_at__gte=placed_at, then=F('last_order_at')), default=Value(placed_at)))
+
+
+def record_payment(order_id, customer_id):
+    products = {}       #product_id -> [quantity, spend]
+    for product_id, quantity, unit_price in OrderItem.objects.filter(order_id=order_id).values_list('product_id', 'quantity', 'unit_price'):
+        bought = products.setdefault(product_id, [0, 0])
+        bought[0] += quantity
+        bought[1] += quantity * unit_price
+    spend = sum(bought[1] for bought in products.values())
+    update_history(customer_id, paid_orders_count=F('paid_orders_count') + 1, lifetime_spend=F('lifetime_spend') + spend)
+    if not products:
+        return
+
+    CustomerProductHistory.objects.bulk_create(
+        [CustomerProductHistory(customer_id=customer_id, product_id=product_id) for product_id in products], ignore_conflicts=True)
+    #UPDATE store_customerproducthistory SET quantity = CASE WHEN product_id = 1 THEN quantity + 2 WHEN ... END, spend = CASE ... END WHERE ...
+    CustomerProductHistory.objects.filter(customer_id=customer_id, product_id__in=products).update(
+        quantity=Case(*[When(product_id=product_id, then=F('quantity') + bought[0]) for product_id, bought in products.items()]),
+        spend=Case(*[When(product_id=product_id, then=F('spend') + bought[1]) for product_id, bought in products.items()], output_field=DecimalField()))
+
+
+def rebuild_history(customer_ids):
+    #recomputes the history of the given customers from their orders, in one transaction... 6 queries whatever the number of customers
+    customer_ids = list(customer_ids)
+    orders = Order.objects \
+        .filter(customer_id__in=customer_ids) \
+        .order_by() \
+        .values('customer_id') \
+        .annotate(
+            orders_count=Count('id'),
+            paid_orders_count=Count('id', filter=Q(payment_status=Order.PAYMENT_STATUS_COMPLETE)),
+            last_order_at=Max('placed_at'))
+    bought = OrderItem.objects \
+        .filter(order__customer_id__in=customer_ids, order__payment_status=Order.PAYMENT_STATUS_COMPLETE) \
+        .order_by() \
+        .values('order__customer_id', 'product_id') \
+        .annotate(total_quantity=Sum('quantity'), total_spend=Sum(F('quantity') * F('unit_price'), output_field=DecimalField(max_digits=12, decimal_places=2)))
+
+    with transaction.atomic():
+        histories = {row['customer_id']: CustomerHistory(**row) for row in orders}
+        products = []
+        for row in bought:
+            histories[row['order__customer_id']].lifetime_spend += row['total_spend']
+            products.append(CustomerProductHistory(customer_id=row['order__customer_id'], product_id=row['product_id'], quantity=row['total_quantity'], spend=row['total_spend']))
+
+        CustomerHistory.objects.filter(customer_id__in=customer_ids).delete()
+        CustomerProductHistory.objects.filter(customer_id__in=customer_ids).delete()
+        CustomerHistory.objects.bulk_create(histories.values())
+        CustomerProductHistory.objects.bulk_create(products)
+    return len(histories)
+
+
+def rebuild_all_history(chunk_size=None, progress=None):
+    #every customer, chunk_size customers (and their orders) per transaction, walking the customers by id
+    chunk_size = chunk_size or get_chunk_size()
+    stats = {'chunks': 0, 'customers': 0, 'histories': 0}
+    last_id = 0
+    while True:
+        customer_ids = list(Customer.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not customer_ids:
+            return stats
+        stats['histories'] += rebuild_history(customer_ids)
+        stats['chunks'] += 1
+        stats['customers'] += len(customer_ids)
+        last_id = customer_ids[-1]
+        if progress is not None:
+            progress(stats)
+
+
+def get_history(customer_id):
+    #the history of a customer (an empty one when it never ordered) with its top products in .top_products, 2 queries
+    history = CustomerHistory.objects.filter(customer_id=customer_id).first() or CustomerHistory(customer_id=customer_id)
+    history.top_products = list(
+        CustomerProductHistory.objects
+        .filter(customer_id=customer_id)
+        .select_related('product')
+        .order_by('-quantity', 'product_id')[:get_top_products_count()])
+    return history
@@ -0,0 +1,166 @@
+import codecs
+import csv
+import json
+import time
+from django.conf import settings
+from django.db import transaction
+from django.utils.text import slugify
+from rest_framework.exceptions import ValidationError
+from .caches import VERSION_COLLECTIONS, VERSION_PRODUCTS, VERSION_PROMOTIONS, bump_version, collection_version
+from .models import Collection, Product, Promotion
+from .search import get_search_index
+from .serializers import ProductImportSerializer
+
+
+#bulk import of the supplier feed, one product per csv row or ndjson line... the rows are matched to the products by sku:
+#new skus are inserted and known ones updated by a single 'INSERT ... ON CONFLICT / ON DUPLICATE KEY UPDATE' per batch (bulk_create(update_conflicts=True))
+#
+#    sku,title,slug,description,unit_price,inventory,collection,promotions
+#    AB-100,Rye bread,rye-bread,,2.50,120,3,1;4
+#
+#bulk_create skips save() and the product signals (store/signals/handlers.py), so every batch does their work itself, once for the whole batch:
+#the products_count of the collections it touched, the search index, the promotion links and the response cache versions
+#a batch is one transaction, a row that doesn't validate is reported and skipped... used by 'manage.py import_products' and products/import/ (admin only)
+
+
+INPUTS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+UPDATE_FIELDS = ['title', 'slug', 'description', 'unit_price', 'inventory', 'collection', 'last_update']     #everything but the sku
+
+
+def get_batch_size():
+    return getattr(settings, 'STORE_IMPORT_BATCH_SIZE', 1000)
+
+
+def read_rows(stream, input_format):
+    #the rows of a binary file (open(path, 'rb'), an upload, the request body) as dicts, read a line at a time
+    lines = codecs.getreader('utf-8-sig')(stream)
+    if input_format == 'csv':
+        for row in csv.DictReader(lines):
+            if row.get('promotions') is not None:
+                row['promotions'] = row['promotions'].replace(';', ' ').split()     #'1;4' (or '1 4'), an empty cell removes the promotions
+            yield row
+        return
+
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line      #the serializer reports it ('Expected a dictionary')
+
+
+
+
+def import_products(rows, batch_size=None, progress=None, max_errors=100):
+    batch_size = batch_size or get_batch_size()
+    stats = {'batches': 0, 'rows': 0, 'created': 0, 'updated': 0, 'invalid': 0, 'seconds': 0.0, 'errors': []}    #'errors' keeps the first max_errors invalid rows
+    started = time.perf_counter()
+    serializer = ProductImportSerializer()      #one serializer validates every row, building one per row (and deep copying its fields) costs more than the inserts
+    batch = []
+
+    def error(number, errors):
+        stats['invalid'] += 1
+        if len(stats['errors']) < max_errors:
+            stats['errors'].append({'row': number, 'errors': errors})
+
+    def flush():
+        import_batch(batch, stats, error)
+        batch.clear()
+        stats['batches'] += 1
+        stats['seconds'] = time.perf_counter() - started
+        if progress is not None:
+            progress(stats)
+
+    for number, row in enumerate(rows, start=1):        #the number of the row in the feed, the csv header not counted
+        stats['rows'] += 1
+        try:
+            batch.append((number, serializer.run_validation(row)))
+        except ValidationError as invalid:
+            error(number, invalid.detail)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def import_batch(batch, stats, error):
+    #the collections and the promotions of the whole batch are checked with one query each
+    collection_ids = set(Collection.objects.filter(pk__in={data['collection'] for _, data in batch}).values_list('pk', flat=True))
+    promotion_ids = {promotion_id for _, data in batch for promotion_id in data.get('promotions', [])}
+    if promotion_ids:
+        promotion_ids = set(Promotion.objects.filter(pk__in=promotion_ids).values_list('pk', flat=True))
+
+    rows = {}
+    for number, data in batch:
+        missing = sorted(set(data.get('promotions', [])) - promotion_ids)
+        if data['collection'] not in collection_ids:
+            error(number, {'collection': [f'No collection with the id {data["collection"]} in the db']})
+        elif missing:
+            error(number, {'promotions': [f'No promotions with the ids {missing} in the db']})
+        else:
+            rows[data['sku']] = data        #the last row wins when a sku is in the batch twice
+    if not rows:
+        return
+
+    with transaction.atomic():
+        existing = {sku: (product_id, collection_id) for sku, product_id, collection_id in Product.objects.filter(sku__in=rows).values_list('sku', 'id', 'collection_id')}
+        products = [
+            Product(
+                sku=sku, title=data['title'], slug=data.get('slug') or slugify(data['title']), description=data.get('description'),
+                unit_price=data['unit_price'], inventory=data['inventory'], collection_id=data['collection'])
+            for sku, data in rows.items()
+        ]
+        Product.objects.bulk_create(products, update_conflicts=True, unique_fields=['sku'], update_fields=UPDATE_FIELDS)
+
+        new = [product.sku for product in products if product.pk is None and product.sku not in existing]
+        ids = dict(Product.objects.filter(sku__in=new).values_list('sku', 'id')) if new else {}     #mysql doesn't return the ids of the inserted rows
+        for product in products:
+            if product.pk is None:
+                product.pk = existing[product.sku][0] if product.sku in existing else ids[product.sku]
+
+        promotions_changed = set_promotions([(product.pk, rows[product.sku]['promotions']) for product in products if 'promotions' in rows[product.sku]])
+
+        collections = set()      #every collection with a product of the batch, before or after
+        counted = set()         #the ones that got a new product or lost one to another collection
+        for product in products:
+            old_collection_id = existing[product.sku][1] if product.sku in existing else None
+            collections |= {product.collection_id, old_collection_id}
+            if old_collection_id != product.collection_id:
+                counted |= {product.collection_id, old_collection_id}
+        if counted - {None}:
+            Collection.objects.rebuild_products_count(counted - {None})
+        get_search_index().update_many(products)
+
+    bump_version(VERSION_PRODUCTS, *[collection_version(collection_id) for collection_id in collections - {None}])
+    if counted - {None}:
+        bump_version(VERSION_COLLECTIONS)
+    if promotions_changed:
+        bump_version(VERSION_PROMOTIONS)
+    stats['created'] += len(products) - len(existing)
+    stats['updated'] += len(existing)
+
+
+def set_promotions(links):
+    #[(product_id, [promotion_id, ...]), ...]... only the links that changed are deleted and inserted, returns whether any did
+    Link = Product.promotions.through
+    wanted = {(product_id, promotion_id) for product_id, promotion_ids in links for promotion_id in promotion_ids}
+    current = {
+        (product_id, promotion_id): link_id
+        for link_id, product_id, promotion_id in Link.objects.filter(product_id__in=[product_id for product_id, _ in links]).values_list('id', 'product_id', 'promotion_id')
+    } if links else {}
+
+    removed = [link_id for link, link_id in current.items() if link not in wanted]
+    added = [Link(product_id=product_id, promotion_id=promotion_id) for product_id, promotion_id in wanted if (product_id, promotion_id) not in current]
+    if removed:
+        Link.objects.filter(pk__in=removed).delete()
+    if added:
+        Link.objects.bulk_create(added)
+    return bool(removed or added)
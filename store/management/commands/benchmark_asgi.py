@@ -0,0 +1,165 @@
+import asyncio
+import importlib
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import connection
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.test.client import FakePayload
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.urls import clear_url_caches
+from .benchmark_endpoints import Command as BenchmarkCommand
+
+
+MODES = ['wsgi', 'asgi-sync', 'asgi-async']
+
+
+#load test of the anonymous read endpoints with many concurrent clients, all in process (no server, no sockets):
+#  wsgi        the sync viewsets through the wsgi handler on a pool of --wsgi-threads threads (like gunicorn with threads)
+#  asgi-sync   the sync viewsets through the asgi handler, every request hops to a thread (STORE_ASYNC_VIEWS = False)
+#  asgi-async  the async views of store/async_views.py through the asgi handler (STORE_ASYNC_VIEWS = True)
+#the latency of a request counts from the moment its client sends it, so the time spent waiting for a free thread is part of it
+#
+#    python manage.py benchmark_asgi --settings=coredjango.benchmark_settings
+#    python manage.py benchmark_asgi --settings=coredjango.benchmark_settings --clients 500 --requests 4 --mode asgi-async
+class Command(BenchmarkCommand):
+    help = 'Compares throughput and tail latency of the read endpoints under wsgi, asgi with the sync viewsets and asgi with the async views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10_000)
+        parser.add_argument('--order-items', type=int, default=10_000)
+        parser.add_argument('--customers', type=int, default=100)
+        parser.add_argument('--clients', type=int, default=500, help='concurrent clients')
+        parser.add_argument('--requests', type=int, default=4, help='requests per client and endpoint')
+        parser.add_argument('--wsgi-threads', type=int, default=32)
+        parser.add_argument('--mode', action='append', choices=MODES, help='only run these modes (default: all)')
+        parser.add_argument('--endpoint', action='append', help='only run these endpoints (by name)')
+        parser.add_argument('--cached', action='store_true', help='keep the response cache (by default every request reads the database)')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)     #never the real database
+        try:
+            fixtures = self.seed(options['products'], options['order_items'], options['customers'])
+            endpoints = [
+                (name, url) for name, user, url in self.get_endpoints(fixtures)
+                if user is None and name in ['products-list', 'products-list-deep-page', 'product-detail', 'product-reviews-list', 'collections-list', 'cart-detail']
+                and (not options['endpoint'] or name in options['endpoint'])
+            ]
+            self.stdout.write(f'{options["clients"]} clients x {options["requests"]} requests per endpoint ({connection.vendor}, response cache {"on" if options["cached"] else "off"})')
+
+            with override_settings(**({} if options['cached'] else {'STORE_RESPONSE_CACHE_TIMEOUT': 0})):      #0 never keeps a response, the version counters stay cached
+                for name, url in endpoints:
+                    self.stdout.write(f'  {name}  {url}')
+                    for mode in options['mode'] or MODES:
+                        result = self.run_mode(mode, url, options)
+                        self.print_mode(mode, result)
+        finally:
+            self.use_async_views(False)
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def use_async_views(self, enabled):
+        #store/urls.py reads STORE_ASYNC_VIEWS when it is imported, so the url modules are reloaded
+        settings.STORE_ASYNC_VIEWS = enabled
+        importlib.reload(importlib.import_module('store.urls'))
+        importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
+
+    def run_mode(self, mode, url, options):
+        self.use_async_views(mode == 'asgi-async')
+        path, _, query = url.partition('?')
+        if mode == 'wsgi':
+            handler = WSGIHandler()
+            pool = ThreadPoolExecutor(options['wsgi_threads'])
+
+            async def send():
+                return await asyncio.get_running_loop().run_in_executor(pool, wsgi_get, handler, path, query)
+            try:
+                return asyncio.run(self.load(send, options['clients'], options['requests']))
+            finally:
+                pool.shutdown()
+
+        handler = ASGIHandler()
+        return asyncio.run(self.load(lambda: asgi_get(handler, path, query), options['clients'], options['requests']))
+
+    async def load(self, send, clients, requests):
+        latencies = []
+        errors = 0
+
+        async def run_client():
+            nonlocal errors
+            for _ in range(requests):
+                started = time.perf_counter()
+                status = await send()
+                latencies.append(time.perf_counter() - started)
+                if status != 200:
+                    errors += 1
+
+        await send()        #warm up (middleware, url resolver, connections)
+        started = time.perf_counter()
+        await asyncio.gather(*[run_client() for _ in range(clients)])
+        elapsed = time.perf_counter() - started
+        if errors:
+            raise CommandError(f'{errors} requests failed')
+
+        latencies.sort()
+        return {
+            'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        }
+
+    def print_mode(self, mode, result):
+        self.stdout.write(
+            f'    {mode:<11} {result["requests_per_second"]:>8.0f} req/s  p50 {result["p50_ms"]:>8.1f} ms  '
+            f'p95 {result["p95_ms"]:>8.1f} ms  p99 {result["p99_ms"]:>8.1f} ms')
+
+
+
+
+#the real wsgi/asgi handlers, called the way a server calls them... the test clients skip parts of it
+#(the AsyncClient runs the sync code of every request on one shared thread instead of one thread per request like ASGIHandler)
+
+def wsgi_get(handler, path, query):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': 'testserver', 'HTTP_ACCEPT': 'application/json',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': FakePayload(b''), 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+    status = []
+    response = handler(environ, lambda line, headers: status.append(int(line.split()[0])))
+    b''.join(response)
+    response.close()        #sends request_finished, like the server does
+    return status[0]
+
+
+async def asgi_get(handler, path, query):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'accept', b'application/json')],
+        'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+    }
+    received = asyncio.Event()
+    status = []
+
+    async def receive():
+        if not received.is_set():
+            received.set()
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await asyncio.Future()      #the client never disconnects, the handler stops listening when the response is sent
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await handler(scope, receive, send)
+    return status[0]
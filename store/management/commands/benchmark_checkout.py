@@ -0,0 +1,113 @@
+import threading
+import time
+from uuid import uuid4
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from store.checkout import InsufficientInventory, place_order
+from store.models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product
+
+
+#N carts checked out in parallel, all of them buying the same few 'hot' products
+#the command creates its own products, users and carts and deletes everything it created when it is done
+class Command(BaseCommand):
+    help = 'Measures checkout throughput with parallel carts contending on the same products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--carts', type=int, default=200)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--products', type=int, default=5, help='number of hot products every cart buys')
+        parser.add_argument('--inventory', type=int, default=None, help='inventory of each product (default: enough for 3/4 of the carts)')
+
+    def handle(self, *args, **options):
+        carts, threads, hot = options['carts'], options['threads'], options['products']
+        inventory = options['inventory'] if options['inventory'] is not None else carts * 3 // 4
+
+        collection, products, users, cart_ids = self.seed(carts, hot, inventory)
+        try:
+            queue = list(zip(cart_ids, users))
+            lock = threading.Lock()
+            results = {'orders': 0, 'shortages': 0, 'errors': 0, 'latencies': []}
+
+            def worker():
+                while True:
+                    with lock:
+                        if not queue:
+                            break
+                        cart_id, user = queue.pop()
+                    started = time.perf_counter()
+                    outcome = self.checkout(cart_id, user.id)
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        results[outcome] += 1
+                        results['latencies'].append(elapsed)
+                connections.close_all()
+
+            started = time.perf_counter()
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            self.report(results, elapsed, carts, threads, hot, inventory, products)
+        finally:
+            self.cleanup(collection, users, cart_ids)
+
+    def checkout(self, cart_id, user_id):
+        for attempt in range(10):
+            try:
+                place_order(cart_id, user_id)
+                return 'orders'
+            except InsufficientInventory:
+                return 'shortages'
+            except OperationalError:       #sqlite has a single writer and answers 'database is locked' instead of waiting for the row lock
+                time.sleep(0.01 * (attempt + 1))
+        return 'errors'
+
+    def seed(self, carts, hot, inventory):
+        run = uuid4().hex[:8]
+        collection = Collection.objects.create(title=f'benchmark {run}')
+        products = [
+            Product.objects.create(title=f'benchmark {run} {i}', slug='benchmark', unit_price=10, inventory=inventory, collection=collection)
+            for i in range(hot)
+        ]
+        User = get_user_model()
+        users = [User.objects.create(username=f'benchmark_{run}_{i}', email=f'benchmark_{run}_{i}@example.com') for i in range(carts)]    #the post_save handler creates their customers
+        cart_ids = [Cart.objects.create().id for _ in range(carts)]
+        CartItem.objects.bulk_create([
+            CartItem(cart_id=cart_id, product=product, quantity=1)
+            for cart_id in cart_ids for product in products
+        ])
+        return collection, products, users, cart_ids
+
+    def report(self, results, elapsed, carts, threads, hot, inventory, products):
+        latencies = sorted(results['latencies'])
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+        remaining = sorted(Product.objects.filter(id__in=[p.id for p in products]).values_list('inventory', flat=True))
+        self.stdout.write(f'{connection.vendor}: {carts} carts x {hot} hot products, {threads} threads, inventory {inventory} each')
+        self.stdout.write(f'  orders placed   {results["orders"]}')
+        self.stdout.write(f'  out of stock    {results["shortages"]}')
+        self.stdout.write(f'  failed          {results["errors"]}')
+        self.stdout.write(f'  throughput      {carts / elapsed:.1f} checkouts/s ({elapsed:.2f}s)')
+        self.stdout.write(f'  latency         p50 {percentile(0.50):.1f} ms   p95 {percentile(0.95):.1f} ms')
+        self.stdout.write(f'  inventory left  {remaining}')
+
+        oversold = any(quantity < 0 for quantity in remaining) or results['orders'] > inventory
+        if oversold:
+            self.stderr.write(self.style.ERROR('Inventory was oversold'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No inventory was oversold'))
+
+    def cleanup(self, collection, users, cart_ids):
+        customers = Customer.objects.filter(user__in=users)
+        OrderItem.objects.filter(order__customer__in=customers).delete()
+        Order.objects.filter(customer__in=customers).delete()
+        Cart.objects.filter(id__in=cart_ids).delete()      #the carts that ran out of stock
+        Product.objects.filter(collection=collection).delete()
+        collection.delete()
+        get_user_model().objects.filter(id__in=[user.id for user in users]).delete()
@@ -0,0 +1,213 @@
+import json
+import random
+import statistics
+import time
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.utils import timezone
+from rest_framework.test import APIClient
+from store.history import rebuild_all_history
+from store.models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product, Review
+from store.reports import rebuild_all_rollups
+from store.search import get_search_index
+
+
+DEFAULT_BUDGETS = Path(__file__).resolve().parent.parent.parent / 'benchmark_budgets.json'
+
+
+#seeds a throwaway test database with a realistic catalog and order history, calls every store endpoint and
+#records its query count, p50/p95 latency and peak allocated memory... fails when one of them is over the budget file
+#
+#    python manage.py benchmark_endpoints --settings=coredjango.benchmark_settings
+#    python manage.py benchmark_endpoints --settings=coredjango.benchmark_settings --products 1000 --order-items 10000 --output report.json
+class Command(BaseCommand):
+    help = 'Benchmarks every store endpoint against a synthetic dataset and checks the results against a budget file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--order-items', type=int, default=1_000_000)
+        parser.add_argument('--customers', type=int, default=1_000)
+        parser.add_argument('--requests', type=int, default=20, help='timed requests per endpoint')
+        parser.add_argument('--budget', default=str(DEFAULT_BUDGETS), help='json file with the thresholds per endpoint')
+        parser.add_argument('--output', help='writes the measurements to this json file')
+        parser.add_argument('--endpoint', action='append', help='only run these endpoints (by name)')
+
+    def handle(self, *args, **options):
+        budgets = self.load_budgets(options['budget'])
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)     #never the real database
+        try:
+            started = time.perf_counter()
+            fixtures = self.seed(options['products'], options['order_items'], options['customers'])
+            self.stdout.write(f'Seeded {options["products"]} products and {options["order_items"]} order items in {time.perf_counter() - started:.1f}s ({connection.vendor})')
+
+            results = {}
+            for name, user, url in self.get_endpoints(fixtures):
+                if options['endpoint'] and name not in options['endpoint']:
+                    continue
+                results[name] = self.measure(user, url, options['requests'])
+                self.print_result(name, results[name])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+
+        failures = self.check_budgets(results, budgets)
+        if failures:
+            raise CommandError('Over budget:\n  ' + '\n  '.join(failures))
+        self.stdout.write(self.style.SUCCESS('All endpoints are within budget'))
+
+    def load_budgets(self, path):
+        try:
+            return json.loads(Path(path).read_text())
+        except FileNotFoundError:
+            raise CommandError(f'No budget file at {path}')
+
+    def seed(self, products_count, order_items_count, customers_count):
+        rng = random.Random(42)
+        batch_size = 5000
+        User = get_user_model()
+
+        collections = Collection.objects.bulk_create([Collection(title=f'Collection {i}') for i in range(100)])
+        words = ['red', 'blue', 'green', 'cotton', 'leather', 'shoe', 'shirt', 'hat', 'bag', 'wool', 'summer', 'winter', 'classic', 'sport']
+        for start in range(0, products_count, batch_size):
+            Product.objects.bulk_create([
+                Product(
+                    title=f'{rng.choice(words).title()} {rng.choice(words)} {i}',
+                    slug=f'product-{i}',
+                    description=' '.join(rng.choices(words, k=12)),
+                    unit_price=Decimal(rng.randint(100, 99999)) / 100,
+                    inventory=rng.randint(0, 500),
+                    collection=rng.choice(collections)
+                ) for i in range(start, min(start + batch_size, products_count))
+            ], batch_size=batch_size)
+        Collection.objects.rebuild_products_count()     #bulk_create skips the signals that keep these up to date
+        get_search_index().rebuild()
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        prices = dict(Product.objects.values_list('id', 'unit_price'))
+
+        users = User.objects.bulk_create([User(username=f'user{i}', email=f'user{i}@example.com') for i in range(customers_count)])
+        customers = Customer.objects.bulk_create([Customer(user=user, phone='555-0100') for user in users])
+        staff = User.objects.create(username='staff', email='staff@example.com', is_staff=True, is_superuser=True)
+
+        orders_count = max(1, order_items_count // 3)
+        for start in range(0, orders_count, batch_size):
+            Order.objects.bulk_create([Order(customer=rng.choice(customers)) for _ in range(start, min(start + batch_size, orders_count))], batch_size=batch_size)
+        order_ids = list(Order.objects.values_list('id', flat=True))
+
+        items = []
+        for i in range(order_items_count):
+            product_id = rng.choice(product_ids)
+            items.append(OrderItem(order_id=order_ids[i % len(order_ids)], product_id=product_id, quantity=rng.randint(1, 5), unit_price=prices[product_id]))
+            if len(items) == batch_size:
+                OrderItem.objects.bulk_create(items, batch_size=batch_size)
+                items = []
+        OrderItem.objects.bulk_create(items, batch_size=batch_size)
+        now = timezone.now()
+        for days_ago in range(365):     #a year of orders
+            Order.objects.filter(id__in=order_ids[days_ago::365]).update(placed_at=now - timedelta(days=days_ago))
+        Order.objects.filter(id__in=order_ids[::2]).update(payment_status=Order.PAYMENT_STATUS_COMPLETE)
+        rebuild_all_history()       #the history and the sales rollups are filled from the orders like the backfills do
+        rebuild_all_rollups()
+
+        hot_product = product_ids[0]
+        Review.objects.bulk_create([Review(product_id=hot_product, name=f'Reviewer {i}', description='Great') for i in range(200)])
+
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create([CartItem(cart=cart, product_id=product_id, quantity=2) for product_id in rng.sample(product_ids, min(20, len(product_ids)))])
+
+        customer = Customer.objects.filter(order__isnull=False).select_related('user').first()
+        return {
+            'staff': staff,
+            'customer': customer,
+            'product_id': hot_product,
+            'collection_id': collections[0].id,
+            'cart_id': cart.id,
+            'order_id': Order.objects.filter(customer=customer).values_list('id', flat=True).first(),
+            'deep_page': max(1, products_count // 10 - 1)
+        }
+
+    def get_endpoints(self, fixtures):
+        customer_user = fixtures['customer'].user
+        staff = fixtures['staff']
+        return [
+            ('products-list', None, '/store/products/'),
+            ('products-list-deep-page', None, f'/store/products/?page={fixtures["deep_page"]}'),
+            ('products-list-cursor', None, '/store/products/?pagination=cursor'),
+            ('products-list-filtered', None, f'/store/products/?collection_id={fixtures["collection_id"]}&unit_price__gt=10&unit_price__lt=500&ordering=unit_price'),
+            ('products-search', None, '/store/products/?search=leather sh'),
+            ('product-detail', None, f'/store/products/{fixtures["product_id"]}/'),
+            ('product-reviews-list', None, f'/store/products/{fixtures["product_id"]}/reviews/'),
+            ('collections-list', None, '/store/collections/'),
+            ('collection-detail', None, f'/store/collections/{fixtures["collection_id"]}/'),
+            ('cart-detail', None, f'/store/carts/{fixtures["cart_id"]}/'),
+            ('cart-items-list', None, f'/store/carts/{fixtures["cart_id"]}/items/'),
+            ('customers-list', staff, '/store/customers/'),
+            ('customers-me', customer_user, '/store/customers/me/'),
+            ('customer-history', staff, f'/store/customers/{fixtures["customer"].id}/history/'),
+            ('orders-list', customer_user, '/store/orders/'),
+            ('orders-list-staff-cursor', staff, '/store/orders/?pagination=cursor'),
+            ('order-detail', customer_user, f'/store/orders/{fixtures["order_id"]}/'),
+            ('sales-report-days', staff, '/store/reports/?group_by=day'),
+            ('sales-report-products', staff, '/store/reports/?group_by=product'),
+        ]
+
+    def measure(self, user, url, requests):
+        client = APIClient()
+        if user is not None:
+            client.force_authenticate(user)
+
+        def get():
+            cache.clear()       #every request is a cache miss, the budgets are for the database path
+            response = client.get(url)
+            if response.status_code != 200:
+                raise CommandError(f'GET {url} returned {response.status_code}')
+            return response
+
+        get()       #warm up
+        with CaptureQueriesContext(connection) as context:
+            get()
+        queries = len(context.captured_queries)
+
+        latencies = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            get()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        tracemalloc.start()
+        get()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        latencies.sort()
+        return {
+            'url': url,
+            'queries': queries,
+            'p50_ms': round(statistics.median(latencies), 2),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+            'memory_kb': round(peak / 1024, 1)
+        }
+
+    def print_result(self, name, result):
+        self.stdout.write(
+            f'  {name:<26} {result["queries"]:>3} queries  p50 {result["p50_ms"]:>8.2f} ms  '
+            f'p95 {result["p95_ms"]:>8.2f} ms  {result["memory_kb"]:>9.1f} KB')
+
+    def check_budgets(self, results, budgets):
+        failures = []
+        for name, result in results.items():
+            for metric, limit in budgets.get(name, {}).items():
+                if result[metric] > limit:
+                    failures.append(f'{name}: {metric} is {result[metric]}, the budget is {limit}')
+        return failures
@@ -0,0 +1,82 @@
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from store.caches import get_cache
+from store.models import Collection, Product, Promotion
+from store.pricing import compute_price, get_prices, get_tax_rate
+
+
+#pricing many products at once (store/pricing.py) against asking every product for its promotions, on a throwaway test database
+#
+#    python manage.py benchmark_pricing --settings=coredjango.benchmark_settings
+#    python manage.py benchmark_pricing --settings=coredjango.benchmark_settings --products 100000 --promoted 0.5
+class Command(BaseCommand):
+    help = 'Compares the time and queries of pricing products one by one and in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10_000)
+        parser.add_argument('--promotions', type=int, default=20)
+        parser.add_argument('--promoted', type=float, default=0.2, help='fraction of the products with promotions')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)     #never the real database
+        try:
+            self.seed(options['products'], options['promotions'], options['promoted'])
+            products = list(Product.objects.values_list('id', 'unit_price'))
+            self.stdout.write(f'{len(products)} products, {Product.promotions.through.objects.count()} product promotions ({connection.vendor})')
+
+            one_by_one = self.one_by_one(products)
+            if one_by_one != {product_id: price.price_with_tax for product_id, price in get_prices(products).items()}:
+                raise CommandError('the bulk prices differ from the prices of one product at a time')
+
+            self.measure('one by one', lambda: self.one_by_one(products), options['repeat'])
+            self.measure('bulk, cold cache', lambda: get_prices(products), options['repeat'], get_cache().clear)
+            self.measure('bulk, warm cache', lambda: get_prices(products), options['repeat'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def seed(self, products, promotions, promoted):
+        collection = Collection.objects.create(title='Benchmark')
+        Product.objects.bulk_create([
+            Product(title=f'Product {i}', slug=f'product-{i}', unit_price=Decimal(100 + i % 9000) / 100, inventory=i % 300, collection=collection)
+            for i in range(products)
+        ], batch_size=2000)
+        promotions = Promotion.objects.bulk_create([Promotion(description=f'Promotion {i}', discount=(1 + i % 10) / 20) for i in range(promotions)])
+        step = max(1, round(1 / promoted)) if promoted else 0
+        Product.promotions.through.objects.bulk_create([
+            Product.promotions.through(product_id=product_id, promotion_id=promotions[(product_id + offset) % len(promotions)].id)
+            for product_id in (Product.objects.values_list('id', flat=True)[::step] if step else [])
+            for offset in range(1 + product_id % 3)     #1 to 3 promotions each
+        ], batch_size=2000, ignore_conflicts=True)
+        get_cache().clear()
+
+    def one_by_one(self, products):
+        #the naive way: a query for the promotions of every product, then its price
+        tax = 1 + get_tax_rate()
+        prices = {}
+        for product in Product.objects.filter(pk__in=[product_id for product_id, _ in products]).only('id', 'unit_price'):
+            discount = max(product.promotions.values_list('discount', flat=True), default=0)
+            prices[product.id] = compute_price(product.unit_price, discount, tax).price_with_tax
+        return prices
+
+    def measure(self, name, function, repeat, before=None):
+        times, queries = [], []
+
+        def count(execute, sql, params, many, context):      #the query log of the connection keeps the last 9000 only
+            queries[-1] += 1
+            return execute(sql, params, many, context)
+
+        for _ in range(repeat):
+            if before is not None:
+                before()
+            queries.append(0)
+            with connection.execute_wrapper(count):
+                started = time.perf_counter()
+                function()
+                times.append(time.perf_counter() - started)
+        self.stdout.write(f'  {name:<18} {min(times) * 1000:>10.1f} ms   {max(queries):>6} queries')
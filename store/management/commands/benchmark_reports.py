@@ -0,0 +1,58 @@
+import statistics
+import time
+from datetime import timedelta
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.utils import timezone
+from store.reports import GROUPS, get_report, rebuild_all_rollups
+from .benchmark_endpoints import Command as BenchmarkEndpointsCommand
+
+
+#the sales reports answered from the daily rollups against the same reports aggregated over the order items, on the dataset of benchmark_endpoints
+#
+#    python manage.py benchmark_reports --settings=coredjango.benchmark_settings
+#    python manage.py benchmark_reports --settings=coredjango.benchmark_settings --order-items 100000 --days 7 --days 365
+class Command(BenchmarkEndpointsCommand):
+    help = 'Compares the latency of the sales reports from the rollups and from the raw order items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--order-items', type=int, default=1_000_000)
+        parser.add_argument('--customers', type=int, default=1_000)
+        parser.add_argument('--requests', type=int, default=10, help='timed reports per case')
+        parser.add_argument('--days', type=int, action='append', help='report ranges in days (default: 30 and 365)')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)     #never the real database
+        try:
+            started = time.perf_counter()
+            self.seed(options['products'], options['order_items'], options['customers'])
+            self.stdout.write(f'Seeded {options["products"]} products and {options["order_items"]} order items in {time.perf_counter() - started:.1f}s ({connection.vendor})')
+
+            started = time.perf_counter()
+            stats = rebuild_all_rollups()       #the seed fills them already, this times the backfill
+            self.stdout.write(f'Rebuilt {stats["days"]} days of rollups ({stats["rows"]} rows) in {time.perf_counter() - started:.1f}s')
+
+            end = timezone.localdate()
+            for days in options['days'] or [30, 365]:
+                start = end - timedelta(days=days - 1)
+                for group_by in GROUPS:
+                    rollups = self.measure_report(options['requests'], start, end, group_by)
+                    raw = self.measure_report(options['requests'], start, end, group_by, raw=True)
+                    self.stdout.write(
+                        f'  {days:>4} days by {group_by:<11} rollups p50 {rollups[0]:>8.2f} ms  p95 {rollups[1]:>8.2f} ms   '
+                        f'raw p50 {raw[0]:>9.2f} ms  p95 {raw[1]:>9.2f} ms   {raw[0] / rollups[0]:>6.0f}x')
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def measure_report(self, requests, start, end, group_by, raw=False):
+        get_report(start, end, group_by, raw=raw)       #warm up
+        latencies = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            get_report(start, end, group_by, raw=raw)
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+        return statistics.median(latencies), latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
@@ -0,0 +1,70 @@
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from rest_framework.renderers import JSONRenderer
+from store.fast_serializers import FastCartSerializer, FastProductSerializer
+from store.models import Cart, CartItem, Collection, Product
+from store.serializers import CartSerializer, ProductSerializer
+
+
+#objects/second of the compiled read-only serializers (store/fast_serializers.py) next to the DRF ones, on a throwaway test database
+#it also checks that both render exactly the same json
+#
+#    python manage.py benchmark_serializers --settings=coredjango.benchmark_settings
+class Command(BaseCommand):
+    help = 'Compares the throughput of the fast serializers with the DRF serializers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--objects', type=int, default=10_000)
+        parser.add_argument('--cart-items', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.seed(options['objects'], options['cart_items'])
+            products = list(Product.objects.all())
+            rows = list(Product.objects.values(*FastProductSerializer.values_fields()))
+            carts = [Cart.objects.prefetch_related('items__product').get()] * max(1, options['objects'] // options['cart_items'])
+
+            self.stdout.write(f'{len(products)} products, {len(carts)} carts of {options["cart_items"]} items')
+            self.compare('products (instances)', lambda: ProductSerializer(products, many=True).data, lambda: FastProductSerializer(products, many=True).data, len(products), options['repeat'])
+            self.compare('products (.values() rows)', lambda: ProductSerializer(products, many=True).data, lambda: FastProductSerializer(rows, many=True).data, len(products), options['repeat'])
+            self.compare('carts', lambda: CartSerializer(carts, many=True).data, lambda: FastCartSerializer(carts, many=True).data, len(carts), options['repeat'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def seed(self, objects, cart_items):
+        collection = Collection.objects.create(title='Benchmark')
+        Product.objects.bulk_create([
+            Product(title=f'Product {i}', slug=f'product-{i}', description=None if i % 5 == 0 else f'Description {i}',
+                    unit_price=Decimal(100 + i % 9000) / 100, inventory=i % 300, collection=collection)
+            for i in range(objects)
+        ], batch_size=2000)
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=1 + i % 4)
+            for i, product in enumerate(Product.objects.all()[:cart_items])
+        ])
+
+    def compare(self, name, slow, fast, count, repeat):
+        renderer = JSONRenderer()
+        if renderer.render(slow()) != renderer.render(fast()):
+            raise CommandError(f'{name}: the fast serializer renders different json')
+
+        slow_time = self.best_of(slow, repeat)
+        fast_time = self.best_of(fast, repeat)
+        self.stdout.write(
+            f'  {name:<28} drf {count / slow_time:>10,.0f} obj/s   fast {count / fast_time:>10,.0f} obj/s   '
+            f'x{slow_time / fast_time:.1f}   (same json)')
+
+    def best_of(self, function, repeat):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - started)
+        return min(times)
@@ -0,0 +1,146 @@
+import re
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from rest_framework.test import APIClient
+from .benchmark_endpoints import Command as BenchmarkCommand
+
+
+#seeds the same throwaway database as benchmark_endpoints, calls every endpoint once and runs EXPLAIN on each SELECT it made
+#a query is reported when the plan reads a whole table (with more than --min-rows rows) or sorts without an index
+#
+#    python manage.py explain_queries --settings=coredjango.benchmark_settings
+#    python manage.py explain_queries --settings=coredjango.benchmark_settings --fail-on-scan      #for ci
+class Command(BenchmarkCommand):
+    help = 'Runs EXPLAIN on the queries of every store endpoint and reports full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=20_000)
+        parser.add_argument('--order-items', type=int, default=100_000)
+        parser.add_argument('--customers', type=int, default=1_000)
+        parser.add_argument('--min-rows', type=int, default=1_000, help='scans of smaller tables are not reported')
+        parser.add_argument('--endpoint', action='append', help='only explain these endpoints (by name)')
+        parser.add_argument('--verbose-plans', action='store_true', help='print the plan of every query')
+        parser.add_argument('--fail-on-scan', action='store_true', help='exit with an error when a full scan is found')
+
+    def handle(self, *args, **options):
+        if connection.vendor not in PLAN_READERS:
+            raise CommandError(f'No plan reader for {connection.vendor}')
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)     #never the real database
+        try:
+            fixtures = self.seed(options['products'], options['order_items'], options['customers'])
+            self.row_counts = {}
+            scans = []
+            for name, user, url in self.get_endpoints(fixtures):
+                if options['endpoint'] and name not in options['endpoint']:
+                    continue
+                scans += self.explain_endpoint(name, user, url, options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if not scans:
+            self.stdout.write(self.style.SUCCESS('No full table scans'))
+        elif options['fail_on_scan']:
+            raise CommandError(f'{len(scans)} queries read a whole table: ' + ', '.join(sorted(set(scans))))
+
+    def explain_endpoint(self, name, user, url, options):
+        client = APIClient()
+        if user is not None:
+            client.force_authenticate(user)
+        cache.clear()       #a cached response makes no queries
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        if response.status_code != 200:
+            raise CommandError(f'GET {url} returned {response.status_code}')
+
+        self.stdout.write(f'{name}  {url}')
+        scans = []
+        seen = set()
+        for query in context.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith('SELECT') or sql in seen:
+                continue
+            seen.add(sql)
+            plan, full_scans, sorts = PLAN_READERS[connection.vendor](sql)
+            full_scans = [table for table in full_scans if self.row_count(table) >= options['min_rows']]
+            if full_scans and not sorts and LIMIT_RE.search(sql):     #a scan in index/primary key order that stops at the LIMIT (keyset pagination)
+                full_scans = []
+
+            if full_scans or sorts or options['verbose_plans']:
+                self.stdout.write(f'  {shorten(sql)}')
+            for table in full_scans:
+                self.stdout.write(self.style.WARNING(f'    full scan of {table} ({self.row_count(table)} rows)'))
+                scans.append(f'{name}:{table}')
+            for sort in sorts:
+                self.stdout.write(f'    sort: {sort}')
+            if options['verbose_plans']:
+                for line in plan:
+                    self.stdout.write(f'      {line}')
+        return scans
+
+    def row_count(self, table):
+        if table not in self.row_counts:
+            if table not in connection.introspection.table_names():     #an alias or a subquery, not a real table
+                self.row_counts[table] = 0
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'SELECT COUNT(*) FROM {connection.ops.quote_name(table)}')
+                    self.row_counts[table] = cursor.fetchone()[0]
+        return self.row_counts[table]
+
+
+LIMIT_RE = re.compile(r'\bLIMIT \d+\s*$')
+
+
+def shorten(sql, length=150):
+    return sql if len(sql) <= length else sql[:length] + '...'
+
+
+
+
+#each reader returns (the plan as lines, the tables read in full, the sorts done without an index)
+
+SQLITE_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')     #'SCAN store_product USING INDEX ...' reads an index, not the table
+
+
+def explain_sqlite(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+        plan = [row[-1] for row in cursor.fetchall()]
+    scans = [match.group(1) for match in map(SQLITE_SCAN_RE.match, plan) if match]
+    sorts = [line for line in plan if line.startswith('USE TEMP B-TREE')]
+    return plan, scans, sorts
+
+
+def explain_mysql(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN {sql}')
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    plan = [' '.join(f'{key}={value}' for key, value in row.items()) for row in rows]
+    scans = [row['table'] for row in rows if row['type'] == 'ALL']
+    sorts = [f'{row["table"]}: {row["Extra"]}' for row in rows if 'filesort' in (row['Extra'] or '')]
+    return plan, scans, sorts
+
+
+POSTGRES_SCAN_RE = re.compile(r'Seq Scan on (\w+)')
+
+
+def explain_postgresql(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN {sql}')
+        plan = [row[0] for row in cursor.fetchall()]
+    scans = [match.group(1) for line in plan for match in [POSTGRES_SCAN_RE.search(line)] if match]
+    sorts = [line.strip() for line in plan if line.strip().startswith('Sort Key')]
+    return plan, scans, sorts
+
+
+PLAN_READERS = {
+    'sqlite': explain_sqlite,
+    'mysql': explain_mysql,
+    'postgresql': explain_postgresql,
+}
@@ -0,0 +1,46 @@
+import json
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from store.imports import INPUTS, import_products, read_rows
+
+
+#creates and updates products from the supplier feed (store.imports.import_products), e.g. every night:
+#
+#    30 2 * * *  python manage.py import_products /data/feed/products.csv
+#    zcat products.ndjson.gz | python manage.py import_products - --format ndjson
+#
+#every batch is committed on its own, so running it again after an interruption just writes the same rows again
+class Command(BaseCommand):
+    help = 'Creates and updates products from a csv or ndjson feed, matched by sku, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="the feed, '-' reads stdin")
+        parser.add_argument('--format', choices=list(INPUTS), help='by default the extension of the file')
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        input_format = options['format'] or options['path'].rsplit('.', 1)[-1]
+        if input_format not in INPUTS:
+            raise CommandError(f'Pass --format ({", ".join(INPUTS)}), the format of {options["path"]} is unknown')
+
+        self.verbosity = options['verbosity']
+        stream = sys.stdin.buffer if options['path'] == '-' else open(options['path'], 'rb')
+        try:
+            stats = import_products(read_rows(stream, input_format), batch_size=options['batch_size'], progress=self.progress)
+        finally:
+            stream.close()
+
+        for error in stats['errors']:
+            self.stderr.write(f'  row {error["row"]}: {json.dumps(error["errors"])}')
+        if stats['invalid'] > len(stats['errors']):
+            self.stderr.write(f'  ... and {stats["invalid"] - len(stats["errors"])} more invalid rows')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {stats["rows"] - stats["invalid"]} of {stats["rows"]} rows ({stats["created"]} created, {stats["updated"]} updated, '
+            f'{stats["invalid"]} invalid) in {stats["batches"]} batches, {stats["seconds"]:.1f}s ({self.rate(stats)} rows/s)'))
+
+    def progress(self, stats):
+        if self.verbosity > 1 or stats['batches'] % 10 == 0:
+            self.stdout.write(f'  batch {stats["batches"]}: {stats["rows"]} rows, {self.rate(stats)} rows/s')
+
+    def rate(self, stats):
+        return f'{stats["rows"] / stats["seconds"]:,.0f}' if stats['seconds'] else '-'
@@ -0,0 +1,34 @@
+import json
+from django.core.management.base import BaseCommand
+from store.profiling import get_report, reset_report
+
+
+#prints what store.profiling.ProfilingMiddleware sampled so far (all processes that share the cache)
+class Command(BaseCommand):
+    help = 'Shows the per view sql, serializer and total times recorded by the profiling middleware'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='print the raw report as json')
+        parser.add_argument('--reset', action='store_true', help='clear the recorded numbers after printing them')
+
+    def handle(self, *args, **options):
+        report = get_report()
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        elif not report:
+            self.stdout.write('Nothing sampled yet')
+        else:
+            self.stdout.write(f'{"view":<40} {"reqs":>6} {"sql":>6} {"max sql":>8} {"sql ms":>8} {"ser ms":>8} {"total ms":>9} {"p50":>6} {"p95":>6}')
+            for name, view in report.items():
+                self.stdout.write(
+                    f'{name:<40} {view["requests"]:>6} {view["avg_sql_count"]:>6} {view["max_sql_count"]:>8} '
+                    f'{view["avg_sql_ms"]:>8} {view["avg_serializer_ms"]:>8} {view["avg_total_ms"]:>9} '
+                    f'{self.bound(view["p50_ms"]):>6} {self.bound(view["p95_ms"]):>6}')
+                for duplicate in view['duplicate_queries']:
+                    self.stdout.write(self.style.WARNING(f'    repeated up to {duplicate["max_repeats"]}x in {duplicate["requests"]} requests: {duplicate["sql"][:160]}'))
+
+        if options['reset']:
+            reset_report()
+
+    def bound(self, milliseconds):
+        return f'<={milliseconds}' if milliseconds is not None else 'slow'
@@ -0,0 +1,52 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from store.carts import purge_abandoned_carts
+from store.models import Cart
+
+
+#deletes the carts that were never checked out (store.carts.purge_abandoned_carts)... meant to run from cron, e.g. every night:
+#
+#    0 3 * * *  python manage.py purge_abandoned_carts --days 30
+#
+#it can be stopped at any time (ctrl+c, kill), the batches already deleted stay deleted and the next run picks up from there
+class Command(BaseCommand):
+    help = 'Deletes abandoned carts older than --days in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'STORE_CART_MAX_AGE_DAYS', 30))
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.1, help='seconds to wait between two batches')
+        parser.add_argument('--max-batches', type=int, default=None, help='stop after this many batches (the next run continues)')
+        parser.add_argument('--dry-run', action='store_true', help='only count the carts that would be deleted')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            cutoff = timezone.now() - timedelta(days=options['days'])
+            self.stdout.write(f'{Cart.objects.filter(created_at__lt=cutoff).count()} carts are older than {options["days"]} days')
+            return
+
+        self.verbosity = options['verbosity']
+        self.last = {'batches': 0, 'carts': 0, 'items': 0, 'seconds': 0.0}     #what the last batch reported, for the summary after an interruption
+        try:
+            stats = purge_abandoned_carts(
+                days=options['days'],
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                max_batches=options['max_batches'],
+                progress=self.progress)
+        except KeyboardInterrupt:
+            self.stdout.write('Interrupted, the next run continues from the oldest cart left')
+            stats = self.last
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {stats["carts"]} carts and {stats["items"]} items in {stats["batches"]} batches, {stats["seconds"]:.1f}s '
+            f'({self.rate(stats)} rows/s)'))
+
+    def progress(self, stats):
+        self.last = dict(stats)
+        if self.verbosity > 1 or stats['batches'] % 10 == 0:
+            self.stdout.write(f'  batch {stats["batches"]}: {stats["carts"]} carts, {stats["items"]} items, {self.rate(stats)} rows/s')
+
+    def rate(self, stats):
+        return f'{(stats["carts"] + stats["items"]) / stats["seconds"]:,.0f}' if stats['seconds'] else '-'
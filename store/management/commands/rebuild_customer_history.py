@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from store.history import rebuild_all_history
+
+
+#the customer history follows order saves and deletes on its own... run this once to fill it from the existing orders,
+#and after bulk changes that skip the signals (queryset.update, bulk_create, raw sql)
+#every chunk of customers is recomputed in its own transaction, an order placed while its chunk is being recomputed may need another run
+class Command(BaseCommand):
+    help = 'Recomputes the order history of every customer from the orders, in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None, help='customers per transaction')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        stats = rebuild_all_history(chunk_size=options['chunk_size'], progress=self.progress)
+        self.stdout.write(self.style.SUCCESS(
+            f'Recomputed the history of {stats["customers"]} customers ({stats["histories"]} with orders) in {stats["chunks"]} chunks'))
+
+    def progress(self, stats):
+        if self.verbosity > 1 or stats['chunks'] % 10 == 0:
+            self.stdout.write(f'  chunk {stats["chunks"]}: {stats["customers"]} customers')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from store.caches import VERSION_COLLECTIONS, bump_version
+from store.models import Collection
+
+
+#Collection.products_count follows product saves and deletes on its own... run this after bulk changes that skip the signals (bulk_create, queryset.update, raw sql)
+class Command(BaseCommand):
+    help = 'Recounts the products of every collection'
+
+    def handle(self, *args, **options):
+        updated = Collection.objects.rebuild_products_count()
+        bump_version(VERSION_COLLECTIONS)       #the collection list shows the counts
+        self.stdout.write(self.style.SUCCESS(f'Recounted the products of {updated} collections'))
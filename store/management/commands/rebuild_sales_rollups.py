@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from store.reports import rebuild_all_rollups
+
+
+#the sales rollups follow the orders on their own... run this once to fill them from the existing orders,
+#and after bulk changes that skip the signals (queryset.update, bulk_create, raw sql)
+#every chunk of days is recomputed in its own transaction by the database (GROUP BY), nothing is aggregated in python
+class Command(BaseCommand):
+    help = 'Recomputes the daily sales rollups from the complete orders, in chunks of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-days', type=int, default=None, help='days per transaction')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        started = time.perf_counter()
+        stats = rebuild_all_rollups(chunk_days=options['chunk_days'], progress=self.progress)
+        self.stdout.write(self.style.SUCCESS(
+            f'Recomputed {stats["days"]} days of sales ({stats["rows"]} rollup rows) in {stats["chunks"]} chunks, {time.perf_counter() - started:.1f}s'))
+
+    def progress(self, stats):
+        if self.verbosity > 1:
+            self.stdout.write(f'  chunk {stats["chunks"]}: {stats["days"]} days, {stats["rows"]} rows')
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from store.search import get_search_index
+
+
+#the search index follows product saves and deletes on its own... run this after bulk changes that skip the signals (queryset.update, raw sql, imports)
+class Command(BaseCommand):
+    help = 'Rebuilds the product full text search index'
+
+    def handle(self, *args, **options):
+        index = get_search_index()
+        index.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the {index.__class__.__name__}'))
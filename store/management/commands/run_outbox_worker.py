@@ -0,0 +1,39 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from store.outbox import dispatch_pending, get_metrics, get_setting
+
+
+#delivers the outbox events (store/outbox.py) outside the web processes... run one or more of these with STORE_OUTBOX_MODE = 'worker'
+#several worker processes can run side by side, each one claims its own batches
+class Command(BaseCommand):
+    help = 'Delivers pending outbox events to their signal receivers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=get_setting('THREADS', 4))
+        parser.add_argument('--batch-size', type=int, default=get_setting('BATCH_SIZE', 100))
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to wait when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='deliver what is pending and exit')
+
+    def handle(self, *args, **options):
+        delivered = 0
+        with ThreadPoolExecutor(max_workers=options['threads'], thread_name_prefix='outbox') as executor:
+            try:
+                while True:
+                    claimed = dispatch_pending(options['batch_size'], executor)
+                    delivered += claimed
+                    if not claimed:
+                        if options['once']:
+                            break
+                        time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                pass
+        self.report(delivered)
+
+    def report(self, claimed):
+        metrics = get_metrics()
+        self.stdout.write(f'{claimed} events claimed, {metrics["lag"]["events"]} delivered (avg lag {metrics["lag"]["avg_ms"]:.1f} ms, max {metrics["lag"]["max_ms"]:.1f} ms)')
+        for name, receiver in sorted(metrics['receivers'].items()):
+            self.stdout.write(
+                f'  {name}: {receiver["calls"]} calls, {receiver["failures"]} failed, '
+                f'avg {receiver["avg_ms"]:.2f} ms, max {receiver["max_ms"]:.2f} ms')
@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+
+#native full text index used by store/search.py... MySQL gets a FULLTEXT index, SQLite an FTS5 table (rowid = product id), other databases use the python index
+
+
+def create_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE store_product ADD FULLTEXT INDEX store_product_fulltext (title, description)')
+    elif vendor == 'sqlite':
+        try:
+            schema_editor.execute('CREATE VIRTUAL TABLE store_product_fts USING fts5(title, description)')
+        except OperationalError:     #sqlite was compiled without FTS5
+            return
+        schema_editor.execute(
+            "INSERT INTO store_product_fts (rowid, title, description) "
+            "SELECT id, title, COALESCE(description, '') FROM store_product")
+
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE store_product DROP INDEX store_product_fulltext')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS store_product_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_alter_orderitem_order'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
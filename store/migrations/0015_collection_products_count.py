@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:51
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_products(apps, schema_editor):
+    Collection = apps.get_model('store', 'Collection')
+    Product = apps.get_model('store', 'Product')
+    products = Product.objects \
+        .filter(collection_id=models.OuterRef('pk')) \
+        .order_by() \
+        .values('collection_id') \
+        .annotate(count=models.Count('id')) \
+        .values('count')
+    Collection.objects.update(products_count=Coalesce(models.Subquery(products), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_product_fulltext_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='products_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_product_sku'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerHistory',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='history', serialize=False, to='store.customer')),
+                ('orders_count', models.PositiveIntegerField(default=0)),
+                ('paid_orders_count', models.PositiveIntegerField(default=0)),
+                ('lifetime_spend', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('last_order_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CustomerProductHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('spend', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='product_history', to='store.customer')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['customer', '-quantity'], name='store_custprod_top_idx')],
+                'unique_together': {('customer', 'product')},
+            },
+        ),
+    ]
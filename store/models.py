@@ -1,6 +1,8 @@
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.utils import timezone
 from uuid import uuid4   #func
 
 
@@ -9,10 +11,24 @@ class Promotion(models.Model):
     discount = models.FloatField()
 
 
+class CollectionManager(models.Manager):
+    def rebuild_products_count(self, collection_ids=None):     #recounts every collection (or only the given ones) in a single UPDATE
+        collections = self.all() if collection_ids is None else self.filter(pk__in=collection_ids)
+        products = Product.objects \
+            .filter(collection_id=models.OuterRef('pk')) \
+            .order_by() \
+            .values('collection_id') \
+            .annotate(count=models.Count('id')) \
+            .values('count')
+        return collections.update(products_count=Coalesce(models.Subquery(products), 0))
+
+
 class Collection(models.Model):
+    objects = CollectionManager()
     title = models.CharField(max_length=255)
     featured_product = models.ForeignKey(
         'Product', on_delete=models.SET_NULL, null=True, related_name='+', blank=True)
+    products_count = models.PositiveIntegerField(default=0, editable=False)    #denormalized, kept up to date by the product signals (store/signals/handlers.py)
 
     def __str__(self) -> str:
         return self.title
@@ -24,6 +40,7 @@ class Collection(models.Model):
 class Product(models.Model):
     title = models.CharField(max_length=255)
     slug = models.SlugField()
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)     #the supplier's stock keeping unit, the bulk import matches its rows to products by it (store/imports.py)
     description = models.TextField(null=True, blank=True)
     unit_price = models.DecimalField(
         max_digits=6,
@@ -37,8 +54,16 @@ class Product(models.Model):
     def __str__(self) -> str:
         return self.title
 
+    def save(self, *args, **kwargs):     #the post_save handlers (collection products_count...) run in the same transaction as the save
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['title']
+        indexes = [
+            models.Index(fields=['collection', 'unit_price'], name='store_product_coll_price_idx'),    #ProductFilter: collection_id + unit_price range
+            models.Index(fields=['title', 'id'], name='store_product_title_idx')      #the default ordering (and the keyset pagination on it)
+        ]
 
 
 class Customer(models.Model):
@@ -89,10 +114,18 @@ class Order(models.Model):
         max_length=1, choices=PAYMENT_STATUS_CHOICES, default=PAYMENT_STATUS_PENDING)
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
 
+    def save(self, *args, **kwargs):     #the customer history handlers (store/signals/handlers.py) run in the same transaction as the save
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     class Meta:
         permissions = [    #this is a custom model permission
             ('cancel_order', 'can cancel order')
         ]
+        indexes = [
+            models.Index(fields=['customer', 'placed_at'], name='store_order_customer_idx'),     #a customer's orders, newest or oldest first
+            models.Index(fields=['placed_at', 'id'], name='store_order_placed_idx')      #the staff order list by date (and the keyset pagination on it)
+        ]
 
         
 
@@ -104,6 +137,62 @@ class OrderItem(models.Model):
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
 
 
+#the order history of each customer, kept up to date as orders are placed and paid (store/history.py) instead of aggregated over Order/OrderItem on every read
+#'manage.py rebuild_customer_history' fills it from the existing orders
+class CustomerHistory(models.Model):
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, related_name='history')
+    orders_count = models.PositiveIntegerField(default=0)     #every order placed
+    paid_orders_count = models.PositiveIntegerField(default=0)        #the complete ones
+    lifetime_spend = models.DecimalField(max_digits=12, decimal_places=2, default=0)      #what the complete orders cost
+    last_order_at = models.DateTimeField(null=True, blank=True)
+
+
+class CustomerProductHistory(models.Model):     #how much of a product a customer bought with complete orders, the top products of the history
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='product_history')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField(default=0)
+    spend = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [['customer', 'product']]
+        indexes = [
+            models.Index(fields=['customer', '-quantity'], name='store_custprod_top_idx')      #a customer's most bought products
+        ]
+
+
+#daily sales of the complete orders, kept up to date as orders are paid (store/reports.py) so the reports/ endpoint doesn't aggregate the order items
+#'manage.py rebuild_sales_rollups' fills them from the existing orders
+class SalesRollup(models.Model):
+    day = models.DateField()        #the day the order was placed
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class DailySales(SalesRollup):
+    day = models.DateField(unique=True)
+
+
+class DailyCollectionSales(SalesRollup):        #orders_count is the orders with a product of the collection
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        unique_together = [['day', 'collection']]
+        indexes = [
+            models.Index(fields=['collection', 'day'], name='store_collsales_coll_idx')      #the days of one collection
+        ]
+
+
+class DailyProductSales(SalesRollup):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        unique_together = [['day', 'product']]
+
+
 class Address(models.Model):
     street = models.CharField(max_length=255)
     city = models.CharField(max_length=255)
@@ -113,7 +202,7 @@ class Address(models.Model):
 
 class Cart(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)     #the abandoned carts are purged by age (store.carts.purge_abandoned_carts)
 
 
 
@@ -135,10 +224,32 @@ class Review(models.Model):
     description = models.TextField()
     date = models.DateField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'date', 'id'], name='store_review_product_idx')     #the reviews of a product by date
+        ]
+
 
 #djoser provides an api layer
 
 
 
+#outbox for signals that are delivered after the transaction that sent them commits (store/outbox.py)
+#the row is written in the same transaction as the data it talks about, so an event is never lost and never delivered for a rolled back order
+class OutboxEvent(models.Model):
+    signal = models.CharField(max_length=255)       #dotted path of the signal, eg. 'store.signals.order_created'
+    sender = models.CharField(max_length=255, blank=True)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)    #not picked up before this time (retry backoff, or a worker is delivering it)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
 
+    def __str__(self) -> str:
+        return f'{self.signal} #{self.pk}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['delivered_at', 'available_at'], name='store_outbox_pending_idx')
+        ]
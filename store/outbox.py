@@ -0,0 +1,274 @@
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, connection, models, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import OutboxEvent
+from .signals import OutboxSignal
+
+
+#transactional outbox for signals like order_created
+#enqueue() writes an OutboxEvent row inside the caller's transaction, after the commit a background dispatcher delivers it to the signal's receivers
+#so the request thread neither runs the receivers nor holds its row locks while they run... delivery is at-least-once (a failed event is retried for all its receivers)
+
+
+def get_setting(name, default):
+    return getattr(settings, f'STORE_OUTBOX_{name}', default)
+
+
+def enqueue(signal, sender=None, **kwargs):
+    #signal is the dotted path of the signal, model instances in kwargs are stored as references and loaded again when the event is delivered
+    event = OutboxEvent.objects.create(
+        signal=signal,
+        sender=f'{sender.__module__}.{sender.__qualname__}' if sender is not None else '',
+        payload={name: encode(value) for name, value in kwargs.items()}
+    )
+    transaction.on_commit(wake)
+    return event
+
+
+def encode(value):
+    if isinstance(value, models.Model):
+        return {'__model__': value._meta.label_lower, 'pk': value.pk}
+    return value
+
+
+def is_model_reference(value):
+    return isinstance(value, dict) and '__model__' in value
+
+
+
+
+#per receiver delivery metrics (kept per process like the response cache counters)
+_metrics_lock = threading.Lock()
+_metrics = defaultdict(lambda: {'calls': 0, 'failures': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+_lag = {'events': 0, 'total_ms': 0.0, 'max_ms': 0.0}     #time from enqueue to delivery
+
+
+def record(receiver_name, elapsed, failed):
+    elapsed_ms = elapsed * 1000
+    with _metrics_lock:
+        metrics = _metrics[receiver_name]
+        metrics['calls'] += 1
+        metrics['failures'] += int(failed)
+        metrics['total_ms'] += elapsed_ms
+        metrics['max_ms'] = max(metrics['max_ms'], elapsed_ms)
+
+
+def record_lag(event):
+    lag_ms = (timezone.now() - event.created_at).total_seconds() * 1000
+    with _metrics_lock:
+        _lag['events'] += 1
+        _lag['total_ms'] += lag_ms
+        _lag['max_ms'] = max(_lag['max_ms'], lag_ms)
+
+
+def get_metrics():
+    with _metrics_lock:
+        receivers = {
+            name: {**metrics, 'avg_ms': metrics['total_ms'] / metrics['calls'] if metrics['calls'] else 0.0}
+            for name, metrics in _metrics.items()
+        }
+        lag = {**_lag, 'avg_ms': _lag['total_ms'] / _lag['events'] if _lag['events'] else 0.0}
+    return {'receivers': receivers, 'lag': lag}
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+        _lag.update({'events': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+
+
+
+
+def claim(batch_size):
+    #takes a batch of pending events and hides them from the other workers for the lease time
+    #SKIP LOCKED lets several worker processes claim batches at the same time without waiting for each other
+    now = timezone.now()
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects
+            .select_for_update(skip_locked=skip_locked)
+            .filter(delivered_at__isnull=True, available_at__lte=now, attempts__lt=get_setting('MAX_ATTEMPTS', 5))
+            .order_by('available_at', 'id')[:batch_size]
+        )
+        if events:
+            OutboxEvent.objects \
+                .filter(id__in=[event.id for event in events]) \
+                .update(available_at=now + timedelta(seconds=get_setting('LEASE', 60)), attempts=F('attempts') + 1)
+    return events
+
+
+def load_objects(events):
+    #one query per model for the whole batch instead of one per event
+    references = defaultdict(set)
+    for event in events:
+        for value in event.payload.values():
+            if is_model_reference(value):
+                references[value['__model__']].add(value['pk'])
+    return {
+        label: apps.get_model(label).objects.in_bulk(list(pks))
+        for label, pks in references.items()
+    }
+
+
+def next_retry():
+    #when the earliest event still to deliver becomes available (a retry after its backoff, or the lease of a worker that died), None when there is none
+    return OutboxEvent.objects \
+        .filter(delivered_at__isnull=True, attempts__lt=get_setting('MAX_ATTEMPTS', 5)) \
+        .order_by('available_at') \
+        .values_list('available_at', flat=True) \
+        .first()
+
+
+def call_receivers(signal, sender, kwargs):
+    #[(receiver name, callable that runs it)]... an OutboxSignal's receivers one by one, any other signal through send_robust as a whole
+    if isinstance(signal, OutboxSignal):
+        return [(f'{receiver.__module__}.{receiver.__qualname__}', lambda receiver=receiver: receiver(signal=signal, sender=sender, **kwargs)) for receiver in signal.receivers_for(sender)]
+    if not signal.has_listeners(sender):
+        return []
+
+    def send():
+        for _, response in signal.send_robust(sender, **kwargs):
+            if isinstance(response, Exception):
+                raise response
+    return [(signal.__class__.__qualname__, send)]
+
+
+def deliver(event, objects):
+    close_old_connections()     #deliveries run on pool threads that are never part of a request cycle
+    signal = import_string(event.signal)
+    sender = import_string(event.sender) if event.sender else None
+    kwargs = {
+        name: objects[value['__model__']].get(value['pk']) if is_model_reference(value) else value
+        for name, value in event.payload.items()
+    }
+
+    errors = []
+    for name, call in call_receivers(signal, sender, kwargs):
+        started = time.perf_counter()
+        failed = False
+        try:
+            call()
+        except Exception:
+            failed = True
+            errors.append(f'{name}\n{traceback.format_exc()}')
+        finally:
+            record(name, time.perf_counter() - started, failed)
+    return errors
+
+
+def dispatch_pending(batch_size=None, executor=None):
+    #delivers one batch of events (in parallel when an executor is given) and returns how many events were claimed
+    close_old_connections()
+    events = claim(batch_size or get_setting('BATCH_SIZE', 100))
+    if not events:
+        return 0
+
+    objects = load_objects(events)
+    if executor is None:
+        results = [deliver(event, objects) for event in events]
+    else:
+        results = list(executor.map(lambda event: deliver(event, objects), events))
+
+    now = timezone.now()
+    delivered = [event for event, errors in zip(events, results) if not errors]
+    OutboxEvent.objects.filter(id__in=[event.id for event in delivered]).update(delivered_at=now, last_error='')
+    for event in delivered:
+        record_lag(event)
+
+    for event, errors in zip(events, results):
+        if errors:      #retried with exponential backoff until STORE_OUTBOX_MAX_ATTEMPTS
+            backoff = get_setting('RETRY_DELAY', 5) * 2 ** event.attempts
+            OutboxEvent.objects \
+                .filter(id=event.id) \
+                .update(available_at=now + timedelta(seconds=backoff), last_error='\n'.join(errors))
+    return len(events)
+
+
+
+
+#in-process dispatcher: wakes up after each commit that enqueued events and drains the outbox on a background thread
+#when the outbox is drained it sets a timer for the next retry, so a failed event is delivered again without waiting for a new one
+class OutboxDispatcher:
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox')
+        self.lock = threading.Lock()
+        self.running = False
+        self.pending = False
+        self.timer = None
+
+    def wake(self):
+        with self.lock:
+            if self.running:        #the running drain will pick up the new events
+                self.pending = True
+                return
+            self.running = True
+            self.pending = False
+        threading.Thread(target=self.drain, name='outbox-dispatcher', daemon=True).start()
+
+    def drain(self):
+        try:
+            while True:
+                try:
+                    claimed = dispatch_pending(executor=self.executor)
+                except Exception:       #the events stay in the table, the next wake-up or the worker command retries them
+                    traceback.print_exc()
+                    claimed = 0
+                with self.lock:
+                    busy = claimed or self.pending
+                    self.pending = False
+                if busy:
+                    continue
+
+                try:
+                    retry_at = next_retry()
+                except Exception:       #try again later
+                    traceback.print_exc()
+                    retry_at = timezone.now() + timedelta(seconds=get_setting('RETRY_DELAY', 5))
+                with self.lock:
+                    if self.pending:
+                        self.pending = False
+                        continue
+                    self.running = False
+                    self.schedule(retry_at)
+                    return
+        finally:
+            connection.close()
+
+    def schedule(self, retry_at):       #with the lock held
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if retry_at is None:
+            return
+        self.timer = threading.Timer(max(0.0, (retry_at - timezone.now()).total_seconds()), self.wake)
+        self.timer.daemon = True
+        self.timer.start()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def wake():
+    #STORE_OUTBOX_MODE is 'thread' (deliver on a background thread of this process), 'sync' (deliver right after the commit on the same thread)
+    #or 'worker' (leave it to 'python manage.py run_outbox_worker')
+    global _dispatcher
+    mode = get_setting('MODE', 'thread')
+    if mode == 'sync':
+        while dispatch_pending():
+            pass
+    elif mode == 'thread':
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = OutboxDispatcher(get_setting('THREADS', 4))
+        _dispatcher.wake()
@@ -1,4 +1,197 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from django.db.models import Q
+from django.db.models.fields.related import RelatedField
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 class DefaultPagination(PageNumberPagination):   #this is custom pagination class
-    page_size = 10
\ No newline at end of file
+    page_size = 10
+
+
+
+
+#keyset (seek) pagination... instead of 'OFFSET n' it continues after the last row of the previous page using 'WHERE (title, id) > (last_title, last_id)'
+#so a deep page costs the same as the first one and there is no COUNT(*) unless the client asks for it with ?count=true
+class KeysetPagination(BasePagination):
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)      #list of (column or annotation name, descending) pairs always ending with the primary key
+        self.count = queryset.count() if self.include_count(request) else None
+
+        cursor = self.decode_cursor(request)
+        self.reverse = bool(cursor and cursor['reverse'])
+        if cursor is not None:
+            queryset = queryset.filter(self.build_filter(cursor['values']))
+
+        order_by = [('-' if descending != self.reverse else '') + name for name, descending in self.ordering]
+        results = list(queryset.order_by(*order_by)[:self.page_size + 1])    #one extra row tells us if there is another page
+
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+
+        if self.reverse:
+            self.has_next, self.has_previous = cursor is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.results = results
+        return results
+
+    def get_paginated_response(self, data):
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data
+        }
+        if self.count is not None:
+            response = {'count': self.count, **response}
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'count': {'type': 'integer', 'example': 123},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def include_count(self, request):
+        return request.query_params.get(self.count_query_param, '').lower() in ['1', 'true', 'yes']
+
+    def get_ordering(self, queryset):
+        #the ordering comes from the queryset itself (OrderingFilter, get_queryset or Meta.ordering)
+        #an ordering the keyset can't follow is a bad request (400), the client can drop ?ordering= or the cursor pagination
+        model = queryset.model
+        pk = model._meta.pk.attname
+        ordering = list(queryset.query.order_by) or list(model._meta.ordering)
+
+        names = []
+        for item in ordering:
+            if not isinstance(item, str):
+                raise ValidationError({'ordering': 'This ordering can not be used with cursor pagination'})
+            descending = item.startswith('-')
+            name = item.lstrip('-')
+            name = pk if name == 'pk' else self.get_name(queryset, name)
+            if name not in [n for n, _ in names]:
+                names.append((name, descending))
+
+        if pk not in [name for name, _ in names]:
+            names.append((pk, False))     #the primary key makes the ordering unique
+        return names
+
+    def get_name(self, queryset, name):
+        if name in queryset.query.annotations:      #e.g. the search rank (store/search.py), the queryset makes sure it is never NULL
+            return name
+        try:
+            field = queryset.model._meta.get_field(name)
+        except Exception:
+            field = None
+        if field is None or not field.concrete or isinstance(field, RelatedField) or field.null:   #NULLs and joins can't be compared with a simple '>'
+            raise ValidationError({'ordering': f'Ordering by "{name}" can not be used with cursor pagination'})
+        return field.attname
+
+    def build_filter(self, values):
+        #(a, b, id) > (x, y, z)  is  a > x  OR  (a = x AND b > y)  OR  (a = x AND b = y AND id > z)
+        condition = Q()
+        equal = {}
+        for (name, descending), value in zip(self.ordering, values):
+            lookup = 'lt' if descending != self.reverse else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    def get_next_link(self):
+        if not self.has_next or not self.results:
+            return None
+        return self.encode_cursor(self.results[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.results:
+            return None
+        return self.encode_cursor(self.results[0], reverse=True)
+
+    def encode_cursor(self, obj, reverse):
+        values = [self.cursor_value(name, obj) for name, _ in self.ordering]
+        data = {'o': [name for name, _ in self.ordering], 'v': values, 'r': reverse}
+        cursor = base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def cursor_value(self, name, obj):     #obj is a model instance or a '.values()' row
+        value = obj[name] if isinstance(obj, dict) else getattr(obj, name)
+        return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            ordering, values, reverse = data['o'], data['v'], bool(data['r'])
+            if not isinstance(ordering, list) or not isinstance(values, list):
+                raise ValueError
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if ordering != [name for name, _ in self.ordering] or len(values) != len(ordering):
+            raise ValidationError({'cursor': 'The cursor was made for another ordering'})
+        return {'values': values, 'reverse': reverse}
+
+
+
+
+#lets the client pick the pagination style per request:  ?pagination=cursor  (or any request that carries a cursor) uses keyset pagination, everything else uses default_pagination_class
+class SelectablePagination(BasePagination):
+    default_pagination_class = DefaultPagination
+    keyset_pagination_class = KeysetPagination
+    pagination_query_param = 'pagination'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.paginator = self.get_paginator(request)
+        if self.paginator is None:
+            return None
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginator(self, request):
+        style = request.query_params.get(self.pagination_query_param)
+        if style == 'cursor' or self.keyset_pagination_class.cursor_query_param in request.query_params:
+            return self.keyset_pagination_class()
+        if self.default_pagination_class is None:
+            return None
+        return self.default_pagination_class()
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.default_pagination_class().get_paginated_response_schema(schema) if self.default_pagination_class else schema
+
+
+
+
+class OptionalKeysetPagination(SelectablePagination):    #not paginated unless the client asks for cursor pagination (keeps the old response shape for orders and reviews)
+    default_pagination_class = None
@@ -0,0 +1,100 @@
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+from django.conf import settings
+from django.db.models import Max
+from .caches import VERSION_PROMOTIONS, aget_validators, get_cache, get_timeout, get_versions
+from .models import Product
+
+
+#what a product costs: its unit_price less its best promotion (the biggest Promotion.discount, a fraction of the price) plus the tax
+#
+#    price = unit_price * (1 - discount)        price_with_tax = price * (1 + STORE_TAX_RATE)       both rounded to the cent
+#
+#the product list, the carts and the checkout all price their products here, many at a time: the prices are kept in the response cache
+#under the promotions version (store/caches.py), which every promotion write and every change to a product's promotions bumps...
+#a page of products is priced with one get_many, and one query for the promotions of the products missing from the cache
+
+
+Price = namedtuple('Price', ['unit_price', 'discount', 'price', 'price_with_tax'])
+
+CENT = Decimal('0.01')
+
+
+def get_tax_rate():
+    return Decimal(str(getattr(settings, 'STORE_TAX_RATE', '0.3')))
+
+
+def _price_key(version, product_id):
+    return f'store:price:{version}:{product_id}'
+
+
+def compute_price(unit_price, discount, tax=None):       #tax is 1 + the rate, pass it when pricing many products
+    tax = tax or 1 + get_tax_rate()
+    discount = min(max(Decimal(str(discount)), Decimal(0)), Decimal(1))     #the float of the promotion, as it reads
+    price = (unit_price * (1 - discount)).quantize(CENT, ROUND_HALF_UP)
+    return Price(unit_price, discount, price, (price * tax).quantize(CENT, ROUND_HALF_UP))
+
+
+def best_discounts(product_ids):
+    #{'product_id': 1, 'discount': 0.25} rows of the best promotion of every product that has one, one query
+    return Product.promotions.through.objects \
+        .filter(product_id__in=product_ids) \
+        .values('product_id') \
+        .annotate(discount=Max('promotion__discount'))
+
+
+def get_prices(products):
+    #[(product_id, unit_price), ...] -> {product_id: Price}
+    products = dict(products)
+    if not products:
+        return {}
+    cache = get_cache()
+    version = get_versions(VERSION_PROMOTIONS)[VERSION_PROMOTIONS]
+    prices, missing = from_cache(products, version, cache.get_many([_price_key(version, product_id) for product_id in products]))
+    if missing:
+        discounts = {row['product_id']: row['discount'] for row in best_discounts(missing)}
+        tax = 1 + get_tax_rate()
+        new = {product_id: compute_price(products[product_id], discounts.get(product_id, 0), tax) for product_id in missing}
+        cache.set_many({_price_key(version, product_id): price for product_id, price in new.items()}, get_timeout())
+        prices.update(new)
+    return prices
+
+
+async def aget_prices(products):       #get_prices for the async views
+    products = dict(products)
+    if not products:
+        return {}
+    cache = get_cache()
+    versions, _ = await aget_validators(VERSION_PROMOTIONS)
+    version = versions[VERSION_PROMOTIONS]
+    prices, missing = from_cache(products, version, await cache.aget_many([_price_key(version, product_id) for product_id in products]))
+    if missing:
+        discounts = {row['product_id']: row['discount'] async for row in best_discounts(missing).aiterator()}
+        tax = 1 + get_tax_rate()
+        new = {product_id: compute_price(products[product_id], discounts.get(product_id, 0), tax) for product_id in missing}
+        await cache.aset_many({_price_key(version, product_id): price for product_id, price in new.items()}, get_timeout())
+        prices.update(new)
+    return prices
+
+
+def from_cache(products, version, found):
+    prices, missing = {}, []
+    tax = 1 + get_tax_rate()
+    for product_id, unit_price in products.items():
+        price = found.get(_price_key(version, product_id))
+        if price is None:
+            missing.append(product_id)
+        elif price.unit_price != unit_price:        #the product's price changed since, its promotion didn't
+            prices[product_id] = compute_price(unit_price, price.discount, tax)
+        else:
+            prices[product_id] = price
+    return prices, missing
+
+
+def price_products(context, products):
+    #the prices of the products in a serializer context, shared by the nested serializers... only the ones not priced yet are looked up
+    prices = context.setdefault('prices', {})
+    missing = [(product_id, unit_price) for product_id, unit_price in products if product_id not in prices]
+    if missing:
+        prices.update(get_prices(missing))
+    return prices
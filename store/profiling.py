@@ -0,0 +1,356 @@
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from rest_framework import serializers
+from .caches import bump_version, get_cache, get_versions
+from .fast_serializers import FastSerializer
+
+
+#sampling profiler for the api... a sampled request records its sql count, sql time, serializer time and total time per view,
+#plus the queries it ran more than once (an N+1 looks like the same query with different ids)
+#the other requests only pay for one random() call, so it can stay on in production at a 1% sample rate
+#
+#every process keeps its own aggregates and copies them to the cache, the 'profiling_report' command and the /store/profiling/ endpoint merge them
+#a reset bumps the 'profiling' version counter (store/caches.py): every process sees it on its next sample and starts over,
+#and the snapshots are stored under the version, so one written by a process that didn't see the reset yet is never read
+
+
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]     #upper bounds of the latency histogram buckets (the last bucket is everything slower)
+MAX_FINGERPRINTS = 20        #duplicate query fingerprints kept per view
+VERSION_PROFILING = 'profiling'     #bumped by reset_report
+SNAPSHOT_TIMEOUT = 60 * 60 * 24
+
+
+def get_setting(name, default):
+    return getattr(settings, f'STORE_PROFILING_{name}', default)
+
+
+_current = ContextVar('store_profile', default=None)
+
+
+NUMBER_RE = re.compile(r'\b\d+(\.\d+)?\b')
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+IN_LIST_RE = re.compile(r'IN \((?:\?|%s)(?:, ?(?:\?|%s))*\)')
+
+
+def fingerprint(sql):
+    #'SELECT ... WHERE id = 5' and 'SELECT ... WHERE id = 6' are the same query
+    sql = STRING_RE.sub('?', sql)
+    sql = NUMBER_RE.sub('?', sql)
+    return IN_LIST_RE.sub('IN (...)', sql)
+
+
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.view = None
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.fingerprints = {}
+
+    def __call__(self, execute, sql, params, many, context):    #connection.execute_wrapper hook
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - started
+            self.sql_count += 1
+            key = fingerprint(sql)
+            self.fingerprints[key] = self.fingerprints.get(key, 0) + 1
+
+
+
+
+#under asgi the queries run on the orm's thread, not in the middleware, so every connection gets a hook that sends them to the profile of the current request (if it is sampled)
+def profile_sql(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    return profile(execute, sql, params, many, context)
+
+
+def add_sql_hook(connection, **kwargs):
+    if profile_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, profile_sql)
+
+
+def install_sql_hooks():
+    connection_created.connect(add_sql_hook, dispatch_uid='store.profiling.add_sql_hook')
+    for connection in connections.all(initialized_only=True):
+        add_sql_hook(connection)
+
+
+
+
+#serializer time is the time spent in Serializer.data (the outermost one, nested serializers are part of it)
+#the patch is installed once and only measures while a sampled request is running
+_original_data = {}
+
+
+def _timed_data(cls):
+    original = _original_data[cls]
+
+    def data(self):
+        profile = _current.get()
+        if profile is None:
+            return original.fget(self)
+        profile.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return original.fget(self)
+        finally:
+            profile.serializer_depth -= 1
+            if profile.serializer_depth == 0:
+                profile.serializer_time += time.perf_counter() - started
+    return property(data)
+
+
+def install_serializer_timing():
+    for cls in [serializers.Serializer, serializers.ListSerializer, FastSerializer]:
+        if cls not in _original_data:
+            _original_data[cls] = cls.__dict__['data']
+            cls.data = _timed_data(cls)
+
+
+
+
+def _slots_key(generation):       #how many processes have a snapshot in this generation
+    return f'store:profiling:{generation}:processes'
+
+
+def _snapshot_key(generation, slot):
+    return f'store:profiling:{generation}:{slot}'
+
+
+class Aggregates:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.generation = None
+        self.slot = None        #where this process keeps its snapshot in the generation
+
+    def add(self, profile, total_time):
+        total_ms = total_time * 1000
+        generation = get_versions(VERSION_PROFILING)[VERSION_PROFILING]
+        with self.lock:
+            if generation != self.generation:       #a reset (by any process) drops the old totals
+                self.views = {}
+                self.generation = generation
+                self.slot = None
+            view = self.views.setdefault(profile.view, new_view_stats())
+            view['requests'] += 1
+            view['sql_count'] += profile.sql_count
+            view['max_sql_count'] = max(view['max_sql_count'], profile.sql_count)
+            view['sql_ms'] += profile.sql_time * 1000
+            view['serializer_ms'] += profile.serializer_time * 1000
+            view['total_ms'] += total_ms
+            view['histogram'][bucket(total_ms)] += 1
+
+            duplicates = view['duplicates']
+            for key, count in profile.fingerprints.items():
+                if count < 2:
+                    continue
+                if key in duplicates or len(duplicates) < MAX_FINGERPRINTS:
+                    duplicate = duplicates.setdefault(key, {'requests': 0, 'max_repeats': 0})
+                    duplicate['requests'] += 1
+                    duplicate['max_repeats'] = max(duplicate['max_repeats'], count)
+            snapshot = {'views': self.views}
+            self.flush(snapshot)
+
+    def flush(self, snapshot):
+        cache = get_cache()
+        if self.slot is None:       #incr is atomic, processes starting together get slots of their own
+            cache.add(_slots_key(self.generation), 0, None)
+            self.slot = cache.incr(_slots_key(self.generation))
+        cache.set(_snapshot_key(self.generation, self.slot), snapshot, SNAPSHOT_TIMEOUT)
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.generation = None
+            self.slot = None
+
+
+def new_view_stats():
+    return {
+        'requests': 0,
+        'sql_count': 0,
+        'max_sql_count': 0,
+        'sql_ms': 0.0,
+        'serializer_ms': 0.0,
+        'total_ms': 0.0,
+        'histogram': [0] * (len(BUCKETS_MS) + 1),
+        'duplicates': {}
+    }
+
+
+def bucket(milliseconds):
+    for i, bound in enumerate(BUCKETS_MS):
+        if milliseconds <= bound:
+            return i
+    return len(BUCKETS_MS)
+
+
+aggregates = Aggregates()
+
+
+
+
+def get_snapshot_keys(cache):      #the snapshots of the current generation
+    generation = get_versions(VERSION_PROFILING)[VERSION_PROFILING]
+    return [_snapshot_key(generation, slot) for slot in range(1, (cache.get(_slots_key(generation)) or 0) + 1)], _slots_key(generation)
+
+
+def get_report():
+    #merges the aggregates of every process into one report per view
+    cache = get_cache()
+    keys, _ = get_snapshot_keys(cache)
+    snapshots = cache.get_many(keys)
+
+    views = {}
+    for snapshot in snapshots.values():
+        for name, stats in snapshot['views'].items():
+            merged = views.setdefault(name, new_view_stats())
+            for field in ['requests', 'sql_count', 'sql_ms', 'serializer_ms', 'total_ms']:
+                merged[field] += stats[field]
+            merged['max_sql_count'] = max(merged['max_sql_count'], stats['max_sql_count'])
+            merged['histogram'] = [a + b for a, b in zip(merged['histogram'], stats['histogram'])]
+            for key, duplicate in stats['duplicates'].items():
+                target = merged['duplicates'].setdefault(key, {'requests': 0, 'max_repeats': 0})
+                target['requests'] += duplicate['requests']
+                target['max_repeats'] = max(target['max_repeats'], duplicate['max_repeats'])
+
+    report = {}
+    for name, stats in sorted(views.items()):
+        requests = stats['requests'] or 1
+        report[name] = {
+            'requests': stats['requests'],
+            'avg_sql_count': round(stats['sql_count'] / requests, 2),
+            'max_sql_count': stats['max_sql_count'],
+            'avg_sql_ms': round(stats['sql_ms'] / requests, 2),
+            'avg_serializer_ms': round(stats['serializer_ms'] / requests, 2),
+            'avg_total_ms': round(stats['total_ms'] / requests, 2),
+            'p50_ms': percentile(stats['histogram'], 0.50),
+            'p95_ms': percentile(stats['histogram'], 0.95),
+            'histogram': {label: count for label, count in zip(bucket_labels(), stats['histogram'])},
+            'duplicate_queries': [
+                {'sql': key, **duplicate}
+                for key, duplicate in sorted(stats['duplicates'].items(), key=lambda item: -item[1]['max_repeats'])
+            ]
+        }
+    return report
+
+
+def percentile(histogram, fraction):
+    #upper bound of the bucket the percentile falls in (None when it is in the last, open ended, bucket)
+    total = sum(histogram)
+    if not total:
+        return None
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= total * fraction:
+            return BUCKETS_MS[i] if i < len(BUCKETS_MS) else None
+    return None
+
+
+def bucket_labels():
+    return [f'<={bound}ms' for bound in BUCKETS_MS] + [f'>{BUCKETS_MS[-1]}ms']
+
+
+def reset_report():
+    cache = get_cache()
+    keys, slots_key = get_snapshot_keys(cache)
+    bump_version(VERSION_PROFILING)     #the other processes drop their totals on their next sample
+    cache.delete_many([*keys, slots_key])
+    aggregates.reset()
+
+
+
+
+class ProfilingMiddleware:
+    #add 'store.profiling.ProfilingMiddleware' to MIDDLEWARE... STORE_PROFILING_SAMPLE_RATE is the fraction of requests that get profiled
+    #works under wsgi and asgi, a sync only middleware would push every async view (store/async_views.py) back onto a thread
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = get_setting('SAMPLE_RATE', 0.01)
+        self.path_prefix = get_setting('PATH_PREFIX', '/store/')
+        install_serializer_timing()
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+            install_sql_hooks()
+            self.process_view = self.aprocess_view      #a sync process_view would cost every async request a thread hop
+
+    def sampled(self, request):
+        return request.path.startswith(self.path_prefix) and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.sampled(request):
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        request._store_profile = profile
+        token = _current.set(profile)
+        try:
+            with connections['default'].execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        if profile.view is not None:
+            aggregates.add(profile, time.perf_counter() - profile.started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled(request):
+            return await self.get_response(request)
+
+        profile = RequestProfile()
+        request._store_profile = profile
+        token = _current.set(profile)       #the orm runs the queries on another thread, the hook of that thread's connection finds the profile through the context
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        if profile.view is not None:
+            await sync_to_async(aggregates.add)(profile, time.perf_counter() - profile.started)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        self.set_view(request, view_func)
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        self.set_view(request, view_func)
+
+    def set_view(self, request, view_func):
+        profile = getattr(request, '_store_profile', None)
+        if profile is not None:
+            profile.view = view_name(request, view_func)
+
+
+def view_name(request, view_func):
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        view_class = getattr(view_func, 'view_class', None)     #django class based views (store/async_views.py)
+        if view_class is not None:
+            return f'{view_class.__name__}.{request.method.lower()}'
+        return f'{view_func.__module__}.{view_func.__name__}'
+    actions = getattr(view_func, 'actions', None) or {}     #viewsets map the http method to an action
+    return f'{cls.__name__}.{actions.get(request.method.lower(), request.method.lower())}'
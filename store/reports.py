@@ -0,0 +1,165 @@
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, Max, Min, Sum, When
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import Collection, DailyCollectionSales, DailyProductSales, DailySales, Order, OrderItem, Product
+
+
+#sales reports (revenue, units and orders per day, collection or product) answered from daily rollups instead of SUM(quantity * unit_price) over the order items
+#
+#the rollups count the complete orders, on the day they were placed... the order handlers (store/signals/handlers.py) keep them up to date:
+#an order becoming complete adds its items with a few UPDATEs (record_sale), anything else that changes a complete order (refund, delete, admin edit)
+#recomputes its day from the orders (rebuild_rollups)... 'manage.py rebuild_sales_rollups' recomputes every day after bulk changes that skip the signals
+#
+#a sale is counted in the collection its product is in when the sale is recorded, the raw queries below use the product's collection of today
+
+
+GROUPS = ['day', 'collection', 'product']
+
+ROLLUP_SUMS = {'revenue': Sum('revenue'), 'units': Sum('units'), 'orders_count': Sum('orders_count')}
+RAW_SUMS = {
+    'revenue': Sum(F('quantity') * F('unit_price'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+    'units': Sum('quantity'),
+    'orders_count': Count('order_id', distinct=True),
+}
+SUM_NAMES = {f'sum_{name}': name for name in ROLLUP_SUMS}       #the annotations can't have the names of the rollup fields
+TITLES = {'collection': Collection, 'product': Product}
+
+
+def get_chunk_days():
+    return getattr(settings, 'STORE_REPORTS_CHUNK_DAYS', 31)
+
+
+def get_max_days():
+    return getattr(settings, 'STORE_REPORTS_MAX_DAYS', 366)
+
+
+def placed_between(start, end):
+    #the order items of the complete orders placed from the day start to the day end (included)... a range of placed_at
+    #(the index on placed_at works) rather than placed_at__date, which casts every row to a date
+    start, end = (timezone.make_aware(datetime.combine(day, time.min)) for day in [start, end + timedelta(days=1)])
+    return OrderItem.objects \
+        .filter(order__payment_status=Order.PAYMENT_STATUS_COMPLETE, order__placed_at__gte=start, order__placed_at__lt=end) \
+        .order_by()
+
+
+
+
+def record_sale(order_id, placed_at):
+    #an order became complete: its items are added to the rollups of its day, 7 queries whatever the number of items
+    day = timezone.localdate(placed_at)
+    products, collections = {}, {}       #id -> [revenue, units, orders]
+    for product_id, collection_id, quantity, unit_price in OrderItem.objects.filter(order_id=order_id).values_list('product_id', 'product__collection_id', 'quantity', 'unit_price'):
+        for sales, key in [(products, product_id), (collections, collection_id)]:
+            sold = sales.setdefault(key, [0, 0, 1])
+            sold[0] += quantity * unit_price
+            sold[1] += quantity
+    if not products:        #an order without items isn't a sale, like in rebuild_rollups
+        return
+
+    add_sales(DailySales, day, {None: [sum(sold[0] for sold in products.values()), sum(sold[1] for sold in products.values()), 1]})
+    add_sales(DailyCollectionSales, day, collections, 'collection_id')
+    add_sales(DailyProductSales, day, products, 'product_id')
+
+
+def add_sales(model, day, sales, field=None):
+    #inserts the missing rows of the day (ignore_conflicts: a concurrent sale may insert them too), then adds to all of them with one UPDATE
+    #UPDATE store_dailyproductsales SET revenue = CASE WHEN product_id = 1 THEN revenue + 20 WHEN ... END, units = ... WHERE day = ... AND product_id IN (...)
+    model.objects.bulk_create([model(day=day, **({field: key} if field else {})) for key in sales], ignore_conflicts=True)
+    rows = model.objects.filter(day=day)
+    if field is None:
+        revenue, units, orders = sales[None]
+        rows.update(revenue=F('revenue') + revenue, units=F('units') + units, orders_count=F('orders_count') + orders)
+        return
+
+    def added(column, index, **extra):
+        return Case(*[When(**{field: key}, then=F(column) + sold[index]) for key, sold in sales.items()], **extra)
+
+    rows.filter(**{f'{field}__in': sales}).update(
+        revenue=added('revenue', 0, output_field=DecimalField()), units=added('units', 1), orders_count=added('orders_count', 2))
+
+
+def rebuild_rollups(start, end):
+    #recomputes the rollups of the days from start to end (included) in one transaction... the database does the aggregation,
+    #one GROUP BY per rollup over the items of those days, and the rows are written with a few multi row INSERTs
+    items = placed_between(start, end)
+    day = TruncDate('order__placed_at')
+    with transaction.atomic():
+        days = [DailySales(**row) for row in items.values(day=day).annotate(**RAW_SUMS)]
+        collections = [DailyCollectionSales(**row) for row in items.values(day=day, collection_id=F('product__collection_id')).annotate(**RAW_SUMS)]
+        products = [DailyProductSales(**row) for row in items.values('product_id', day=day).annotate(**RAW_SUMS)]
+
+        for model, rows in [(DailySales, days), (DailyCollectionSales, collections), (DailyProductSales, products)]:
+            model.objects.filter(day__range=(start, end)).delete()
+            model.objects.bulk_create(rows, batch_size=1000)
+    return {'days': len(days), 'rows': len(days) + len(collections) + len(products)}
+
+
+def rebuild_all_rollups(chunk_days=None, progress=None):
+    #every day with an order, chunk_days days per transaction
+    chunk_days = chunk_days or get_chunk_days()
+    stats = {'chunks': 0, 'days': 0, 'rows': 0}
+    placed = Order.objects.aggregate(first=Min('placed_at'), last=Max('placed_at'))
+    if placed['first'] is None:
+        return stats
+    start, last = timezone.localdate(placed['first']), timezone.localdate(placed['last'])
+    while start <= last:
+        end = min(start + timedelta(days=chunk_days - 1), last)
+        rebuilt = rebuild_rollups(start, end)
+        stats['chunks'] += 1
+        stats['days'] += rebuilt['days']
+        stats['rows'] += rebuilt['rows']
+        start = end + timedelta(days=1)
+        if progress is not None:
+            progress(stats)
+    return stats
+
+
+
+
+def get_report(start, end, group_by='day', collection_id=None, limit=100, raw=False):
+    #{'totals': {...}, 'rows': [...]} of the days from start to end (included), 2 queries (3 with the titles of the collections/products)
+    #raw=True answers the same from the order items (what the rollups replace, for the benchmark and the tests)
+    totals, rows = (get_raw_querysets if raw else get_rollup_querysets)(start, end, group_by, collection_id)
+    sums = {f'sum_{name}': aggregate for name, aggregate in (RAW_SUMS if raw else ROLLUP_SUMS).items()}
+    rows = rows.annotate(**sums).order_by(*(['day'] if group_by == 'day' else ['-sum_revenue', f'{group_by}_id']))
+    rows = [rename_sums(row) for row in (rows if group_by == 'day' else rows[:limit])]
+    if group_by != 'day':       #the titles of the rows only, joining them in the GROUP BY costs more
+        titles = dict(TITLES[group_by].objects.filter(pk__in=[row[f'{group_by}_id'] for row in rows]).values_list('id', 'title'))
+        for row in rows:
+            row['title'] = titles.get(row[f'{group_by}_id'])
+    return {'totals': rename_sums(totals.aggregate(**sums)), 'rows': rows}
+
+
+def rename_sums(row):
+    return {SUM_NAMES.get(name, name): 0 if name in SUM_NAMES and value is None else value for name, value in row.items()}      #None when nothing was sold
+
+
+def get_rollup_querysets(start, end, group_by, collection_id):
+    days = DailySales.objects.filter(day__range=(start, end))
+    if collection_id is not None:
+        days = DailyCollectionSales.objects.filter(day__range=(start, end), collection_id=collection_id)
+    if group_by == 'day':
+        return days, days.values('day')
+    if group_by == 'collection':
+        collections = DailyCollectionSales.objects.filter(day__range=(start, end))
+        if collection_id is not None:
+            collections = collections.filter(collection_id=collection_id)
+        return days, collections.values('collection_id')
+    products = DailyProductSales.objects.filter(day__range=(start, end))
+    if collection_id is not None:
+        products = products.filter(product__collection_id=collection_id)
+    return days, products.values('product_id')
+
+
+def get_raw_querysets(start, end, group_by, collection_id):
+    items = placed_between(start, end)
+    if collection_id is not None:
+        items = items.filter(product__collection_id=collection_id)
+    if group_by == 'day':
+        return items, items.values(day=TruncDate('order__placed_at'))
+    if group_by == 'collection':
+        return items, items.values(collection_id=F('product__collection_id'))
+    return items, items.values('product_id')
@@ -0,0 +1,301 @@
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, When
+from django.db.models.expressions import RawSQL
+from django.db.utils import DatabaseError
+from rest_framework.filters import SearchFilter
+from .caches import bump_version, get_versions
+from .models import Product
+
+
+#full text search over product title/description
+#the filter backend runs 'WHERE id IN (<the matches of the index>)' instead of 'LIKE %term%' on every row, and orders the best
+#STORE_SEARCH_RANKED_RESULTS matches by relevance... every match is returned (count, last pages, exports), the ones past the ranked ones come after them in id order
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+VERSION_SEARCH = 'search'
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text or '')]
+
+
+def get_ranked_results():
+    return getattr(settings, 'STORE_SEARCH_RANKED_RESULTS', 200)
+
+
+class BaseSearchIndex:
+    def search(self, terms, limit=None):    #returns product ids, best match first (all of them without a limit)...every term has to match (the last one as a prefix so it works while the user is typing)
+        raise NotImplementedError
+
+    def filter(self, queryset, terms):      #the products matching the terms, all of them
+        return queryset.filter(pk__in=self.search(terms))
+
+    def update(self, product):
+        pass
+
+    def update_many(self, products):        #for the bulk writes that skip the signals (store/imports.py)
+        for product in products:
+            self.update(product)
+
+    def remove(self, product_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+
+
+#MySQL keeps a FULLTEXT index (added in migration 0014) up to date by itself, so update/remove have nothing to do
+class MySQLSearchIndex(BaseSearchIndex):
+    def search(self, terms, limit=None):
+        query = self.match_query(terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT id FROM store_product '
+                'WHERE MATCH(title, description) AGAINST (%s IN BOOLEAN MODE) '
+                'ORDER BY MATCH(title, description) AGAINST (%s IN BOOLEAN MODE) DESC, id' + (' LIMIT %s' if limit else ''),
+                [query, query, *([limit] if limit else [])])
+            return [row[0] for row in cursor.fetchall()]
+
+    def filter(self, queryset, terms):      #a subquery, the ids never come back to python
+        return queryset.filter(pk__in=RawSQL(
+            'SELECT id FROM store_product WHERE MATCH(title, description) AGAINST (%s IN BOOLEAN MODE)', [self.match_query(terms)]))
+
+    def match_query(self, terms):
+        return ' '.join(f'+{term}*' for term in terms)
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute('OPTIMIZE TABLE store_product')
+
+
+
+
+#SQLite keeps the tokens in the 'store_product_fts' FTS5 table (rowid = product id) which is maintained from the product signals
+class SQLiteSearchIndex(BaseSearchIndex):
+    table = 'store_product_fts'
+
+    def search(self, terms, limit=None):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s '
+                f'ORDER BY bm25({self.table}, 2.0, 1.0), rowid LIMIT %s',      #a match in the title counts twice as much as one in the description
+                [self.match_query(terms), limit or -1])       #-1 is no limit
+            return [row[0] for row in cursor.fetchall()]
+
+    def filter(self, queryset, terms):      #a subquery, the ids never come back to python (and can't go over sqlite's limit of parameters)
+        return queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s', [self.match_query(terms)]))
+
+    def match_query(self, terms):
+        return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+    def update(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [product.pk])
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, description) VALUES (%s, %s, %s)',
+                [product.pk, product.title, product.description or ''])
+
+    def update_many(self, products):       #one DELETE and one INSERT per 300 products (sqlite allows 999 parameters on old versions)
+        with connection.cursor() as cursor:
+            for start in range(0, len(products), 300):
+                chunk = products[start:start + 300]
+                cursor.execute(f'DELETE FROM {self.table} WHERE rowid IN ({", ".join(["%s"] * len(chunk))})', [product.pk for product in chunk])
+                cursor.execute(
+                    f'INSERT INTO {self.table} (rowid, title, description) VALUES {", ".join(["(%s, %s, %s)"] * len(chunk))}',
+                    [value for product in chunk for value in [product.pk, product.title, product.description or '']])
+
+    def remove(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [product_id])
+
+    def rebuild(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, description) '
+                f'SELECT id, title, COALESCE(description, \'\') FROM store_product')
+
+
+
+
+#pure python fallback for databases without a native full text index
+#the inverted index lives in the process memory... writes made by other processes bump the 'search' version counter (store/caches.py) and the index is reloaded on the next search
+class PythonSearchIndex(BaseSearchIndex):
+    title_weight = 2
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = None
+        self.postings = None    #token -> {product_id: weighted term frequency}
+        self.tokens = []        #sorted vocabulary for prefix lookups
+        self.documents = {}     #product_id -> tokens of that product (to remove its postings on update)
+
+    def search(self, terms, limit=None):
+        with self.lock:
+            self.ensure_loaded()
+            scores = None
+            for i, term in enumerate(terms):
+                prefix = i == len(terms) - 1
+                term_scores = self.score(term, prefix)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {product_id: score + term_scores[product_id] for product_id, score in scores.items() if product_id in term_scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, _ in (ranked[:limit] if limit else ranked)]
+
+    def score(self, term, prefix):
+        if prefix:
+            start = bisect_left(self.tokens, term)
+            matches = []
+            for token in self.tokens[start:]:
+                if not token.startswith(term):
+                    break
+                matches.append(token)
+        else:
+            matches = [term] if term in self.postings else []
+
+        total = len(self.documents) or 1
+        scores = defaultdict(float)
+        for token in matches:
+            postings = self.postings[token]
+            idf = math.log(1 + total / len(postings))
+            for product_id, frequency in postings.items():
+                scores[product_id] += frequency * idf
+        return scores
+
+    def ensure_loaded(self):
+        version = get_versions(VERSION_SEARCH)[VERSION_SEARCH]
+        if self.postings is None or version != self.version:
+            self.load()
+            self.version = version
+
+    def load(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        for product_id, title, description in Product.objects.values_list('id', 'title', 'description').iterator(chunk_size=2000):
+            self.add(product_id, title, description)
+        self.tokens = sorted(self.postings)
+
+    def add(self, product_id, title, description):
+        frequencies = defaultdict(int)
+        for token in tokenize(title):
+            frequencies[token] += self.title_weight
+        for token in tokenize(description):
+            frequencies[token] += 1
+        for token, frequency in frequencies.items():
+            self.postings[token][product_id] = frequency
+        self.documents[product_id] = list(frequencies)
+
+    def discard(self, product_id):
+        for token in self.documents.pop(product_id, []):
+            postings = self.postings[token]
+            postings.pop(product_id, None)
+            if not postings:
+                del self.postings[token]
+
+    def update(self, product):
+        with self.lock:
+            if self.postings is None:     #nothing loaded yet, the first search will load everything
+                return
+            self.discard(product.pk)
+            self.add(product.pk, product.title, product.description)
+            self.tokens = sorted(self.postings)
+            self.version = self.next_version()
+
+    def update_many(self, products):        #one version bump for all of them
+        with self.lock:
+            if self.postings is None:
+                return
+            for product in products:
+                self.discard(product.pk)
+                self.add(product.pk, product.title, product.description)
+            self.tokens = sorted(self.postings)
+            self.version = self.next_version()
+
+    def remove(self, product_id):
+        with self.lock:
+            if self.postings is None:
+                return
+            self.discard(product_id)
+            self.tokens = sorted(self.postings)
+            self.version = self.next_version()
+
+    def next_version(self):
+        bump_version(VERSION_SEARCH)     #tells the other processes their index is stale
+        return get_versions(VERSION_SEARCH)[VERSION_SEARCH]
+
+    def rebuild(self):
+        with self.lock:
+            bump_version(VERSION_SEARCH)
+            self.postings = None
+
+
+
+
+SEARCH_BACKENDS = {
+    'mysql': MySQLSearchIndex,
+    'sqlite': SQLiteSearchIndex,
+    'python': PythonSearchIndex
+}
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index():
+    #STORE_SEARCH_BACKEND is 'auto' (pick the native index of the database if there is one) or one of SEARCH_BACKENDS
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            backend = getattr(settings, 'STORE_SEARCH_BACKEND', 'auto')
+            if backend == 'auto':
+                backend = connection.vendor if connection.vendor in SEARCH_BACKENDS and has_native_index() else 'python'
+            _search_index = SEARCH_BACKENDS[backend]()
+        return _search_index
+
+
+def has_native_index():
+    if connection.vendor != 'sqlite':
+        return True
+    return SQLiteSearchIndex.table in connection.introspection.table_names()    #FTS5 may not be compiled into this sqlite (see migration 0014)
+
+
+def reset_search_index():
+    global _search_index
+    with _search_index_lock:
+        _search_index = None
+
+
+
+
+#drop-in replacement for rest_framework's SearchFilter (same ?search= parameter)
+class FullTextSearchFilter(SearchFilter):
+    def filter_queryset(self, request, queryset, view):
+        terms = tokenize(request.query_params.get(self.search_param, ''))
+        if not terms:
+            return queryset
+
+        index = get_search_index()
+        try:
+            ranked_ids = index.search(terms, get_ranked_results())
+        except DatabaseError:       #the native index is missing (e.g. migrations not applied yet), search the old way
+            return super().filter_queryset(request, queryset, view)
+
+        queryset = index.filter(queryset, terms)
+        if not ranked_ids:
+            return queryset
+        ranking = Case(*[When(pk=product_id, then=rank) for rank, product_id in enumerate(ranked_ids)], default=len(ranked_ids), output_field=IntegerField())
+        #an annotation (never NULL, it has a default) instead of ordering by the expression, so the keyset pagination can continue after the rank of the last row
+        return queryset.annotate(search_rank=ranking).order_by('search_rank', 'pk')     #OrderingFilter still wins when the client asks for an ordering
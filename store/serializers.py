@@ -1,8 +1,12 @@
-from decimal import Decimal
+from datetime import timedelta
 from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
-from .models import CartItem, OrderItem, Product, Collection, Review, Cart, Customer, Order
-from .signals import order_created
+from .models import CartItem, CustomerHistory, CustomerProductHistory, OrderItem, Product, Collection, Review, Cart, Customer, Order
+from .checkout import place_order
+from .carts import MAX_QUANTITY, get_cart_store
+from .pricing import price_products
+from .reports import GROUPS, get_max_days
 
 
 
@@ -42,13 +46,24 @@ class CollectionSerializer(serializers.ModelSerializer):
 
 
 
+class PricedProductListSerializer(serializers.ListSerializer):     #prices all the products at once (store/pricing.py) before they are serialized one by one
+    def to_representation(self, data):
+        products = list(data.all() if hasattr(data, 'all') else data)
+        price_products(self.context, [(product.id, product.unit_price) for product in products])
+        return super().to_representation(products)
+
+
+
+
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
-        fields = ['id', 'title', 'slug', 'description', 'inventory', 'unit_price', 'price_with_tax', 'collection']
+        fields = ['id', 'title', 'slug', 'description', 'inventory', 'unit_price', 'price', 'price_with_tax', 'collection']
+        list_serializer_class = PricedProductListSerializer
     # id = serializers.IntegerField()
     # title = serializers.CharField(max_length=255)
     #price = serializers.DecimalField(max_digits=6, decimal_places=2, source='unit_price')
+    price = serializers.SerializerMethodField(method_name='get_price')        #unit_price less the best promotion
     price_with_tax = serializers.SerializerMethodField(method_name='calculate_tax')
     # collection = serializers.HyperlinkedRelatedField(
     #     queryset = Collection.objects.all(),
@@ -61,8 +76,11 @@ class ProductSerializer(serializers.ModelSerializer):
     # )
 
 
+    def get_price(self, product: Product):
+        return price_products(self.context, [(product.id, product.unit_price)])[product.id].price
+
     def calculate_tax(self, product: Product):
-        return product.unit_price * Decimal(1.3)
+        return price_products(self.context, [(product.id, product.unit_price)])[product.id].price_with_tax
     
 
 
@@ -90,6 +108,21 @@ class ProductSerializer(serializers.ModelSerializer):
 
 
 
+class ProductImportSerializer(serializers.Serializer):      #one row of the supplier feed (store/imports.py)... the collection and promotion ids are checked for a whole batch at once
+    sku = serializers.CharField(max_length=64)
+    title = serializers.CharField(max_length=255)
+    slug = serializers.SlugField(required=False, allow_blank=True)      #made from the title when it is missing
+    description = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    unit_price = serializers.DecimalField(max_digits=6, decimal_places=2, min_value=1)
+    inventory = serializers.IntegerField(min_value=0)
+    collection = serializers.IntegerField()
+    promotions = serializers.ListField(child=serializers.IntegerField(), required=False)     #replaces the product's promotions, left alone when the row has none
+
+
+
+
+
+
 class ReviewSerializer(serializers.ModelSerializer):
     class Meta:
         model = Review
@@ -125,13 +158,17 @@ class SimpleProductSerializer(serializers.ModelSerializer):
 class CartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
-        fields = ['id', 'product', 'quantity', 'total_price']
+        fields = ['id', 'product', 'quantity', 'price', 'total_price']
 
     product = SimpleProductSerializer()
+    price = serializers.SerializerMethodField(method_name='get_price')     #what the product costs with its promotion (store/pricing.py)
     total_price = serializers.SerializerMethodField(method_name='get_total_price')
 
+    def get_price(self, cartitem: CartItem):
+        return price_products(self.context, [(cartitem.product.id, cartitem.product.unit_price)])[cartitem.product.id].price
+
     def get_total_price(self, cartitem: CartItem):
-        return cartitem.quantity * cartitem.product.unit_price
+        return cartitem.quantity * self.get_price(cartitem)
     
 
 
@@ -149,7 +186,9 @@ class CartSerializer(serializers.ModelSerializer):
     total_price = serializers.SerializerMethodField(method_name='get_total_price')
 
     def get_total_price(self, cart: Cart):
-        return sum([item.quantity * item.product.unit_price for item in cart.items.all()])
+        items = cart.items.all()
+        prices = price_products(self.context, [(item.product.id, item.product.unit_price) for item in items])
+        return sum([item.quantity * prices[item.product.id].price for item in items])
     
 
 
@@ -177,13 +216,8 @@ class AddCartItemSerializer(serializers.ModelSerializer):
         quantity = self.validated_data['quantity']
         cart_id = self.context['cart_id']
 
-        try:
-            cart_item = CartItem.objects.get(cart_id = cart_id, product_id = product_id)
-            cart_item.quantity += quantity   #update
-            self.instance = cart_item.save()  #assign it to self.instance to match with the default implementation of save method(check it in ModelSerializer)
-
-        except CartItem.DoesNotExist:
-            self.instance =  CartItem.objects.create(cart_id = cart_id, **self.validated_data)    #create
+        #create or increase the quantity in one step, so concurrent adds of the same product can't race... the item comes back as a dict (store/carts.py)
+        self.instance = get_cart_store().add_item(cart_id, product_id, quantity)  #assign it to self.instance to match with the default implementation of save method(check it in ModelSerializer)
 
         return self.instance
         #the create and update methods are in the save method implementation and the creation and updation to the db is done in their implementation and then they return a product w/h is created or updated and that product is set to the self.instance of the save method
@@ -192,11 +226,38 @@ class AddCartItemSerializer(serializers.ModelSerializer):
 
 
 
+class CartItemQuantitySerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_QUANTITY)
+
+
+class BulkAddCartItemsSerializer(serializers.Serializer):     #{"items": [{"product_id": 1, "quantity": 2}, ...]}
+    items = CartItemQuantitySerializer(many=True, allow_empty=False)
+
+    def validate_items(self, items):
+        product_ids = {item['product_id'] for item in items}
+        existing = set(Product.objects.filter(pk__in = product_ids).order_by().values_list('pk', flat=True))    #all the product ids are checked with one query
+        missing = sorted(product_ids - existing)
+        if missing:
+            raise serializers.ValidationError(f'No products with the ids {missing} in the db')
+        return items
+
+    def save(self, **kwargs):
+        get_cart_store().add_items(self.context['cart_id'], [(item['product_id'], item['quantity']) for item in self.validated_data['items']])
+
+
+
+
+
 class UpdateCartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = ['quantity']
 
+    def update(self, instance, validated_data):     #the instance is an item dict from the cart store
+        quantity = validated_data.get('quantity', instance['quantity'])
+        return get_cart_store().update_item(self.context['cart_id'], instance['id'], quantity) or instance
+
 
 
 
@@ -221,6 +282,24 @@ class CustomerSerializer(serializers.ModelSerializer):
 
 
 
+class CustomerProductHistorySerializer(serializers.ModelSerializer):
+    title = serializers.CharField(source='product.title')
+
+    class Meta:
+        model = CustomerProductHistory
+        fields = ['product_id', 'title', 'quantity', 'spend']
+
+
+class CustomerHistorySerializer(serializers.ModelSerializer):      #served from the history table (store/history.py), not aggregated over the orders
+    top_products = CustomerProductHistorySerializer(many=True, read_only=True)
+
+    class Meta:
+        model = CustomerHistory
+        fields = ['customer_id', 'orders_count', 'paid_orders_count', 'lifetime_spend', 'last_order_at', 'top_products']
+
+
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
@@ -250,7 +329,7 @@ class CreateOrderSerializer(serializers.Serializer):
 
 
     def validate_cart_id(self, cart_id):
-        if not Cart.objects.filter(id = cart_id).exists():
+        if not get_cart_store().exists(cart_id):     #the cart may only be in the cache until it is checked out (store/carts.py)
             raise serializers.ValidationError('no cart with the given id is in the db')
         # if CartItem.objects.filter(cart_id = cart_id).count() == 0:
         #     raise serializers.ValidationError('the cart does not have items')
@@ -263,36 +342,34 @@ class CreateOrderSerializer(serializers.Serializer):
         # print(self.validated_data)
         # print(self.context['user_id'])
 
-        with transaction.atomic():     #we put it in a transaction b/c we've got three operations like creating an order in this 'save' function
-
-            customer = Customer.objects.get(user_id = self.context['user_id'])
-            order = Order.objects.create(customer = customer)     #here to just create an order without its items
+        #the whole checkout (locking the products, reserving the inventory, creating the order and its items, deleting the cart) runs in one transaction in store/checkout.py
+        #it raises InsufficientInventory (handled in OrderViewSet.create) when a product doesn't have enough inventory
+        return place_order(self.validated_data['cart_id'], self.context['user_id'], sender=self.__class__, customer_id=self.context.get('customer_id'))    #returning the order object to be used in the viewset 'create' method
 
-            
-            cart_items = CartItem.objects.select_related('product').filter(cart_id = self.validated_data['cart_id'])   #returns queryset
-
-            order_items = [ OrderItem(    #converting cart items to orderitems storing them in a list
-                order = order,
-                product = item.product,
-                quantity = item.quantity,
-                unit_price = item.product.unit_price
-            ) for item in cart_items ]    #to iterate over and evaluate      #this is list comprehension
-
-
-            OrderItem.objects.bulk_create(order_items)    #save the orderitems to db
+            #the idea is first we get a cart and we grap its cart items and then convert them to order items and save the order items to the order item table and then delete the cart
 
-            Cart.objects.filter(id = self.validated_data['cart_id']).delete()   #to delete the cart
 
-            order_created.send_robust(self.__class__, order=order)     #this is to fire the 'order_created' signal              # self.__class__ is the class of the current object(w/h is the class of the current serializer w/h is Order)         # order=order is the actual order created(w/h is one of the kwargs used in the receivers)
 
+class UpdateOrderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = ['payment_status']
 
-            return order  #returning the order object to be used in the viewset 'create' method
 
-            #the idea is first we get a cart and we grap its cart items and then convert them to order items and save the order items to the order item table and then delete the cart
 
 
+class SalesReportQuerySerializer(serializers.Serializer):      #the query string of reports/, by default the last 30 days per day
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    group_by = serializers.ChoiceField(choices=GROUPS, default='day')
+    collection_id = serializers.IntegerField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)      #rows of the collection and product reports, the best selling first
 
-class UpdateOrderSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Order
-        fields = ['payment_status']
\ No newline at end of file
+    def validate(self, data):
+        data['end'] = data.get('end') or timezone.localdate()
+        data['start'] = data.get('start') or data['end'] - timedelta(days=29)
+        if data['start'] > data['end']:
+            raise serializers.ValidationError({'start': 'start has to be before end'})
+        if (data['end'] - data['start']).days >= get_max_days():
+            raise serializers.ValidationError({'start': f'at most {get_max_days()} days per report'})
+        return data
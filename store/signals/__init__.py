@@ -1,4 +1,24 @@
 from django.dispatch import Signal
 
 
-order_created = Signal()    #creating a signal
\ No newline at end of file
+#a signal delivered through the outbox (store/outbox.py)... it keeps its receivers in a registry of its own as well, so the dispatcher
+#can call and time them one by one without django's private receiver lookup... connect to it with @receiver as usual
+#the registry holds the receivers strongly (weak=False): they are module level functions, disconnect them to drop them
+class OutboxSignal(Signal):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.registry = {}      #(dispatch_uid or id(receiver), id(sender)) -> (receiver, sender)
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
+        super().connect(receiver, sender, weak, dispatch_uid)
+        self.registry.setdefault((dispatch_uid or id(receiver), id(sender)), (receiver, sender))
+
+    def disconnect(self, receiver=None, sender=None, dispatch_uid=None):
+        self.registry.pop((dispatch_uid or id(receiver), id(sender)), None)
+        return super().disconnect(receiver, sender, dispatch_uid)
+
+    def receivers_for(self, sender):
+        return [receiver for receiver, receiver_sender in self.registry.values() if receiver_sender is None or receiver_sender is sender]
+
+
+order_created = OutboxSignal()    #creating a signal
\ No newline at end of file
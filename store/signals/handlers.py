@@ -1,7 +1,13 @@
 from django.conf import settings
 from django.dispatch import receiver
-from django.db.models.signals import post_save
-from store.models import Customer
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_save, m2m_changed
+from django.utils import timezone
+from store.caches import VERSION_COLLECTIONS, VERSION_PRODUCTS, VERSION_PROMOTIONS, bump_version, collection_version, now_and_on_commit, review_version
+from store.history import rebuild_history, record_order, record_payment
+from store.models import Collection, Customer, Order, Product, Promotion, Review
+from store.reports import rebuild_rollups, record_sale
+from store.search import get_search_index
 
 
 #here we are receiving and handling a signal that is sent or fired from the User class(the custom user) through its serializer(specifically the UserCreateSerializer since it is a post save signal w/h is a signal sent after a user is created)
@@ -14,4 +20,124 @@ def create_customer_for_new_user(sender, **kwargs):     #signal handler method
 
 
 #sender is the class that sends or fires the signal(through its serializer actually)
-#sender is a class
\ No newline at end of file
+#sender is a class
+
+
+
+#the handlers below keep the response cache (store/caches.py) fresh by bumping the version counters the cached responses were stored under...
+#now and again after the commit of the write (now_and_on_commit)
+@receiver(pre_save, sender=Product)
+def remember_old_collection(sender, instance, **kwargs):
+    if instance.pk is not None:     #when a product moves to another collection, the old collection's pages are stale too
+        #locked until Product.save commits, so a concurrent move of the same product waits and reads the collection this one leaves it in
+        instance._old_collection_id = Product.objects.select_for_update().filter(pk=instance.pk).values_list('collection_id', flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_cache(sender, instance, signal, **kwargs):
+    collection_ids = {instance.collection_id, getattr(instance, '_old_collection_id', None)} - {None}
+    names = [VERSION_PRODUCTS, *[collection_version(collection_id) for collection_id in collection_ids]]
+    if signal is post_delete or kwargs['created'] or len(collection_ids) > 1:      #the products_count of the collection list changed
+        names.append(VERSION_COLLECTIONS)
+    now_and_on_commit(bump_version, *names)
+
+
+@receiver(m2m_changed, sender=Product.promotions.through)
+def invalidate_product_promotions_cache(sender, **kwargs):
+    if kwargs['action'] in ['post_add', 'post_remove', 'post_clear']:
+        now_and_on_commit(bump_version, VERSION_PRODUCTS, VERSION_PROMOTIONS)
+
+
+@receiver([post_save, post_delete], sender=Collection)
+def invalidate_collection_cache(sender, instance, **kwargs):
+    now_and_on_commit(bump_version, collection_version(instance.pk), VERSION_COLLECTIONS)
+
+
+@receiver([post_save, post_delete], sender=Review)
+def invalidate_review_cache(sender, instance, **kwargs):
+    now_and_on_commit(bump_version, review_version(instance.product_id))
+
+
+@receiver([post_save, post_delete], sender=Promotion)
+def invalidate_promotion_cache(sender, instance, **kwargs):
+    now_and_on_commit(bump_version, VERSION_PROMOTIONS)     #the cached prices (store/pricing.py) are keyed by it
+
+
+
+
+#keeps the product search index (store/search.py) in step with the products table
+@receiver(post_save, sender=Product)
+def update_search_index(sender, instance, **kwargs):
+    get_search_index().update(instance)
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_search_index(sender, instance, **kwargs):
+    get_search_index().remove(instance.pk)
+
+
+
+
+#keeps Collection.products_count in step with the products... Product.save runs these in the same transaction as the insert/update and deletes always run in one
+@receiver(post_save, sender=Product)
+def update_products_count(sender, instance, created, **kwargs):
+    old_collection_id = getattr(instance, '_old_collection_id', None)
+    if created:
+        Collection.objects.filter(pk=instance.collection_id).update(products_count=F('products_count') + 1)
+    elif old_collection_id is not None and old_collection_id != instance.collection_id:     #the product moved to another collection
+        Collection.objects.filter(pk=old_collection_id).update(products_count=F('products_count') - 1)
+        Collection.objects.filter(pk=instance.collection_id).update(products_count=F('products_count') + 1)
+
+
+@receiver(post_delete, sender=Product)
+def decrease_products_count(sender, instance, **kwargs):
+    Collection.objects.filter(pk=instance.collection_id).update(products_count=F('products_count') - 1)
+
+
+
+
+#keeps the customers' order history (store/history.py) and the sales rollups (store/reports.py) in step with the orders... Order.save runs these in the same transaction as the insert/update
+@receiver(pre_save, sender=Order)
+def remember_old_order(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._old_order = Order.objects.filter(pk=instance.pk).values_list('payment_status', 'customer_id').first()
+
+
+@receiver(post_save, sender=Order)
+def update_customer_history(sender, instance, created, **kwargs):
+    if created:
+        record_order(instance.customer_id, instance.placed_at)      #placed by the checkout, the items come after this (a pending order)
+        return
+    old = getattr(instance, '_old_order', None)
+    if old is None:
+        return
+    old_payment_status, old_customer_id = old
+    was_paid, is_paid = old_payment_status == Order.PAYMENT_STATUS_COMPLETE, instance.payment_status == Order.PAYMENT_STATUS_COMPLETE
+    if old_customer_id != instance.customer_id or (was_paid and not is_paid):
+        rebuild_history({old_customer_id, instance.customer_id})
+    elif is_paid and not was_paid:
+        record_payment(instance.pk, instance.customer_id)
+
+
+@receiver(post_delete, sender=Order)
+def remove_from_customer_history(sender, instance, **kwargs):
+    rebuild_history([instance.customer_id])
+
+
+@receiver(post_save, sender=Order)
+def update_sales_rollups(sender, instance, created, **kwargs):
+    old = getattr(instance, '_old_order', None)
+    was_paid = old is not None and old[0] == Order.PAYMENT_STATUS_COMPLETE
+    is_paid = instance.payment_status == Order.PAYMENT_STATUS_COMPLETE
+    if is_paid and not was_paid:
+        record_sale(instance.pk, instance.placed_at)
+    elif was_paid and not is_paid:
+        day = timezone.localdate(instance.placed_at)
+        rebuild_rollups(day, day)
+
+
+@receiver(post_delete, sender=Order)
+def remove_from_sales_rollups(sender, instance, **kwargs):
+    if instance.payment_status == Order.PAYMENT_STATUS_COMPLETE:
+        day = timezone.localdate(instance.placed_at)
+        rebuild_rollups(day, day)
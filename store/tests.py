@@ -1,3 +1,903 @@
-from django.test import TestCase
+import json
+import uuid
+from io import StringIO
+from datetime import timedelta
+from decimal import Decimal
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.urls import include, path
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from . import async_views, urls as store_urls
+from .exports import prepared
+from .carts import get_cart_store, purge_abandoned_carts, reset_cart_store
+from .checkout import place_order
+from .history import get_history, rebuild_all_history
+from .pricing import get_prices
+from .profiling import Aggregates, RequestProfile, get_report as get_profiling_report, reset_report
+from .outbox import OutboxDispatcher, dispatch_pending, enqueue, get_metrics, next_retry, reset_metrics
+from .models import Cart, CartItem, Collection, Customer, DailyProductSales, Order, OrderItem, OutboxEvent, Product, Promotion, Review
+from .reports import get_report, rebuild_all_rollups
+from .search import reset_search_index
+from .signals import OutboxSignal
+from .fast_serializers import FastCartSerializer, FastProductSerializer
+from .serializers import CartSerializer, CustomerHistorySerializer, ProductSerializer
 
 # Create your tests here.
+
+
+#query count regression harness... every endpoint gets a fixed query budget and has to keep it when the page grows
+class QueryCountTestCase(TestCase):
+    def setUp(self):
+        cache.clear()       #the catalog responses are cached (store/caches.py)
+        self.client = APIClient()
+        self.collection = Collection.objects.create(title='collection')
+        self.products = [
+            Product.objects.create(title=f'product {i}', slug='product', unit_price=10 + i, inventory=100, collection=self.collection)
+            for i in range(3)
+        ]
+
+    def create_user(self, username, is_staff=False):
+        return get_user_model().objects.create(username=username, email=f'{username}@example.com', is_staff=is_staff)   #the post_save handler creates its customer
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url, add_rows, budget):
+        #the query count has to stay the same after add_rows() adds more data to the page
+        before = self.count_queries(url)
+        add_rows()
+        after = self.count_queries(url)
+        self.assertEqual(before, after, f'{url} runs {before} queries before and {after} after adding rows (N+1)')
+        self.assertLessEqual(after, budget, f'{url} runs {after} queries, the budget is {budget}')
+
+
+
+
+class OrderQueryCountTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('customer')
+        self.customer = Customer.objects.get(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    def create_orders(self, count, customer=None):
+        for _ in range(count):
+            order = Order.objects.create(customer=customer or self.customer)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, quantity=1, unit_price=product.unit_price)
+                for product in self.products
+            ])
+
+    def test_order_list_query_count_does_not_grow_with_orders(self):
+        self.create_orders(1)
+        self.assertConstantQueries('/store/orders/', lambda: self.create_orders(20), budget=2)
+
+    def test_order_list_only_returns_the_customers_orders(self):
+        self.create_orders(2)
+        self.create_orders(3, customer=Customer.objects.get(user=self.create_user('other')))
+        response = self.client.get('/store/orders/')
+        self.assertEqual(len(response.data), 2)
+
+    def test_staff_order_list_query_count_does_not_grow_with_orders(self):
+        self.client.force_authenticate(self.create_user('staff', is_staff=True))
+        self.create_orders(1)
+        self.assertConstantQueries('/store/orders/', lambda: self.create_orders(20), budget=2)
+
+    def test_order_detail_query_count_does_not_grow_with_items(self):
+        self.create_orders(1)
+        order = Order.objects.get()
+
+        def add_items():
+            for i in range(10):
+                product = Product.objects.create(title=f'extra {i}', slug='extra', unit_price=5, inventory=10, collection=self.collection)
+                OrderItem.objects.create(order=order, product=product, quantity=2, unit_price=5)
+
+        self.assertConstantQueries(f'/store/orders/{order.id}/', add_items, budget=2)
+
+
+
+
+
+#the store urls with the async views in front, like STORE_ASYNC_VIEWS = True does (used as ROOT_URLCONF below)
+urlpatterns = [
+    path('store/', include(async_views.get_urlpatterns(store_urls.router.urls + store_urls.products_router.urls + store_urls.carts_router.urls) + store_urls.urlpatterns)),
+]
+
+
+class KeysetPaginationTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(8):      #ties on unit_price
+            Product.objects.create(title=f'tied {i}', slug='tied', unit_price=20 + i % 3, inventory=10, collection=self.collection)
+
+    def walk(self, url, link='next'):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.data)
+            ids += [product['id'] for product in response.data['results']]
+            url, pages = response.data[link], pages + 1
+        return ids, pages, response
+
+    def test_cursor_walks_every_row_once(self):
+        for ordering in ['unit_price', '-unit_price', 'title', '-id']:
+            expected = list(Product.objects.order_by(ordering, 'id').values_list('id', flat=True))       #the ties in id order, the primary key is added last
+            ids, pages, last = self.walk(f'/store/products/?pagination=cursor&page_size=3&ordering={ordering}')
+            self.assertEqual(ids, expected, ordering)
+            self.assertEqual(pages, 4)
+            self.assertNotIn('count', last.data)
+
+            back, _, _ = self.walk(last.data['previous'], 'previous')       #and back from the last page
+            self.assertEqual(back, [id for page in [expected[i:i + 3] for i in range(0, 9, 3)][::-1] for id in page])
+
+    def test_count_only_when_asked(self):
+        response = self.client.get('/store/products/?pagination=cursor&count=true')
+        self.assertEqual(response.data['count'], 11)
+
+    def test_orderings_that_cant_be_compared_are_rejected(self):
+        for ordering in ['description', 'collection']:      #nullable, a join
+            response = self.client.get(f'/store/products/?pagination=cursor&ordering={ordering}')
+            self.assertEqual(response.status_code, 400, ordering)
+            self.assertIn('ordering', response.data)
+        self.assertEqual(self.client.get('/store/products/?ordering=collection').status_code, 200)      #fine with page numbers
+
+    def test_invalid_cursors_are_rejected(self):
+        cursor = self.client.get('/store/products/?pagination=cursor&page_size=2&ordering=title').data['next'].split('cursor=')[1]
+        self.assertEqual(self.client.get(f'/store/products/?cursor={cursor}&page_size=2&ordering=title').status_code, 200)
+        self.assertEqual(self.client.get(f'/store/products/?cursor={cursor}&ordering=unit_price').status_code, 400)       #made for another ordering
+        self.assertEqual(self.client.get('/store/products/?cursor=not-a-cursor').status_code, 404)
+
+
+
+
+class SearchTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        Product.objects.create(title='lamp lamp', slug='lamp', description='lamp', unit_price=5, inventory=1, collection=self.collection)
+        for i in range(4):
+            Product.objects.create(title=f'desk {i}', slug='desk', description='with a lamp', unit_price=5, inventory=1, collection=self.collection)
+
+    def tearDown(self):
+        reset_search_index()
+
+    @override_settings(STORE_SEARCH_RANKED_RESULTS=2)
+    def test_every_match_is_returned_past_the_ranked_ones(self):
+        lamps = list(Product.objects.filter(description__contains='lamp').order_by('id').values_list('id', flat=True))
+        for backend in ['auto', 'python']:
+            with self.settings(STORE_SEARCH_BACKEND=backend):
+                reset_search_index()
+                cache.clear()
+                response = self.client.get('/store/products/?search=lam')
+                self.assertEqual(response.data['count'], 5, backend)
+                ids = [product['id'] for product in response.data['results']]
+                self.assertEqual(ids[0], lamps[0], backend)      #the best match first
+                self.assertEqual(sorted(ids), lamps, backend)
+                self.assertEqual(ids[2:], sorted(ids[2:]), backend)     #the ones past the ranked ones in id order
+
+    @override_settings(STORE_SEARCH_RANKED_RESULTS=3)
+    def test_cursor_pagination_follows_the_rank(self):
+        ranked = [product['id'] for product in self.client.get('/store/products/?search=lam').data['results']]
+        ids, url = [], '/store/products/?search=lam&pagination=cursor&page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.data)
+            ids += [product['id'] for product in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, ranked)
+        self.assertNotIn('search_rank', response.data['results'][0])
+        self.assertEqual(self.client.get('/store/products/?search=lam&pagination=cursor&ordering=title').status_code, 200)
+
+
+
+
+class ProductsCountTests(QueryCountTestCase):
+    def assertCounts(self, *counts):
+        self.assertEqual(list(Collection.objects.filter(id__gte=self.collection.id).order_by('id').values_list('products_count', flat=True)), list(counts))
+
+    def test_products_count_follows_the_products(self):
+        other = Collection.objects.create(title='other')
+        self.assertCounts(3, 0)
+        Product.objects.create(title='new', slug='new', unit_price=1, inventory=1, collection=other)
+        self.assertCounts(3, 1)
+
+        product = self.products[0]
+        product.collection = other
+        product.save()
+        self.assertCounts(2, 2)
+        product.title = 'renamed'       #not moved
+        product.save()
+        self.assertCounts(2, 2)
+
+        product.delete()
+        self.assertCounts(2, 1)
+        self.assertEqual(self.client.get(f'/store/collections/{other.id}/').data['products_count'], 1)
+
+    def test_rebuild_after_changes_that_skip_the_signals(self):
+        other = Collection.objects.create(title='other')
+        Product.objects.filter(pk=self.products[0].pk).update(collection=other)
+        Product.objects.bulk_create([Product(title='bulk', slug='bulk', unit_price=1, inventory=1, collection=other)])
+        self.assertCounts(3, 0)
+        self.assertEqual(Collection.objects.rebuild_products_count([other.id]), 1)
+        self.assertCounts(3, 2)
+        call_command('rebuild_products_count', stdout=StringIO())
+        self.assertCounts(2, 2)
+
+
+
+
+class CheckoutTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.create_user('customer'))
+        self.cart = Cart.objects.create()
+        CartItem.objects.create(cart=self.cart, product=self.products[0], quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.products[1], quantity=3)
+
+    def inventory(self):
+        return list(Product.objects.filter(pk__in=[product.pk for product in self.products]).order_by('id').values_list('inventory', flat=True))
+
+    def test_checkout_reserves_the_inventory(self):
+        response = self.client.post('/store/orders/', {'cart_id': self.cart.id})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(sorted((item['product']['id'], item['quantity']) for item in response.data['items']), [(self.products[0].id, 2), (self.products[1].id, 3)])
+        self.assertEqual(self.inventory(), [98, 97, 100])
+        self.assertFalse(Cart.objects.filter(pk=self.cart.pk).exists())
+
+    def test_shortages_are_a_409_and_nothing_changes(self):
+        Product.objects.filter(pk=self.products[1].pk).update(inventory=1)
+        response = self.client.post('/store/orders/', {'cart_id': self.cart.id})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['shortages'], [{'product_id': self.products[1].id, 'requested': 3, 'available': 1}])
+        self.assertEqual(self.inventory(), [100, 1, 100])
+        self.assertEqual(sorted(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity')), [(self.products[0].id, 2), (self.products[1].id, 3)])
+        self.assertFalse(Order.objects.exists())
+
+        self.products[1].inventory = 3
+        self.products[1].save()
+        self.assertEqual(self.client.post('/store/orders/', {'cart_id': self.cart.id}).status_code, 200)        #the same cart once there is enough
+        self.assertEqual(self.inventory(), [98, 0, 100])
+
+
+
+
+outbox_signal = OutboxSignal()      #enqueued as 'store.tests.outbox_signal'
+
+
+@override_settings(STORE_OUTBOX_MODE='sync', STORE_OUTBOX_RETRY_DELAY=60)
+class OutboxTests(TransactionTestCase):     #the events are delivered after the commit
+    def setUp(self):
+        reset_metrics()
+        self.calls = []
+
+    def connect(self, receiver):
+        outbox_signal.connect(receiver)
+        self.addCleanup(outbox_signal.disconnect, receiver)
+        return f'{receiver.__module__}.{receiver.__qualname__}'
+
+    def test_events_are_delivered_after_the_commit(self):
+        name = self.connect(lambda sender, value, **kwargs: self.calls.append(value))
+        with transaction.atomic():
+            enqueue('store.tests.outbox_signal', value=1)
+            self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, [1])
+        self.assertIsNotNone(OutboxEvent.objects.get().delivered_at)
+        self.assertEqual(get_metrics()['receivers'][name]['calls'], 1)
+
+    def test_failed_events_are_retried_after_their_backoff(self):
+        def fail(sender, **kwargs):
+            raise ValueError('down')
+        name = self.connect(fail)
+        enqueue('store.tests.outbox_signal', value=1)
+
+        event = OutboxEvent.objects.get()
+        self.assertIsNone(event.delivered_at)
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('ValueError', event.last_error)
+        self.assertEqual(get_metrics()['receivers'][name]['failures'], 1)
+        self.assertEqual(next_retry(), event.available_at)
+
+        dispatcher = OutboxDispatcher(1)        #drained, it waits for the retry instead of for a new event
+        dispatcher.schedule(next_retry())
+        self.assertAlmostEqual(dispatcher.timer.interval, 60, delta=5)
+        dispatcher.schedule(None)
+        self.assertIsNone(dispatcher.timer)
+        dispatcher.executor.shutdown()
+
+        OutboxEvent.objects.update(available_at=timezone.now())
+        outbox_signal.disconnect(fail)
+        self.connect(lambda sender, value, **kwargs: self.calls.append(value))
+        self.assertEqual(dispatch_pending(), 1)
+        self.assertEqual(self.calls, [1])
+        self.assertIsNone(next_retry())
+
+
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_report()
+
+    def sample(self, process, view='ProductViewSet.list'):
+        profile = RequestProfile()
+        profile.view = view
+        process.add(profile, 0.003)
+
+    def test_report_merges_the_processes_and_reset_clears_them_all(self):
+        first, second = Aggregates(), Aggregates()      #two worker processes sharing the cache
+        self.sample(first)
+        self.sample(second)
+        self.sample(second)
+        self.assertNotEqual(first.slot, second.slot)
+        self.assertEqual(get_profiling_report()['ProductViewSet.list']['requests'], 3)
+
+        reset_report()      #from a third process
+        self.assertEqual(get_profiling_report(), {})
+        first.flush({'views': first.views})     #a flush that started before the reset is stored under the old generation
+        self.assertEqual(get_profiling_report(), {})
+        self.sample(second)     #its old totals are dropped
+        self.assertEqual(get_profiling_report()['ProductViewSet.list']['requests'], 1)
+
+    def test_endpoint(self):
+        self.sample(Aggregates())
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.create(username='customer', email='customer@example.com'))
+        self.assertEqual(client.get('/store/profiling/').status_code, 403)
+
+        client.force_authenticate(get_user_model().objects.create(username='admin', email='admin@example.com', is_staff=True))
+        response = client.get('/store/profiling/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['ProductViewSet.list']['requests'], 1)
+        self.assertEqual(client.delete('/store/profiling/').status_code, 204)
+        self.assertEqual(client.get('/store/profiling/').data, {})
+
+
+
+
+class CartStoreTests(QueryCountTestCase):      #the cart endpoints through the cart store (store/carts.py)
+    backend = 'database'
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(STORE_CART_BACKEND=self.backend))
+        reset_cart_store()
+        self.addCleanup(reset_cart_store)
+
+    def create_cart(self):
+        response = self.client.post('/store/carts/')
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def add(self, cart_id, product, quantity):
+        return self.client.post(f'/store/carts/{cart_id}/items/', {'product_id': product.id, 'quantity': quantity})
+
+    def test_items_are_added_updated_and_removed(self):
+        cart_id = self.create_cart()
+        self.assertEqual(self.add(cart_id, self.products[0], 2).status_code, 201)
+        item = self.add(cart_id, self.products[0], 3).data       #the same product again, added to its quantity
+        self.assertEqual(item['quantity'], 5)
+        self.add(cart_id, self.products[1], 1)
+
+        cart = self.client.get(f'/store/carts/{cart_id}/').data
+        self.assertEqual([(item['product']['id'], item['quantity']) for item in cart['items']], [(self.products[0].id, 5), (self.products[1].id, 1)])
+        self.assertEqual(cart['total_price'], 5 * 10 + 11)
+
+        url = f'/store/carts/{cart_id}/items/{item["id"]}/'
+        self.assertEqual(self.client.patch(url, {'quantity': 1}).data['quantity'], 1)
+        self.assertEqual(self.client.get(url).data['quantity'], 1)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual([item['product']['id'] for item in self.client.get(f'/store/carts/{cart_id}/items/').data], [self.products[1].id])
+
+        self.assertEqual(self.client.delete(f'/store/carts/{cart_id}/').status_code, 204)
+        self.assertEqual(self.client.get(f'/store/carts/{cart_id}/').status_code, 404)
+        self.assertEqual(self.client.delete(f'/store/carts/{cart_id}/').status_code, 404)
+
+    def test_quantities_past_the_field_maximum_are_a_400(self):
+        cart_id = self.create_cart()
+        bulk = lambda *items: self.client.post(f'/store/carts/{cart_id}/items/bulk/', [{'product_id': product.id, 'quantity': quantity} for product, quantity in items], format='json')
+        self.assertEqual(bulk((self.products[0], 30000), (self.products[1], 1)).status_code, 200)
+        self.assertEqual(bulk((self.products[0], 2767)).status_code, 200)        #32767 exactly
+
+        response = bulk((self.products[1], 1), (self.products[0], 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['product_ids'], [self.products[0].id])
+        self.assertEqual(self.add(cart_id, self.products[0], 1).status_code, 400)
+        self.assertEqual(bulk((self.products[2], 20000), (self.products[2], 20000)).status_code, 400)     #the same product twice in one request
+        self.assertEqual([item['quantity'] for item in self.client.get(f'/store/carts/{cart_id}/').data['items']], [32767, 1])     #nothing was added
+
+    def test_malformed_and_missing_carts_are_404(self):
+        item_id = self.add(self.create_cart(), self.products[0], 1).data['id']
+        for cart_id in ['not-a-uuid', uuid.uuid4()]:
+            self.assertEqual(self.client.get(f'/store/carts/{cart_id}/').status_code, 404, cart_id)
+            self.assertEqual(self.client.delete(f'/store/carts/{cart_id}/').status_code, 404, cart_id)
+            self.assertEqual(self.add(cart_id, self.products[0], 1).status_code, 404, cart_id)
+            self.assertEqual(self.client.post(f'/store/carts/{cart_id}/items/bulk/', [{'product_id': self.products[0].id, 'quantity': 1}], format='json').status_code, 404, cart_id)
+            self.assertEqual(self.client.get(f'/store/carts/{cart_id}/items/{item_id}/').status_code, 404, cart_id)
+            self.assertEqual(self.client.patch(f'/store/carts/{cart_id}/items/{item_id}/', {'quantity': 2}).status_code, 404, cart_id)
+            self.assertEqual(self.client.delete(f'/store/carts/{cart_id}/items/{item_id}/').status_code, 404, cart_id)
+            self.assertEqual(self.client.get(f'/store/carts/{cart_id}/items/').data, [], cart_id)
+
+
+
+
+class CacheCartStoreApiTests(CartStoreTests):      #the same endpoints, with the carts in the cache
+    backend = 'cache'
+
+
+
+
+class CacheCartStoreTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(STORE_CART_BACKEND='cache'))
+        reset_cart_store()
+        self.addCleanup(reset_cart_store)
+        self.client.force_authenticate(self.create_user('customer'))
+
+    def create_cart(self, *items):
+        cart_id = self.client.post('/store/carts/').data['id']
+        for product, quantity in items:
+            self.client.post(f'/store/carts/{cart_id}/items/', {'product_id': product.id, 'quantity': quantity})
+        return cart_id
+
+    def test_a_cart_can_only_be_checked_out_once_at_a_time(self):
+        cart_id = self.create_cart((self.products[0], 1))
+        with transaction.atomic():
+            get_cart_store().persist(cart_id)       #a checkout of it is running
+            response = self.client.post('/store/orders/', {'cart_id': cart_id})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('cart_id', response.data)
+            transaction.set_rollback(True)      #and fails
+        get_cart_store().release(cart_id)
+        self.assertEqual(self.client.post('/store/orders/', {'cart_id': cart_id}).status_code, 200)
+
+    def test_a_failed_checkout_releases_the_cart(self):
+        cart_id = self.create_cart((self.products[0], 200))
+        self.assertEqual(self.client.post('/store/orders/', {'cart_id': cart_id}).status_code, 409)
+        self.client.patch(f'/store/carts/{cart_id}/items/1/', {'quantity': 100})
+        self.assertEqual(self.client.post('/store/orders/', {'cart_id': cart_id}).status_code, 200)
+
+    @override_settings(STORE_OUTBOX_MODE='worker')     #the callbacks wake the outbox too
+    def test_the_checkout_forgets_the_cart_after_the_commit(self):
+        cart_id = self.create_cart((self.products[0], 2), (self.products[1], 1))
+        self.assertEqual(self.client.patch(f'/store/carts/{cart_id}/items/1/', {'quantity': 3}).data['quantity'], 3)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/store/orders/', {'cart_id': cart_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(item['quantity'] for item in response.data['items']), [1, 3])
+        self.assertFalse(Cart.objects.filter(id=cart_id).exists())      #written to the tables and deleted by the checkout
+        self.assertIsNotNone(get_cart_store().load(cart_id))        #not committed yet, still in the cache
+
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(get_cart_store().load(cart_id))
+        self.assertEqual(self.client.get(f'/store/carts/{cart_id}/').status_code, 404)
+
+    def test_items_never_reach_the_tables_before_the_checkout(self):
+        cart_id = self.create_cart((self.products[0], 2))
+        self.client.post(f'/store/carts/{cart_id}/items/bulk/', [{'product_id': self.products[1].id, 'quantity': 1}], format='json')
+        self.assertFalse(Cart.objects.filter(id=cart_id).exists())
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual([item['quantity'] for item in self.client.get(f'/store/carts/{cart_id}/').data['items']], [2, 1])
+
+    def test_carts_in_the_tables_still_work(self):
+        cart = Cart.objects.create()        #created before switching to the cache store
+        item = CartItem.objects.create(cart=cart, product=self.products[0], quantity=1)
+        self.assertEqual(self.client.get(f'/store/carts/{cart.id}/').data['items'][0]['quantity'], 1)
+        self.assertEqual(self.client.post(f'/store/carts/{cart.id}/items/', {'product_id': self.products[1].id, 'quantity': 2}).status_code, 201)
+        self.assertEqual(self.client.patch(f'/store/carts/{cart.id}/items/{item.id}/', {'quantity': 3}).data['quantity'], 3)
+        response = self.client.post('/store/orders/', {'cart_id': cart.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(item['quantity'] for item in response.data['items']), [2, 3])
+        self.assertEqual(self.client.get(f'/store/carts/{cart.id}/').status_code, 404)
+
+
+
+
+class PurgeAbandonedCartsTests(QueryCountTestCase):
+    def create_carts(self, count, days_old):
+        carts = []
+        for i in range(count):
+            cart = Cart.objects.create()
+            CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=1) for product in self.products[:2]])
+            Cart.objects.filter(id=cart.id).update(created_at=timezone.now() - timedelta(days=days_old, minutes=i))     #auto_now_add, backdated
+            carts.append(cart.id)
+        return carts
+
+    def test_old_carts_are_deleted_in_batches(self):
+        self.create_carts(5, days_old=40)
+        recent = self.create_carts(2, days_old=10)
+        batches = []
+        stats = purge_abandoned_carts(days=30, batch_size=2, pause=0, progress=lambda stats: batches.append(dict(stats)))
+        self.assertEqual((stats['batches'], stats['carts'], stats['items']), (3, 5, 10))
+        self.assertEqual([batch['carts'] for batch in batches], [2, 4, 5])
+        self.assertEqual(sorted(Cart.objects.values_list('id', flat=True)), sorted(recent))
+        self.assertEqual(CartItem.objects.count(), 4)
+
+    def test_max_batches_stops_early_and_the_next_run_continues(self):
+        self.create_carts(5, days_old=40)
+        stats = purge_abandoned_carts(days=30, batch_size=2, pause=0, max_batches=1)
+        self.assertEqual((stats['batches'], stats['carts'], stats['items']), (1, 2, 4))
+        self.assertEqual(Cart.objects.count(), 3)
+        stats = purge_abandoned_carts(days=30, batch_size=2, pause=0)
+        self.assertEqual((stats['batches'], stats['carts']), (2, 3))
+        self.assertFalse(Cart.objects.exists())
+
+    def test_command(self):
+        self.create_carts(3, days_old=40)
+        self.create_carts(1, days_old=10)
+        out = StringIO()
+        call_command('purge_abandoned_carts', '--days', '30', '--dry-run', stdout=out)
+        self.assertIn('3 carts are older than 30 days', out.getvalue())
+        self.assertEqual(Cart.objects.count(), 4)
+
+        out = StringIO()
+        call_command('purge_abandoned_carts', '--days', '30', '--batch-size', '2', '--pause', '0', stdout=out)
+        self.assertIn('Deleted 3 carts and 6 items in 2 batches', out.getvalue())
+        self.assertEqual(Cart.objects.count(), 1)
+
+
+
+
+class FastSerializerTests(QueryCountTestCase):       #the fast serializers have to render exactly the json of the DRF ones
+    def assertSameJson(self, slow, fast):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(fast), renderer.render(slow))
+
+    def test_products_with_promotions(self):
+        promotions = [Promotion.objects.create(description='summer', discount=0.15), Promotion.objects.create(description='clearance', discount=0.4)]
+        self.products[0].promotions.add(promotions[0])
+        self.products[1].promotions.add(*promotions)
+        Product.objects.filter(id=self.products[2].id).update(description=None, unit_price=Decimal('9.99'))
+        products = Product.objects.filter(collection=self.collection).order_by('id')
+        slow = ProductSerializer(products, many=True).data
+        self.assertEqual([product['price'] for product in slow], [Decimal('8.50'), Decimal('6.60'), Decimal('9.99')])
+        self.assertSameJson(slow, FastProductSerializer(products, many=True).data)
+        self.assertSameJson(slow, FastProductSerializer(products.values(*FastProductSerializer.values_fields()), many=True).data)
+        self.assertSameJson(ProductSerializer(products[1]).data, FastProductSerializer(products[1]).data)
+
+    def test_empty_and_multi_item_carts(self):
+        empty, cart = Cart.objects.create(), Cart.objects.create()
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=i + 1) for i, product in enumerate(self.products)])
+        self.products[0].promotions.add(Promotion.objects.create(description='summer', discount=0.5))
+        carts = Cart.objects.filter(id__in=[empty.id, cart.id]).prefetch_related('items__product')
+        for loaded in carts:
+            slow = CartSerializer(loaded).data
+            self.assertSameJson(slow, FastCartSerializer(loaded).data)
+        self.assertSameJson(CartSerializer(carts, many=True).data, FastCartSerializer(carts, many=True).data)
+        self.assertEqual(CartSerializer(Cart.objects.get(id=empty.id)).data['items'], [])
+
+
+
+
+class ResponseCacheTests(QueryCountTestCase):
+    def test_responses_cached_before_the_commit_are_not_served_after_it(self):
+        url = f'/store/products/{self.products[0].id}/'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].save()
+            self.count_queries(url)     #a concurrent request may read the rows of before the commit here and cache them
+            self.assertEqual(self.count_queries(url), 0)
+        self.assertGreater(self.count_queries(url), 0)       #the versions were bumped again by the commit
+
+
+
+
+class AsyncViewTests(QueryCountTestCase):
+    def get_both(self, url, **extra):
+        cache.clear()
+        expected = self.client.get(url, **extra)
+        cache.clear()
+        with self.settings(ROOT_URLCONF='store.tests'), CaptureQueriesContext(connection) as context:
+            response = async_to_sync(self.async_client.get)(url, **extra)
+        return expected, response, len(context.captured_queries)
+
+    def test_async_views_return_the_same_responses_as_the_viewsets(self):
+        product = self.products[0]
+        Review.objects.create(product=product, name='name', description='description')
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=product, quantity=2)
+        urls = [
+            '/store/products/', '/store/products/?page=2', f'/store/products/?collection_id={self.collection.id}&unit_price__gt=10.5',
+            f'/store/products/{product.id}/', '/store/products/0/', '/store/collections/',
+            f'/store/products/{product.id}/reviews/', f'/store/carts/{cart.id}/', '/store/carts/not-a-cart/',
+        ]
+        for url in urls:
+            expected, response, _ = self.get_both(url)
+            self.assertEqual((response.status_code, response.content), (expected.status_code, expected.content), url)
+            self.assertEqual(response['Allow'], expected['Allow'], url)
+
+    def test_async_views_answer_the_etags_of_the_viewsets(self):
+        product = self.products[0]
+        for url in ['/store/products/', f'/store/products/{product.id}/', '/store/collections/', f'/store/products/{product.id}/reviews/']:
+            expected = self.client.get(url)
+            with self.settings(ROOT_URLCONF='store.tests'):
+                response = async_to_sync(self.async_client.get)(url, headers={'If-None-Match': expected['ETag']})
+            self.assertEqual((response.status_code, response['ETag']), (304, expected['ETag']), url)
+
+    def test_async_product_list_runs_three_queries(self):
+        _, response, queries = self.get_both('/store/products/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, 3)      #count, page and the promotions of the page (the price cache is empty)
+
+    def test_other_requests_go_to_the_viewsets(self):
+        for url in ['/store/products/?search=product', '/store/products/?ordering=-unit_price', '/store/products/?page=x']:
+            expected, response, _ = self.get_both(url)
+            self.assertEqual((response.status_code, response.content), (expected.status_code, expected.content), url)
+        with self.settings(ROOT_URLCONF='store.tests'):
+            response = async_to_sync(self.async_client.post)('/store/products/', {'title': 'x'})
+        self.assertEqual(response.status_code, 401)     #IsAdminOrReadOnly of the viewset
+
+
+
+
+class ExportTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('customer')
+        self.customer = Customer.objects.get(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    create_orders = OrderQueryCountTests.create_orders
+
+    def test_order_export_streams_the_list_in_chunks(self):
+        self.create_orders(5)
+        self.client.force_authenticate(self.create_user('staff', is_staff=True))
+        with self.settings(STORE_EXPORT_CHUNK_SIZE=2), CaptureQueriesContext(connection) as context:
+            response = self.client.get('/store/orders/export/')
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(context), 4)       #the orders (fetched 2 at a time) and the items of each of the 3 chunks
+        self.assertEqual([json.loads(line) for line in lines], self.client.get('/store/orders/').json())
+
+    def test_the_export_context_only_holds_the_prices_of_one_chunk(self):
+        for i in range(7):
+            Product.objects.create(title=f'more {i}', slug='more', unit_price=20 + i, inventory=5, collection=self.collection)
+        products = Product.objects.filter(collection=self.collection).order_by('pk')
+        serializer = FastProductSerializer(context={})
+        rows, priced = [], []
+        for product in prepared(products.values(*FastProductSerializer.values_fields()).iterator(chunk_size=3), serializer, 3):
+            rows.append(serializer.to_representation(product))
+            priced.append(len(serializer.context['prices']))
+        self.assertEqual(priced, [3] * 9 + [1])
+        self.assertEqual(rows, FastProductSerializer(products, many=True).data)
+
+    def test_export_needs_staff_or_the_view_permission(self):
+        self.assertEqual(self.client.get('/store/orders/export/').status_code, 403)
+        self.user.user_permissions.add(Permission.objects.get(codename='view_product'))
+        self.client.force_authenticate(get_user_model().objects.get(pk=self.user.pk))      #a fresh user, has_perm caches the permissions
+        response = self.client.get(f'/store/products/export/?output=csv&collection_id={self.collection.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 4)     #header and 3 products
+
+
+
+
+class ConditionalGetTests(QueryCountTestCase):
+    def assertNotModified(self, url, response):
+        with CaptureQueriesContext(connection) as context:
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304, url)
+        self.assertEqual(len(context), 0)       #from the version counters in the cache, nothing is read or serialized
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304, url)
+
+    def test_catalog_endpoints_answer_304_until_they_change(self):
+        product = self.products[0]
+        Review.objects.create(product=product, name='name', description='description')
+        urls = ['/store/products/', f'/store/products/{product.id}/', '/store/collections/', f'/store/collections/{self.collection.id}/', f'/store/products/{product.id}/reviews/']
+        responses = {url: self.client.get(url) for url in urls}
+        for url, response in responses.items():
+            self.assertNotModified(url, response)
+
+        Review.objects.create(product=product, name='other', description='description')
+        product.save()
+        for url in ['/store/products/', f'/store/products/{product.id}/', f'/store/collections/{self.collection.id}/', f'/store/products/{product.id}/reviews/']:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=responses[url]['ETag']).status_code, 200, url)
+        self.assertEqual(self.client.get('/store/collections/', HTTP_IF_NONE_MATCH=responses['/store/collections/']['ETag']).status_code, 304)      #the counts didn't change
+
+    def test_etag_depends_on_the_query(self):
+        first = self.client.get('/store/products/')
+        ordered = self.client.get('/store/products/?ordering=-unit_price', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(ordered.status_code, 200)
+        self.assertNotEqual(ordered['ETag'], first['ETag'])
+
+
+
+
+class ImportTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.staff = self.create_user('staff', is_staff=True)
+
+    def import_feed(self, feed, content_type='text/csv', user=None):
+        self.client.force_authenticate(user or self.staff)
+        return self.client.post('/store/products/import/', data=feed.encode(), content_type=content_type)
+
+    def test_import_creates_and_updates_products_by_sku(self):
+        promotion = Promotion.objects.create(description='promotion', discount=0.1)
+        other = Collection.objects.create(title='other')
+        with self.settings(STORE_IMPORT_BATCH_SIZE=2), CaptureQueriesContext(connection) as context:
+            response = self.import_feed(
+                'sku,title,unit_price,inventory,collection,promotions\n'
+                f'A1,bread,2.50,10,{self.collection.id},{promotion.id}\n'
+                f'A2,milk,1.20,5,{self.collection.id},\n'
+                f'A3,eggs,0,5,{self.collection.id},\n'
+                f'A4,tea,4,5,{self.collection.id},\n')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['invalid']), (3, 1))
+        self.assertEqual(response.data['errors'][0]['row'], 3)
+        self.assertLessEqual(len(context), 2 * 10)       #at most 10 queries per batch (savepoints included) whatever the size of the batch
+        self.assertEqual(Collection.objects.get(pk=self.collection.pk).products_count, 6)
+        self.assertEqual(list(Product.objects.get(sku='A1').promotions.all()), [promotion])
+
+        response = self.import_feed(f'{{"sku": "A1", "title": "rye bread", "unit_price": "3", "inventory": 8, "collection": {other.id}, "promotions": []}}\n', 'application/x-ndjson')
+        self.assertEqual((response.data['created'], response.data['updated']), (0, 1))
+        product = Product.objects.get(sku='A1')
+        self.assertEqual((product.title, product.slug, product.collection_id), ('rye bread', 'rye-bread', other.id))
+        self.assertFalse(product.promotions.exists())
+        self.assertEqual(Collection.objects.get(pk=self.collection.pk).products_count, 5)
+        self.assertEqual(Collection.objects.get(pk=other.pk).products_count, 1)
+
+    def test_import_is_for_admins_only(self):
+        feed = f'sku,title,unit_price,inventory,collection\nA1,bread,2.50,10,{self.collection.id}\n'
+        self.assertEqual(self.import_feed(feed, user=self.create_user('customer')).status_code, 403)
+        self.assertEqual(self.import_feed(feed, content_type='text/plain').status_code, 415)
+        self.assertFalse(Product.objects.filter(sku='A1').exists())
+
+
+
+
+class CustomerHistoryTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('customer')
+        self.customer = Customer.objects.get(user=self.user)
+
+    def place_order(self, quantities):
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=quantity) for product, quantity in zip(self.products, quantities) if quantity])
+        return place_order(cart.id, self.user.id)
+
+    def get_history(self):
+        return CustomerHistorySerializer(get_history(self.customer.pk)).data
+
+    def test_history_follows_the_orders(self):
+        order = self.place_order([1, 2])
+        self.place_order([3])
+        history = self.get_history()
+        self.assertEqual((history['orders_count'], history['paid_orders_count'], history['lifetime_spend'], history['top_products']), (2, 0, 0, []))
+
+        order.payment_status = Order.PAYMENT_STATUS_COMPLETE
+        order.save()
+        history = self.get_history()
+        self.assertEqual((history['paid_orders_count'], history['lifetime_spend']), (1, 32))       #10 + 2 * 11
+        self.assertEqual([(product['product_id'], product['quantity']) for product in history['top_products']], [(self.products[1].id, 2), (self.products[0].id, 1)])
+
+        rebuild_all_history(chunk_size=1)
+        self.assertEqual(self.get_history(), history)      #the backfill computes the same history
+
+        order.payment_status = Order.PAYMENT_STATUS_FAILED
+        order.save()
+        history = self.get_history()
+        self.assertEqual((history['orders_count'], history['paid_orders_count'], history['lifetime_spend'], history['top_products']), (2, 0, 0, []))
+
+    def test_history_endpoint_needs_the_permission(self):
+        self.place_order([1])
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(f'/store/customers/{self.customer.id}/history/').status_code, 403)
+
+        self.user.user_permissions.add(Permission.objects.get(codename='view_histroy'))
+        self.client.force_authenticate(get_user_model().objects.get(pk=self.user.pk))
+        response = self.client.get(f'/store/customers/{self.customer.id}/history/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['customer_id'], response.data['orders_count']), (self.customer.id, 1))
+        self.assertConstantQueries(f'/store/customers/{self.customer.id}/history/', lambda: self.place_order([1, 1, 1]), budget=3)     #the customer, its history and top products
+
+
+
+
+class SalesReportTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('customer')
+        self.other = Collection.objects.create(title='other')
+        self.products.append(Product.objects.create(title='other product', slug='other', unit_price=20, inventory=100, collection=self.other))
+        self.today = timezone.localdate()
+
+    place_order = CustomerHistoryTests.place_order
+
+    def pay(self, order, payment_status=Order.PAYMENT_STATUS_COMPLETE):
+        order.payment_status = payment_status
+        order.save()
+
+    def assertReportsMatchTheOrders(self):
+        for group_by in ['day', 'collection', 'product']:
+            for collection_id in [None, self.collection.id]:
+                expected = get_report(self.today, self.today, group_by, collection_id, raw=True)
+                self.assertEqual(get_report(self.today, self.today, group_by, collection_id), expected, (group_by, collection_id))
+
+    def test_rollups_follow_the_payments(self):
+        orders = [self.place_order([1, 2, 0, 1]), self.place_order([3, 0, 0, 2]), self.place_order([1])]
+        self.pay(orders[0])
+        self.pay(orders[1])
+        report = get_report(self.today, self.today, 'collection')
+        self.assertEqual(report['totals'], {'revenue': 122, 'units': 9, 'orders_count': 2})      #(10 + 2 * 11 + 20) + (3 * 10 + 2 * 20)
+        self.assertEqual([(row['title'], row['orders_count']) for row in report['rows']], [('collection', 2), ('other', 2)])       #62 and 60
+        self.assertReportsMatchTheOrders()
+
+        self.pay(orders[1], Order.PAYMENT_STATUS_FAILED)
+        self.assertEqual(get_report(self.today, self.today)['totals']['orders_count'], 1)
+        self.assertReportsMatchTheOrders()
+
+        DailyProductSales.objects.all().delete()
+        self.assertEqual(rebuild_all_rollups()['days'], 1)
+        self.assertReportsMatchTheOrders()
+
+    def test_reports_endpoint_is_for_admins_only(self):
+        self.pay(self.place_order([1]))
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/store/reports/').status_code, 403)
+
+        self.client.force_authenticate(self.create_user('staff', is_staff=True))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/store/reports/?group_by=product&limit=1')
+            self.assertEqual(len(context), 3)       #the totals, the rows and their titles
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['start'], response.data['end']), (self.today - timedelta(days=29), self.today))
+        self.assertEqual([row['product_id'] for row in response.data['rows']], [self.products[0].id])
+        self.assertEqual(self.client.get(f'/store/reports/?start={self.today}&end={self.today - timedelta(days=1)}').status_code, 400)
+
+
+
+
+
+class PricingTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = self.products[0]       #10
+        self.product.promotions.add(Promotion.objects.create(description='small', discount=0.1), Promotion.objects.create(description='big', discount=0.25))
+        self.user = self.create_user('customer')
+
+    def test_best_promotion_and_tax_are_applied(self):
+        prices = get_prices([(product.id, product.unit_price) for product in self.products])
+        self.assertEqual(prices[self.product.id], (10, Decimal('0.25'), Decimal('7.50'), Decimal('9.75')))
+        self.assertEqual((prices[self.products[1].id].price, prices[self.products[1].id].price_with_tax), (Decimal('11.00'), Decimal('14.30')))
+
+        response = self.client.get(f'/store/products/?collection_id={self.collection.id}')
+        self.assertEqual([(product['price'], product['price_with_tax']) for product in response.data['results']][0], (Decimal('7.50'), Decimal('9.75')))
+        self.assertEqual(ProductSerializer(Product.objects.filter(pk=self.product.pk), many=True).data[0]['price'], Decimal('7.50'))
+
+    def test_prices_are_cached_until_the_promotions_change(self):
+        get_prices([(self.product.id, self.product.unit_price)])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_prices([(self.product.id, Decimal(20))])[self.product.id].price, Decimal('15.00'))     #a new unit_price, the same promotion
+
+        Promotion.objects.filter(description='big').update(discount=0.5)     #no signal, the cached price stays
+        self.assertEqual(get_prices([(self.product.id, self.product.unit_price)])[self.product.id].price, Decimal('7.50'))
+        Promotion.objects.get(description='big').save()
+        self.assertEqual(get_prices([(self.product.id, self.product.unit_price)])[self.product.id].price, Decimal('5.00'))
+        self.product.promotions.clear()
+        self.assertEqual(get_prices([(self.product.id, self.product.unit_price)])[self.product.id].price, Decimal('10.00'))
+
+    def test_cart_and_order_use_the_promotion_price(self):
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        CartItem.objects.create(cart=cart, product=self.products[1], quantity=1)
+        response = self.client.get(f'/store/carts/{cart.id}/')
+        self.assertEqual([item['price'] for item in response.data['items']], [Decimal('7.50'), Decimal('11.00')])
+        self.assertEqual(response.data['total_price'], Decimal('26.00'))
+        self.assertEqual(CartSerializer(Cart.objects.get(pk=cart.pk)).data['total_price'], Decimal('26.00'))
+
+        order = place_order(cart.id, self.user.id)
+        self.assertEqual(sorted(order.items.values_list('unit_price', flat=True)), [Decimal('7.50'), Decimal('11.00')])
@@ -1,5 +1,6 @@
+from django.conf import settings
 from django.urls import path, include
-from . import views
+from . import async_views, views
 #from rest_framework.routers import SimpleRouter, DefaultRouter
 from rest_framework_nested import routers
 
@@ -38,11 +39,16 @@ carts_router.register('items', views.CartItemViewSet, basename='cart-items')
 urlpatterns = [
     path('', include(router.urls)),       #'include' to import routes from somewhere else
     path('', include(products_router.urls)),
-    path('', include(carts_router.urls))
+    path('', include(carts_router.urls)),
+    path('profiling/', views.ProfilingReportView.as_view()),    #admin only, per view sql/serializer timings from store.profiling.ProfilingMiddleware
+    path('reports/', views.SalesReportView.as_view()),     #admin only, sales per day/collection/product from the daily rollups (store/reports.py)
     #...other url patterns for specific purposes
 
 ]
 
+if getattr(settings, 'STORE_ASYNC_VIEWS', False):     #async views in front of the viewsets for the anonymous reads under asgi (store/async_views.py), they hand everything else to the viewsets
+    urlpatterns = async_views.get_urlpatterns(router.urls + products_router.urls + carts_router.urls) + urlpatterns
+
 #urlpatterns = router.urls + products_router.urls
 
 
@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.shortcuts import get_object_or_404
+from django.db.models import Prefetch
 from django.db.models.aggregates import Count
+from django.utils.module_loading import import_string
 from django_filters.rest_framework import DjangoFilterBackend       
 #from django.http import HttpResponse
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import NotFound, UnsupportedMediaType, ValidationError
 from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet, GenericViewSet
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, UpdateModelMixin, ListModelMixin
@@ -11,26 +15,41 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny, DjangoModelPermissions, DjangoModelPermissionsOrAnonReadOnly
 #from rest_framework.pagination import PageNumberPagination
 #from rest_framework.decorators import api_view
-#from rest_framework.views import APIView
+from rest_framework.views import APIView
 #from rest_framework.mixins import CreateModelMixin, ListModelMixin, RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin
 #from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 from .models import CartItem, Customer, Order, Product, Collection, OrderItem, Review, Cart
-from .serializers import AddCartItemSerializer, CartItemSerializer, CreateOrderSerializer, CustomerSerializer, OrderSerializer, ProductSerializer, CollectionSerializer, ReviewSerializer, CartSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
+from .serializers import AddCartItemSerializer, BulkAddCartItemsSerializer, CartItemSerializer, CreateOrderSerializer, CustomerHistorySerializer, CustomerSerializer, SalesReportQuerySerializer, OrderSerializer, ProductSerializer, CollectionSerializer, ReviewSerializer, CartSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
 from .filters import ProductFilter
-from .paginations import DefaultPagination 
+from .paginations import DefaultPagination, SelectablePagination, OptionalKeysetPagination
 from .permissions import IsAdminOrReadOnly, FullDjangoModelPermissions, ViewCustomerHistoryPermission
+from .search import FullTextSearchFilter
+from .checkout import InsufficientInventory
+from .carts import CartNotFound, QuantityTooLarge, get_cart_store
+from .profiling import get_report, reset_report
+from .fast_serializers import FastCartItemSerializer, FastCartSerializer, FastOrderSerializer, FastProductSerializer
+from .exports import ExportMixin
+from .imports import INPUTS, import_products, read_rows
+from .history import get_history
+from .reports import get_report as get_sales_report
+from .caches import CachedResponseMixin, ConditionalResponseMixin, VERSION_COLLECTIONS, VERSION_PRODUCTS, VERSION_PROMOTIONS, collection_version, review_version
 
 # Create your views here.
 
 
-class CollectionViewSet(ModelViewSet):
-    queryset = Collection.objects.annotate(products_count = Count('product') ).all() 
+class CollectionViewSet(ConditionalResponseMixin, ModelViewSet):     #list and retrieve send ETag/Last-Modified and answer 304 to a client that is up to date (store/caches.py)
+    queryset = Collection.objects.all()       #products_count is a column on Collection now, no need for 'annotate(products_count = Count('product'))'
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
 
+    def get_cache_versions(self):
+        if self.action == 'retrieve':
+            return [collection_version(self.kwargs['pk'])]
+        return [VERSION_COLLECTIONS]
+
 
     def destroy(self, request, *args, **kwargs):
-        if Product.objects.filter(collection_id = kwargs['pk']).count() > 0:   #we use this b/c not to retrieve the collection from the db again b/c we've already retrieved it in the destroy method in the ModelViewSet class
+        if Collection.objects.filter(pk = kwargs['pk'], products_count__gt = 0).exists():   #we use this b/c not to retrieve the collection from the db again b/c we've already retrieved it in the destroy method in the ModelViewSet class
             return Response({'error': 'The collection can not be deleted because it includes one or more products'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
         return super().destroy(request, *args, **kwargs)
 
@@ -41,15 +60,16 @@ class CollectionViewSet(ModelViewSet):
 
 
 
-class ProductViewSet(ModelViewSet):   #u can also use ReadOnlyViewSet
+class ProductViewSet(ExportMixin, ConditionalResponseMixin, CachedResponseMixin, ModelViewSet):   #u can also use ReadOnlyViewSet      #list and retrieve responses are served from the cache (store/caches.py) and answer 304 when the client's ETag is current... products/export/ streams the whole filtered list (store/exports.py), products/import/ takes a supplier feed (store/imports.py)
     queryset = Product.objects.all()
     serializer_class  = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter, OrderingFilter]     #FullTextSearchFilter uses the search index instead of 'LIKE %term%' (store/search.py)
     filterset_class = ProductFilter 
-    pagination_class = DefaultPagination
+    pagination_class = SelectablePagination      #page numbers by default, keyset pagination with '?pagination=cursor'
     permission_classes = [IsAdminOrReadOnly]   #only 'get' operation is available for the authenticated or anonymous users but all the operations are available for the admin user
     search_fields = ['title', 'description']    #text based fields are used for searching
-    Ordering_fields = ['unit_price']
+    ordering_fields = ['id', 'title', 'slug', 'description', 'inventory', 'unit_price', 'collection']    #listed explicitly, OrderingFilter can't read them from the fast serializer
+    export_serializer_class = FastProductSerializer
     #filterset_fields = ['collection_id', 'inventory']
 
     # def get_queryset(self):    #this below is a filtering logic
@@ -63,16 +83,71 @@ class ProductViewSet(ModelViewSet):   #u can also use ReadOnlyViewSet
 
 
 
+    def get_queryset(self):
+        if self.action in ['list', 'retrieve', 'export']:       #read only requests are serialized straight from '.values()' rows
+            return Product.objects.values(*FastProductSerializer.values_fields())
+        return Product.objects.all()
+
+    def get_serializer_class(self):
+        if self.action in ['list', 'retrieve']:
+            return FastProductSerializer      #same json as ProductSerializer without the per field overhead (store/fast_serializers.py)
+        return ProductSerializer
+
     def get_serializer_context(self):
         return {'request': self.request}
+
+    def get_cache_versions(self):
+        collection_id = self.request.query_params.get('collection_id')
+        if self.action == 'list' and collection_id and collection_id.isdigit():   #a page filtered by collection only goes stale when that collection's products change
+            return [collection_version(int(collection_id)), VERSION_PROMOTIONS]
+        return [VERSION_PRODUCTS, VERSION_PROMOTIONS]
+
+    def get_includes(self):     #e.g. '?include=tags,likes'... what can be included comes from STORE_PRODUCT_INCLUDES, {name: dotted path of a function(products, model)}
+        available = getattr(settings, 'STORE_PRODUCT_INCLUDES', {})
+        includes = list(dict.fromkeys(name for name in self.request.query_params.get('include', '').split(',') if name))
+        if set(includes) - set(available):
+            raise ValidationError({'include': f'Pick from {", ".join(available)}' if available else 'Nothing can be included'})
+        return includes
+
+    def is_conditional(self, request):
+        return not self.get_includes() and super().is_conditional(request)      #the tags and likes have no version counter, never a 304 for them
+
+    def list(self, request, *args, **kwargs):
+        return self.add_includes(super().list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.add_includes(super().retrieve(request, *args, **kwargs))
+
+    def add_includes(self, response):
+        #added to the (maybe cached) products after the response cache, so they are never older than the likes counters' own cache
+        includes = self.get_includes()
+        if response.status_code != status.HTTP_200_OK or not includes:
+            return response
+        products = response.data.get('results', [response.data]) if isinstance(response.data, dict) else response.data
+        available = getattr(settings, 'STORE_PRODUCT_INCLUDES', {})
+        for name in includes:
+            import_string(available[name])(products, Product)      #one query for the whole page, e.g. store_custom/loaders.py
+        return response
     
     def destroy(self, request, *args, **kwargs):
-            if OrderItem.objects.filter(product_id = kwargs['pk']).count() > 0:   #we use this b/c not to retrieve the product from the db again
+            if OrderItem.objects.filter(product_id = kwargs['pk']).exists():   #we use this b/c not to retrieve the product from the db again... exists() stops at the first row of the product_id index
                 return Response({'error': 'The product can not be deleted because it is associated with an order item'},status=status.HTTP_405_METHOD_NOT_ALLOWED)
             return super().destroy(request, *args, **kwargs)
 
             #kwargs(keyword arguments) is a dictionary that contains our url parameters(products/product_id)
 
+    @action(detail=False, methods=['POST'], url_path='import', permission_classes=[IsAdminUser])
+    def import_products(self, request):     #the feed is the request body (Content-Type text/csv or application/x-ndjson), it is read row by row and never parsed as a whole
+        content_type = request.content_type.split(';')[0].strip()
+        input_format = next((name for name, media_type in INPUTS.items() if media_type == content_type), None)
+        if input_format is None:
+            raise UnsupportedMediaType(content_type)
+        if request.stream is None:
+            raise ValidationError({'detail': 'The feed is empty'})
+        stats = import_products(read_rows(request.stream, input_format))
+        stats['rows_per_second'] = round(stats['rows'] / stats['seconds']) if stats['seconds'] else None
+        return Response(stats)
+
 
 
 
@@ -81,9 +156,12 @@ class ProductViewSet(ModelViewSet):   #u can also use ReadOnlyViewSet
 
 
 
-class ReviewViewSet(ModelViewSet):
+class ReviewViewSet(ConditionalResponseMixin, ModelViewSet):      #ETag/Last-Modified from the product's review counter (store/caches.py)
      #queryset = Review.objects.filter(product_id = )
      serializer_class = ReviewSerializer
+     filter_backends = [OrderingFilter]
+     ordering_fields = ['date', 'id']
+     pagination_class = OptionalKeysetPagination     #unpaginated unless the client asks for '?pagination=cursor'
 
      def get_queryset(self):
          return Review.objects.filter(product_id = self.kwargs['product_pk'])  #based on this logic, its hard to figure out the basename
@@ -91,6 +169,9 @@ class ReviewViewSet(ModelViewSet):
      def get_serializer_context(self):
         return {'product_id': self.kwargs['product_pk']}       #passing data in a context object to ReviewSerializer
 
+     def get_cache_versions(self):
+        return [review_version(self.kwargs['product_pk'])]
+
 
     #here in this class we have access to the 'product_pk' url parameter of the url: 'http://127.0.0.1:8000/store/products/product_pk/reviews/pk' using kwargs... and using the context object, we can pass it to the serializer
 
@@ -99,10 +180,25 @@ class ReviewViewSet(ModelViewSet):
 
 
 #possible operations are create cart, rertriev cart, delete cart
-class CartViewSet(GenericViewSet, CreateModelMixin, RetrieveModelMixin, DestroyModelMixin):   #ListModelMixin is not allowed b/c it is not wanted for anonymous users to see the list of carts and get their ids
-    queryset = Cart.objects.prefetch_related('items__product').all()  #preloading a cart with its items and then preloading each items with their product they reference
+class CartViewSet(GenericViewSet):   #ListModelMixin is not allowed b/c it is not wanted for anonymous users to see the list of carts and get their ids
+    queryset = Cart.objects.all()       #only gives the router its basename... the carts live in the cart store (database or cache, see store/carts.py) so create/retrieve/destroy talk to it
     serializer_class = CartSerializer
 
+    def create(self, request, *args, **kwargs):
+        cart = get_cart_store().create_cart()
+        return Response(FastCartSerializer(cart).data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk):
+        cart = get_cart_store().get_cart(pk)
+        if cart is None:
+            raise NotFound()
+        return Response(FastCartSerializer(cart).data)     #serializes the items once and sums the total in the same pass
+
+    def destroy(self, request, pk):
+        if not get_cart_store().delete_cart(pk):
+            raise NotFound()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 
 
@@ -116,19 +212,55 @@ class CartItemViewSet(ModelViewSet):
     http_method_names = ['post', 'get', 'patch', 'delete']
 
 
-    def get_queryset(self):
-        return CartItem.objects.filter(cart_id = self.kwargs['cart_pk']).select_related('product')
-    
     def get_serializer_class(self):  #the serializer class is set dynamically based on request method
+        if self.action == 'bulk':
+            return BulkAddCartItemsSerializer
         if self.request.method == 'POST':
             return AddCartItemSerializer
         elif self.request.method == 'PATCH':
             return UpdateCartItemSerializer
+        elif self.request.method == 'GET':
+            return FastCartItemSerializer
         return CartItemSerializer
     
     def get_serializer_context(self):
         return {'cart_id': self.kwargs['cart_pk']}     #passing data in a context object to AddCartItemSerializer
 
+    def get_object(self):       #the items are dicts from the cart store (store/carts.py)
+        item = get_cart_store().get_item(self.kwargs['cart_pk'], self.kwargs['pk'])
+        if item is None:
+            raise NotFound()
+        return item
+
+    def list(self, request, cart_pk):
+        return Response(FastCartItemSerializer(get_cart_store().get_items(cart_pk), many=True).data)
+
+    def create(self, request, *args, **kwargs):
+        try:
+            return super().create(request, *args, **kwargs)
+        except CartNotFound:
+            raise NotFound()
+        except QuantityTooLarge as error:     #nothing was added
+            return Response({'error': str(error), 'product_ids': error.product_ids}, status=status.HTTP_400_BAD_REQUEST)
+
+    def destroy(self, request, cart_pk, pk):
+        if not get_cart_store().remove_item(cart_pk, pk):
+            raise NotFound()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False, methods=['POST'])      #store/carts/{cart_id}/items/bulk/ adds many products at once and returns the updated cart
+    def bulk(self, request, cart_pk):
+        data = {'items': request.data} if isinstance(request.data, list) else request.data    #a bare list of items is accepted too
+        serializer = BulkAddCartItemsSerializer(data = data, context = self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        try:
+            serializer.save()
+        except CartNotFound:
+            raise NotFound()
+        except QuantityTooLarge as error:     #nothing was added
+            return Response({'error': str(error), 'product_ids': error.product_ids}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(FastCartSerializer(get_cart_store().get_cart(cart_pk)).data)
+
 
 
 
@@ -165,8 +297,9 @@ class CustomerViewSet(ModelViewSet):
     
 
     @action(detail=True, permission_classes=[ViewCustomerHistoryPermission])                                                           #this action is available on the detail view(store/customers/1)
-    def history(self, request, pk):
-        return Response('hi')
+    def history(self, request, pk):     #order count, lifetime spend, last order and top products (store/history.py)
+        customer = self.get_object()
+        return Response(CustomerHistorySerializer(get_history(customer.pk)).data)
     #first create the custom model permission(like view histroy) then create the endpoint(for viewing a particular customer's histroy) and then apply the custom model permission to the endpoint
 
 
@@ -176,14 +309,20 @@ class CustomerViewSet(ModelViewSet):
 
 
 
-class OrderViewSet(ModelViewSet):
+class OrderViewSet(ExportMixin, ModelViewSet):      #orders/export/ streams all the orders with their items (store/exports.py)
     #queryset = Order.objects.all()
     #serializer_class = OrderSerializer
     #permission_classes = [IsAuthenticated]
     http_method_names = ['get', 'post', 'patch', 'delete', 'head', 'options']    #available methods at this endpoint
+    filter_backends = [OrderingFilter]
+    ordering_fields = ['placed_at', 'id']
+    pagination_class = OptionalKeysetPagination     #unpaginated unless the client asks for '?pagination=cursor'
+    export_serializer_class = FastOrderSerializer
 
 
     def get_permissions(self):
+        if self.action == 'export':
+            return super().get_permissions()       #the export action's own permission_classes
         if self.request.method in ['PATCH', 'DELETE']:
             return [IsAdminUser()]
         return [IsAuthenticated()]
@@ -191,19 +330,40 @@ class OrderViewSet(ModelViewSet):
 
 
     def create(self, request, *args, **kwargs):   #in the createModelMixin        #create resembles 'POST' method in the old way
-        serializer = CreateOrderSerializer( data = request.data, context = {'user_id' : self.request.user.id} )
+        serializer = CreateOrderSerializer( data = request.data, context = {'user_id' : self.request.user.id, 'customer_id': getattr(self.request.user, 'customer_id', None)} )
         serializer.is_valid(raise_exception=True)
-        order = serializer.save()    #here when we call the save method of the serializer, the validated datas(cart_id in our eg) are also passed to the save method of the serializer
+        try:
+            order = serializer.save()    #here when we call the save method of the serializer, the validated datas(cart_id in our eg) are also passed to the save method of the serializer
+        except InsufficientInventory as error:     #nothing was saved, the checkout transaction was rolled back
+            return Response({'error': str(error), 'shortages': error.shortages}, status=status.HTTP_409_CONFLICT)
+        except CartNotFound as error:      #checked out (or expired) since it was validated, or a concurrent checkout of it is running
+            raise ValidationError({'cart_id': [str(error) or 'no cart with the given id is in the db']})
+        order = self.get_queryset().get(pk = order.pk)    #reloaded with its items and products so serializing it doesn't query per item
         serializer = OrderSerializer(order)
         return Response(serializer.data)
 
 
 
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return Order.objects.all()
-        customer_id = Customer.objects.only('id').get(user_id = self.request.user.id)   #else
-        return Order.objects.filter(customer_id = customer_id)
+        queryset = Order.objects.prefetch_related(      #2 queries whatever the page size: the orders, then all their items joined with their products
+            Prefetch('items', queryset = OrderItem.objects.select_related('product'))
+        )
+        if self.request.user.is_staff or self.action == 'export':      #ExportPermission lets only staff and reporting users export
+            return queryset
+        customer_id = getattr(self.request.user, 'customer_id', None)      #set by CachedJWTAuthentication (store_custom/authentication.py)
+        if customer_id is not None:
+            return queryset.filter(customer_id = customer_id)
+        return queryset.filter(customer__user_id = self.request.user.id)   #else     #filtering through the join saves the extra 'Customer.objects.get(user_id = ...)' query
+
+
+    def get_export_header(self):       #one csv row per order item
+        return ['id', 'customer', 'placed_at', 'payment_status', 'item_id', 'product_id', 'product_title', 'quantity', 'unit_price']
+
+    def get_export_rows(self, order):
+        columns = [order['id'], order['customer'], order['placed_at'], order['payment_status']]
+        if not order['items']:
+            return [columns + [''] * 5]
+        return [columns + [item['id'], item['product']['id'], item['product']['title'], item['quantity'], item['unit_price']] for item in order['items']]
 
 
     def get_serializer_class(self):
@@ -229,6 +389,33 @@ class OrderViewSet(ModelViewSet):
 
 
 
+class ProfilingReportView(APIView):      #aggregated numbers of the sampling profiler (store/profiling.py)
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(get_report())
+
+    def delete(self, request):
+        reset_report()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+
+
+class SalesReportView(APIView):     #revenue, units and orders per day, collection or product from the daily rollups (store/reports.py)
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        query = SalesReportQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        return Response({**query.validated_data, **get_sales_report(**query.validated_data)})
+
+
+
+
+
+
+
 #the authentication middleware looks if there is any info about a user in the request obj and if there is, it uses it to retrieve a user from db and sets it to the user attribute of the request object otherwise the user attrib in the request obj is set to an instance of anonymous user
 
 
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from .models import User
+
+
+#JWTAuthentication loads the user from the database on every request, and the views then look up its customer...
+#CachedJWTAuthentication keeps what a request needs about the user (the user row without the password and its customer id)
+#in a small lru of the process for a few seconds and in the shared cache for a few minutes, so most requests don't query anything to authenticate
+#(its permissions are cached by store_custom/backends.py)
+#
+#saving or deleting a User or its Customer drops its entry (store_custom/signals/handlers.py)...
+#the shared cache right away, the lru of the other processes when their AUTH_USER_CACHE_LOCAL_TIMEOUT runs out
+#
+#    REST_FRAMEWORK = {'DEFAULT_AUTHENTICATION_CLASSES': ('store_custom.authentication.CachedJWTAuthentication',)}
+
+
+USER_FIELDS = ['id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser']      #request.user has these, the others (password, last_login...) load on first use like .only() fields
+
+
+def get_cache():
+    return caches[getattr(settings, 'AUTH_USER_CACHE_ALIAS', 'default')]
+
+
+def _user_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+
+
+class LocalCache:       #lru of the process with a ttl per entry
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()        #key -> (expires, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_local = LocalCache(getattr(settings, 'AUTH_USER_CACHE_SIZE', 10_000))
+
+
+
+
+def load_entry(user_id):        #one query for the user and its customer
+    row = User.objects.filter(pk=user_id).values(*USER_FIELDS, 'password', 'customer__id').first()
+    if row is None:
+        return None
+    return {
+        'user': {name: row[name] for name in USER_FIELDS},
+        'customer_id': row['customer__id'],
+        'revoke': get_md5_hash_password(row['password']) if api_settings.CHECK_REVOKE_TOKEN else None,     #never the password itself
+    }
+
+
+def get_entry(user_id):
+    key = _user_key(user_id)
+    entry = _local.get(key)
+    if entry is not None:
+        return entry
+
+    cache = get_cache()
+    entry = cache.get(key)
+    if entry is None:
+        entry = load_entry(user_id)
+        if entry is None:
+            return None
+        cache.set(key, entry, getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 60 * 5))
+    _local.set(key, entry, getattr(settings, 'AUTH_USER_CACHE_LOCAL_TIMEOUT', 5))
+    return entry
+
+
+def build_user(entry):
+    #a User like the database would return it (saving it only writes the loaded fields), plus its customer_id
+    field_names = [field.attname for field in User._meta.concrete_fields if field.attname in entry['user']]     #from_db wants them in the model's order
+    user = User.from_db(DEFAULT_DB_ALIAS, field_names, [entry['user'][name] for name in field_names])
+    user.customer_id = entry['customer_id']
+    return user
+
+
+def invalidate_user(user_id):
+    key = _user_key(user_id)
+    _local.delete(key)
+    get_cache().delete(key)
+
+
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_FIELD != 'id':      #the entries are kept by primary key
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        entry = get_entry(user_id)
+        if entry is None:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        if api_settings.CHECK_USER_IS_ACTIVE and not entry['user']['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != entry['revoke']:
+            raise AuthenticationFailed("The user's password has been changed.", code='password_changed')
+        return build_user(entry)
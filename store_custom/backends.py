@@ -0,0 +1,70 @@
+import time
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+
+#ModelBackend reads a user's permissions with two joined queries (its own, its groups') the first time a user object is asked,
+#and request.user is a new object on every request... CachedModelBackend compiles them once into a frozenset of 'app_label.codename'
+#and keeps it in the shared cache, so has_perm (DjangoModelPermissions, FullDjangoModelPermissions, ViewCustomerHistoryPermission...) costs no query
+#
+#every set is stored with the permission version it was built under: a change to a group's permissions (or a permission or group deleted)
+#bumps the version and every set is rebuilt on its next use, a change to one user's permissions or groups drops that user's set (store_custom/signals/handlers.py)
+#
+#    AUTHENTICATION_BACKENDS = ['store_custom.backends.CachedModelBackend']
+
+
+VERSION_KEY = 'auth:permissions:version'
+
+
+def get_cache():
+    return caches[getattr(settings, 'AUTH_USER_CACHE_ALIAS', 'default')]
+
+
+def _permissions_key(user_id):
+    return f'auth:permissions:{user_id}'
+
+
+def invalidate_permissions(user_id):
+    get_cache().delete(_permissions_key(user_id))
+
+
+def get_permissions_version(cache, found):
+    #a missing version (never set or evicted) starts from the clock, like store.caches.get_versions... restarting from 0 or 1
+    #would make a set cached under that value before a permission change valid again
+    if VERSION_KEY not in found:
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        found[VERSION_KEY] = cache.get(VERSION_KEY)
+    return found[VERSION_KEY]
+
+
+def bump_permissions_version():
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:      #not in the cache yet
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+
+
+
+
+class CachedModelBackend(ModelBackend):
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):        #the same per object cache as ModelBackend, filled from the shared cache
+            user_obj._perm_cache = self.get_permission_set(user_obj)
+        return user_obj._perm_cache
+
+    def get_permission_set(self, user_obj):
+        cache = get_cache()
+        key = _permissions_key(user_obj.pk)
+        found = cache.get_many([key, VERSION_KEY])      #one round trip for the set and the version
+        version = get_permissions_version(cache, found)
+        entry = found.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        permissions = frozenset(super().get_all_permissions(user_obj))     #the superuser gets every permission, like ModelBackend
+        cache.set(key, (version, permissions), getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 60 * 5))
+        return permissions
@@ -0,0 +1,110 @@
+from collections import defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import QuerySet
+from likes.counters import get_counts
+from tags.models import TaggedItem
+
+
+#batch loaders for the generic relations (tags, likes) in the style of a DataLoader:
+#load() only queues an object, the first get() (or load_many()) resolves everything queued with one query per content type
+#and the results stay cached on the loader, so one loader per request/page never asks twice for the same object
+#
+#    tags = TagLoader()
+#    tags.load(product)
+#    tags.load(collection)
+#    tags.get(product)          #one query for the products, one for the collections
+#
+#objects can be model instances or '.values()' rows (pass the model for the rows)
+
+
+class GenericRelationLoader:
+    def __init__(self):
+        self.values = {}        #(content_type_id, object_id) -> value
+        self.queue = defaultdict(set)       #content_type -> object ids waiting for the next dispatch
+
+    def batch(self, content_type, object_ids):      #{object_id: value} for the object ids of one content type, in one query
+        raise NotImplementedError
+
+    def empty(self):        #the value of an object that has nothing
+        return None
+
+    def key(self, obj, model=None):
+        if isinstance(obj, dict):
+            content_type = ContentType.objects.get_for_model(model)     #cached by ContentTypeManager after the first call
+            return content_type, obj['id']
+        return ContentType.objects.get_for_model(model or obj), obj.pk
+
+    def load(self, obj, model=None):
+        content_type, object_id = self.key(obj, model)
+        if (content_type.id, object_id) not in self.values:
+            self.queue[content_type].add(object_id)
+        return content_type.id, object_id
+
+    def dispatch(self):
+        queue, self.queue = self.queue, defaultdict(set)
+        for content_type, object_ids in queue.items():
+            found = self.batch(content_type, object_ids)
+            for object_id in object_ids:
+                self.values[(content_type.id, object_id)] = found.get(object_id, self.empty())
+
+    def get(self, obj, model=None):
+        key = self.load(obj, model)
+        if self.queue:
+            self.dispatch()
+        return self.values[key]
+
+    def load_many(self, objects, model=None):
+        keys = [self.load(obj, model) for obj in objects]
+        if self.queue:
+            self.dispatch()
+        return [self.values[key] for key in keys]
+
+
+
+
+class TagLoader(GenericRelationLoader):     #[tag, ...] of each object
+    def batch(self, content_type, object_ids):
+        return TaggedItem.objects.get_tags_for_many(content_type, object_ids)
+
+    def empty(self):
+        return []
+
+
+class LikeCountLoader(GenericRelationLoader):       #number of likes of each object, from the cached sums of the sharded counters (likes/counters.py)
+    def batch(self, content_type, object_ids):
+        return get_counts(content_type, object_ids)
+
+    def empty(self):
+        return 0
+
+
+
+
+def prefetch_tags_and_likes(objects, model=None, tags=True, likes=True):
+    #attaches 'tags' (the labels) and 'likes_count' to every object, at most two queries for the whole page (per content type)...
+    #works with the querysets of ProductViewSet (product instances or '.values()' rows) and with any list of them, e.g. a paginated page
+    if isinstance(objects, QuerySet):
+        model = model or objects.model
+    objects = list(objects)
+
+    values = {}
+    if tags:
+        values['tags'] = [[tag.label for tag in obj_tags] for obj_tags in TagLoader().load_many(objects, model)]
+    if likes:
+        values['likes_count'] = LikeCountLoader().load_many(objects, model)
+    for name, column in values.items():
+        for obj, value in zip(objects, column):
+            if isinstance(obj, dict):
+                obj[name] = value
+            else:
+                setattr(obj, name, value)
+    return objects
+
+
+#the '?include=' hooks of ProductViewSet (STORE_PRODUCT_INCLUDES in the settings), called with the serialized products of a page
+def prefetch_tags(objects, model=None):
+    return prefetch_tags_and_likes(objects, model, likes=False)
+
+
+def prefetch_likes(objects, model=None):
+    return prefetch_tags_and_likes(objects, model, tags=False)
@@ -0,0 +1,81 @@
+import statistics
+import time
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.core.management.base import BaseCommand
+from rest_framework.request import Request
+from rest_framework.views import APIView
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+from store_custom.authentication import CachedJWTAuthentication
+
+
+#authenticated requests with real tokens (benchmark_endpoints uses force_authenticate and skips authentication) through
+#JWTAuthentication and CachedJWTAuthentication: the authentication alone and whole requests, spread over --users users
+#runs on a throwaway test database
+#
+#    python manage.py benchmark_auth --settings=coredjango.benchmark_settings
+class Command(BaseCommand):
+    help = 'Compares the per request cost of JWTAuthentication and CachedJWTAuthentication'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--requests', type=int, default=2000, help='requests per measurement')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        old_classes = APIView.authentication_classes
+        try:
+            User = get_user_model()
+            users = [User.objects.create(username=f'benchmark_{i}', email=f'benchmark_{i}@example.com') for i in range(options['users'])]      #the signal creates their customers
+            tokens = [f'JWT {AccessToken.for_user(user)}' for user in users]
+            self.stdout.write(f'{options["requests"]} requests per line, {options["users"]} users ({connection.vendor})')
+
+            for authentication_class in [JWTAuthentication, CachedJWTAuthentication]:
+                APIView.authentication_classes = [authentication_class]     #every viewset inherits it
+                cache.clear()
+                self.stdout.write(f'  {authentication_class.__name__}')
+                self.print_result('authenticate()', self.measure(lambda token: self.authenticate(authentication_class(), token), tokens, options['requests']))
+                client = Client()
+                for url in ['/store/orders/', '/store/customers/me/']:
+                    self.print_result(url, self.measure(lambda token: client.get(url, HTTP_AUTHORIZATION=token, HTTP_ACCEPT='application/json'), tokens, options['requests']))
+        finally:
+            APIView.authentication_classes = old_classes
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def authenticate(self, authenticator, token):
+        request = Request(RequestFactory().get('/', HTTP_AUTHORIZATION=token))
+        user, _ = authenticator.authenticate(request)
+        return user
+
+    def measure(self, call, tokens, requests):
+        latencies = []
+        queries = 0
+
+        def count(execute, sql, params, many, context):     #the test client resets connection.queries on every request, this counts across them
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            for i in range(requests):
+                started = time.perf_counter()
+                call(tokens[i % len(tokens)])
+                latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return {
+            'mean_us': statistics.mean(latencies) * 1e6,
+            'p50_us': latencies[len(latencies) // 2] * 1e6,
+            'p95_us': latencies[int(len(latencies) * 0.95)] * 1e6,
+            'queries': queries / requests,
+        }
+
+    def print_result(self, name, result):
+        self.stdout.write(
+            f'    {name:<22} mean {result["mean_us"]:>8.0f} us  p50 {result["p50_us"]:>8.0f} us  p95 {result["p95_us"]:>8.0f} us  '
+            f'{result["queries"]:.2f} queries/request')
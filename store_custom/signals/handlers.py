@@ -1,5 +1,12 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
+from django.contrib.auth.models import Group, Permission
+from store.caches import now_and_on_commit
+from store.models import Customer
 from store.signals import order_created     #here the store_custom app is being dependent on the store(its okay but the other way around is not okay)
+from store_custom.authentication import invalidate_user
+from store_custom.backends import bump_permissions_version, invalidate_permissions
+from store_custom.models import User
 
 
 #this receiver receives and handles an order_created signal that is sent from the Order class through its CreateOrderSerializer
@@ -10,4 +17,47 @@ def on_order_created(sender, **kwargs):
 
 
 
-#when we receive a custom signal, we don't need to specify the sender class as an argument in the receiver decorator otherwise we don't get the expected result
\ No newline at end of file
+#when we receive a custom signal, we don't need to specify the sender class as an argument in the receiver decorator otherwise we don't get the expected result
+
+
+
+
+#drop the entries of CachedJWTAuthentication (store_custom/authentication.py) and the permission sets of CachedModelBackend (store_custom/backends.py)
+#when what they hold changes... again after the commit, so a request that read the old rows before the commit can't leave them in the cache
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    now_and_on_commit(invalidate_user, instance.pk)
+    now_and_on_commit(invalidate_permissions, instance.pk)     #is_active and is_superuser change what the user may do
+
+
+@receiver([post_save, post_delete], sender=Customer)
+def invalidate_cached_customer(sender, instance, **kwargs):
+    now_and_on_commit(invalidate_user, instance.user_id)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_cached_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:     #user.groups.add(...), user.user_permissions.remove(...)
+        now_and_on_commit(invalidate_permissions, instance.pk)
+    elif pk_set:        #group.user_set.add(user, ...)
+        for user_id in pk_set:
+            now_and_on_commit(invalidate_permissions, user_id)
+    else:       #permission.user_set.clear()... no way to tell whose
+        now_and_on_commit(bump_permissions_version)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_cached_group_permissions(sender, action, **kwargs):
+    if action.startswith('post_'):
+        now_and_on_commit(bump_permissions_version)
+
+
+@receiver(post_delete, sender=Group)
+@receiver([post_save, post_delete], sender=Permission)
+def invalidate_all_cached_permissions(sender, **kwargs):      #deleting cascades to the links without m2m_changed, a new permission is one more for the superusers
+    now_and_on_commit(bump_permissions_version)
@@ -1,3 +1,89 @@
-from django.test import TestCase
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from rest_framework.request import Request
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken
+from store.models import Customer
+from .authentication import CachedJWTAuthentication, _local
+from .backends import VERSION_KEY, _permissions_key
+from .models import User
 
 # Create your tests here.
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _local.clear()
+        self.user = User.objects.create(username='customer', email='customer@example.com')
+        self.token = f'JWT {AccessToken.for_user(self.user)}'
+
+    def authenticate(self):
+        request = Request(RequestFactory().get('/', HTTP_AUTHORIZATION=self.token))
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        return user
+
+    def test_second_request_runs_no_queries(self):
+        self.authenticate().has_perm('store.view_product')
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+            self.assertFalse(user.has_perm('store.view_product'))
+        self.assertEqual((user.pk, user.username, user.customer_id), (self.user.pk, 'customer', Customer.objects.get(user=self.user).pk))
+
+    def test_saving_the_user_or_its_permissions_drops_the_entry(self):
+        self.authenticate()
+        self.user.user_permissions.add(Permission.objects.get(codename='view_product'))
+        self.assertTrue(self.authenticate().has_perm('store.view_product'))
+
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+
+
+
+class CachedModelBackendTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='customer', email='customer@example.com')
+        self.group = Group.objects.create(name='staff')
+        self.user.groups.add(self.group)
+        self.permission = Permission.objects.get(codename='view_product')
+
+    def fresh_user(self):       #like request.user, a new object without the permissions of the last one
+        return User.objects.get(pk=self.user.pk)
+
+    def test_permission_set_is_shared_by_the_user_objects(self):
+        self.assertFalse(self.fresh_user().has_perm('store.view_product'))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertFalse(user.has_perm('store.view_product'))
+            self.assertFalse(user.has_perms(['store.view_product', 'store.change_product']))
+
+    def test_permission_changes_rebuild_the_sets(self):
+        self.assertFalse(self.fresh_user().has_perm('store.view_product'))
+        self.group.permissions.add(self.permission)
+        self.assertTrue(self.fresh_user().has_perm('store.view_product'))
+
+        self.group.permissions.remove(self.permission)
+        self.permission.user_set.add(self.user)
+        self.assertTrue(self.fresh_user().has_perm('store.view_product'))
+
+        self.group.delete()
+        self.permission.user_set.clear()
+        self.assertFalse(self.fresh_user().has_perm('store.view_product'))
+
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertTrue(self.fresh_user().has_perm('store.view_product'))
+
+    def test_an_evicted_version_never_comes_back_to_an_old_value(self):
+        self.assertFalse(self.fresh_user().has_perm('store.view_product'))
+        stale = cache.get(_permissions_key(self.user.pk))
+        self.group.permissions.add(self.permission)
+        cache.delete(VERSION_KEY)       #evicted
+        cache.set(_permissions_key(self.user.pk), stale)       #the set of before the change, still cached
+        self.assertTrue(self.fresh_user().has_perm('store.view_product'))
+        self.assertGreater(cache.get(VERSION_KEY), 1000)        #from the clock
@@ -14,6 +14,13 @@ class TaggedItemManager(models.Manager):
                 object_id=obj_id
             )
 
+    def get_tags_for_many(self, content_type, object_ids):
+        #{object_id: [tag, ...]} for many objects of one content type in one query (store_custom/loaders.py batches mixed content types)
+        tags = {}
+        for item in self.select_related('tag').filter(content_type=content_type, object_id__in=object_ids).order_by('id'):
+            tags.setdefault(item.object_id, []).append(item.tag)
+        return tags
+
 
 class Tag(models.Model):
     label = models.CharField(max_length=255)
@@ -28,3 +35,8 @@ class TaggedItem(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_type', 'object_id'], name='tags_taggeditem_object_idx')     #get_tags_for looks the tags up by the tagged object
+        ]
@@ -1,3 +1,128 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from likes.counters import add
+from store.models import Collection, Product
+from store_custom.loaders import LikeCountLoader, TagLoader, prefetch_tags_and_likes
+from .models import Tag, TaggedItem
 
 # Create your tests here.
+
+
+class TagLoaderTests(TestCase):
+    def setUp(self):
+        cache.clear()       #the like counts are cached (likes/counters.py)
+        self.collections = [Collection.objects.create(title=f'collection {i}') for i in range(2)]
+        self.products = [
+            Product.objects.create(title=f'product {i}', slug='product', unit_price=10, inventory=10, collection=self.collections[0])
+            for i in range(3)
+        ]
+        self.red, self.blue = Tag.objects.create(label='red'), Tag.objects.create(label='blue')
+        self.tag(self.products[0], self.red, self.blue)
+        self.tag(self.products[1], self.blue)
+        self.tag(self.collections[0], self.red)
+        self.product_type = ContentType.objects.get_for_model(Product)      #the content types are cached from here on
+        self.collection_type = ContentType.objects.get_for_model(Collection)
+
+    def tag(self, obj, *tags):
+        for tag in tags:
+            TaggedItem.objects.create(tag=tag, content_object=obj)
+
+    def test_one_query_per_content_type(self):
+        loader = TagLoader()
+        objects = self.products + self.collections
+        with CaptureQueriesContext(connection) as context:
+            tags = loader.load_many(objects)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertEqual([[tag.label for tag in obj_tags] for obj_tags in tags], [['red', 'blue'], ['blue'], [], ['red'], []])
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(loader.get(self.collections[0])[0].label, 'red')        #already loaded
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_the_same_object_id_in_two_content_types(self):
+        product = Product.objects.create(id=self.collections[1].id + 1000, title='product', slug='product', unit_price=10, inventory=10, collection=self.collections[0])
+        collection = Collection.objects.create(id=product.id, title='collection')
+        self.tag(product, self.blue)
+        self.tag(collection, self.red)
+        self.assertEqual([[tag.label for tag in obj_tags] for obj_tags in TagLoader().load_many([product, collection])], [['blue'], ['red']])
+
+    def test_like_counts_of_mixed_content_types(self):
+        add(self.product_type, {self.products[0].id: 2, self.products[2].id: 1})
+        add(self.collection_type, {self.collections[0].id: 3})
+        with CaptureQueriesContext(connection) as context:
+            counts = LikeCountLoader().load_many(self.products + self.collections)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertEqual(counts, [2, 0, 1, 3, 0])
+
+    def test_prefetch_rows_and_instances(self):
+        add(self.product_type, {self.products[0].id: 1})
+        rows = list(Product.objects.filter(id__in=[product.id for product in self.products]).order_by('id').values('id', 'title'))
+        with CaptureQueriesContext(connection) as context:
+            prefetch_tags_and_likes(rows, Product)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertEqual([(row['tags'], row['likes_count']) for row in rows], [(['red', 'blue'], 1), (['blue'], 0), ([], 0)])
+
+        collections = prefetch_tags_and_likes(Collection.objects.filter(id__in=[collection.id for collection in self.collections]).order_by('id'), likes=False)
+        self.assertEqual([collection.tags for collection in collections], [['red'], []])
+        self.assertFalse(hasattr(collections[0], 'likes_count'))
+
+
+
+
+class ProductIncludeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.collection = Collection.objects.create(title='collection')
+        self.tag = Tag.objects.create(label='red')
+        self.product_type = ContentType.objects.get_for_model(Product)
+        self.products = []
+        self.create_products(3)
+
+    def create_products(self, count):
+        for i in range(count):
+            product = Product.objects.create(title=f'product {i}', slug='product', unit_price=10, inventory=10, collection=self.collection)
+            TaggedItem.objects.create(tag=self.tag, content_object=product)
+            add(self.product_type, {product.id: len(self.products) + 1})
+            self.products.append(product)
+
+    def get(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response, len(context.captured_queries)
+
+    def test_list_includes_tags_and_likes_in_constant_queries(self):
+        url = f'/store/products/?collection_id={self.collection.id}&include=tags,likes'
+        response, before = self.get(url)
+        self.assertEqual([(product['tags'], product['likes_count']) for product in response.data['results']], [(['red'], 1), (['red'], 2), (['red'], 3)])
+        self.create_products(5)
+        response, after = self.get(url)
+        self.assertEqual(len(response.data['results']), 8)
+        self.assertEqual(before, after)
+        _, plain = self.get(f'/store/products/?collection_id={self.collection.id}')
+        self.assertEqual(after, plain + 2)      #one query for the tags, one for the like counts
+
+    def test_only_what_is_asked(self):
+        response, _ = self.get(f'/store/products/{self.products[1].id}/?include=likes')
+        self.assertEqual(response.data['likes_count'], 2)
+        self.assertNotIn('tags', response.data)
+        response, _ = self.get(f'/store/products/{self.products[1].id}/')
+        self.assertNotIn('likes_count', response.data)
+        self.assertEqual(self.client.get('/store/products/?include=reviews').status_code, 400)
+        with self.settings(STORE_PRODUCT_INCLUDES={}):
+            self.assertEqual(self.client.get(f'/store/products/{self.products[1].id}/?include=likes').status_code, 400)
+
+    def test_the_likes_are_fresh_on_a_cached_page(self):
+        url = f'/store/products/{self.products[0].id}/?include=likes'
+        self.assertEqual(self.client.get(url).data['likes_count'], 1)
+        etag = self.client.get(url).get('ETag')
+        self.assertIsNone(etag)     #never 304'd, the likes have no version counter
+        with self.captureOnCommitCallbacks(execute=True):
+            add(self.product_type, {self.products[0].id: 1})
+        self.assertEqual(self.client.get(url).data['likes_count'], 2)